@@ -0,0 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+from Profiling import span
+import pickle
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _render(payload):
+    # Runs in the worker process: the artifact and its snapshot were pickled at submission
+    func, args, kwargs = pickle.loads(payload)
+    return func(*args, **kwargs)
+
+class ArtifactQueue:
+    """
+    Renders the plots and reports in background processes while the optimization goes on.
+
+    The arguments of an artifact are pickled when it is submitted, so that they are a snapshot
+    of the schedule at that point even if the schedule changes afterwards. Artifacts returning
+    a string (terminal reports) have it printed at join(), in the order of submission.
+    Intermediate artifacts (the priority stages) can be skipped altogether, and artifacts
+    submitted with a key can pass their result (e.g. PNG bytes) to later ones through result().
+    With max_workers=0 the artifacts are rendered synchronously in the main process.
+    """
+
+    def __init__(self, max_workers=2, intermediate=True):
+        """
+        Args:
+            max_workers (int): プロセス数。0 の場合は同期的に描きます。
+            intermediate (bool): 途中の段階の成果物を作るか。
+        """
+        self.intermediate = intermediate
+        self._executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self._futures = []
+        self._names = []
+        self._keys = {}
+        self._t0 = time.perf_counter()
+
+    def submit(self, func, *args, intermediate=False, barrier=False, key=None, **kwargs):
+        """
+        成果物の作成を登録します。
+
+        Args:
+            func: 成果物を作るモジュールレベルの関数。
+            args: func の引数 (この時点の内容で送られます)。
+            intermediate (bool): 途中の段階の成果物。intermediate=False のキューでは作りません。
+            barrier (bool): それまでに登録した成果物が全て終わってから作ります (それらのファイルを読む場合)。
+            key (str): result() で結果を受け取るためのキー。
+
+        Returns:
+            Future: 成果物の Future。作らない場合は None。
+        """
+        if intermediate and not self.intermediate:
+            return None
+        if barrier:
+            self.wait()
+        name = getattr(func, '__name__', str(func))
+        # Synchronously the span covers the rendering, otherwise only the pickling of the snapshot
+        with span(f'submit {name}'):
+            if self._executor is None:
+                future = Future()
+                future.set_result(func(*args, **kwargs))
+                self._print(name, future)
+            else:
+                future = self._executor.submit(_render, pickle.dumps((func, args, kwargs)))
+        if key is not None:
+            self._keys[key] = future
+        if self._executor is None:
+            return future
+        self._futures.append(future)
+        self._names.append(name)
+        return future
+
+    def wait(self):
+        """
+        登録した成果物が全て終わるまで待ちます。
+        """
+        wait(self._futures)
+
+    def result(self, key, default=None):
+        """
+        キー key で登録した成果物の結果を待って返します (PNG のバイト列などを次の成果物に渡す場合)。
+
+        Returns:
+            成果物の結果。登録されていないか失敗した場合は default。
+        """
+        future = self._keys.get(key)
+        if future is None:
+            return default
+        if future.exception() is not None:
+            logger.error(f"Artifact {key} failed: {future.exception()!r}")
+            return default
+        return future.result()
+
+    def _print(self, name, future):
+        if future.exception() is not None:
+            logger.error(f"Artifact {name} failed: {future.exception()!r}")
+        elif isinstance(future.result(), str):
+            print(future.result(), end='')
+
+    def join(self):
+        """
+        全ての成果物を待ち、端末用の出力を表示して、プロセスを終了します。
+
+        Raises:
+            Exception: 失敗した成果物があった場合は、最初の例外。
+        """
+        with span('artifacts.join'):
+            self.wait()
+        errors = []
+        for name, future in zip(self._names, self._futures):
+            self._print(name, future)
+            if future.exception() is not None:
+                errors.append(future.exception())
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        logger.info(f"{len(self._futures)} artifacts rendered in the background "
+                    f"({time.perf_counter() - self._t0:.1f} s since the queue was created)")
+        self._futures = []
+        self._names = []
+        self._keys = {}
+        if errors:
+            raise errors[0]
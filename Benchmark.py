@@ -0,0 +1,293 @@
+from Params import Params
+from MyObserver import MyObserver
+from ObsSlot import ObsDate
+from Targets import TargetManager, field_name
+from Visibility import VisibilityWindows
+from ObservingConditions import ObservingConditions
+from Optimize import OptimizeSchedule, slew_transitions, ROTANG_MIN, ROTANG_MAX
+from Report import scheduleFrame, formatSchedule, createTableContents, write_text_and_table_to_pdf
+from Profiling import Profiler, span, peak_rss_mb
+import Profiling
+from concurrent.futures import ProcessPoolExecutor
+from astropy.table import Table
+from astropy.time import Time
+from astropy.coordinates import Angle
+import astropy.units as u
+import numpy as np
+import datetime
+import platform
+import tempfile
+import json
+import os
+import logging
+import argparse
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the pointings of each WG in the synthetic target tables
+WG_MIX = {'CO': 0.5, 'GE': 0.2, 'GA': 0.3}
+
+# Mean length of a lunation (days), the spacing of the observing runs
+LUNATION = 29.53
+
+# Stages timed for each case, in order. The model stage is split into the build of the MILP and the CBC solve
+SUMMARY_COLUMNS = ['obsdate', 'targets', 'visibility', 'conditions', 'model_build', 'model_solve', 'slew', 'report']
+
+def generate_obsdates(fname, n_nights, start='2025-05-26', run_length=5):
+    """
+    n_nights 夜の観測日ファイルを作ります。夜は run_length 夜の連続した観測ランに分け、ランは朔望月ごとに置きます。
+
+    Args:
+        fname (str): 観測日ファイルの名前。
+        n_nights (int): 夜の数。
+        start (str): 最初の夜の日付 (HST)。
+        run_length (int): 1 つの観測ランの夜の数。
+
+    Returns:
+        list: 夜の日付 (HST) のリスト。
+    """
+    first = Time(start)
+    dates = [(first + (k // run_length * LUNATION + k % run_length) * u.day).iso[:10] for k in range(n_nights)]
+    # Whitespace-separated like obsdates_2025May.txt
+    with open(fname, 'w') as f:
+        f.write(f"{'date':10s} {'start':8s} end\n")
+        for date in dates:
+            f.write(f"{date} {'sun_set':8s} sun_rise\n")
+    return dates
+
+def generate_targets(fname, n_pointings, dates, observer, mix=None, seed=0):
+    """
+    n_pointings ポインティングの合成ターゲット表を作ります (sspplan.py の ECSV と同じ列)。
+
+    CO は赤緯一定の帯に並べたポインティング、GE は preMer/postMer の組 (同じ位置で PA が 0/180)、
+    GA は同じ位置と PA を持つサブポインティング (<フィールド>_<番号>) に分けたフィールドです。
+    赤経は観測夜の真夜中の恒星時の周り、赤緯はすばるから観測できる範囲に置きます。
+
+    Args:
+        fname (str): ターゲット表のファイル名 (.ecsv)。
+        n_pointings (int): ポインティング (表の行) の数。
+        dates (list): 観測夜の日付 (HST) のリスト。
+        observer: MyObserver オブジェクト
+        mix (dict): WG をキー、ポインティングの割合を値とする辞書。None の場合は WG_MIX。
+        seed (int): 乱数の種。
+
+    Returns:
+        Table: 書いたターゲット表。
+    """
+    rng = np.random.default_rng(seed)
+    mix = mix or WG_MIX
+    counts = {wg: int(round(frac * n_pointings / sum(mix.values()))) for wg, frac in mix.items()}
+    counts['CO'] = n_pointings - sum(n for wg, n in counts.items() if wg != 'CO')
+
+    # Local sidereal time at the midnight (HST) of the nights
+    midnights = Time(dates) + 1 * u.day - observer.utcoffset
+    lst = midnights.sidereal_time('mean', longitude=observer.longitude).deg
+
+    def position():
+        ra = np.mod(rng.choice(lst) + rng.normal(0.0, 30.0), 360.0)
+        dec = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(-15.0)), np.sin(np.radians(65.0)))))
+        return ra, dec
+
+    rows = []
+    n_co = counts.get('CO', 0)
+    strip = 0
+    while n_co > 0:
+        # Strips of up to 10 pointings 0.5 deg apart in RA
+        ra, dec = position()
+        priority = int(rng.choice([1, 2, 3], p=[0.3, 0.4, 0.3]))
+        for k in range(min(10, n_co)):
+            rows.append(('CO', f'CO_{strip:04d}_{k}', ra + 0.5 * k / np.cos(np.radians(dec)), dec, 90.0, 2, priority))
+        n_co -= min(10, n_co)
+        strip += 1
+    for k in range(counts.get('GE', 0) // 2 + counts.get('GE', 0) % 2):
+        ra, dec = position()
+        nexp = int(rng.choice([8, 16, 32]))
+        priority = int(rng.choice([1, 2]))
+        for suffix, pa in [('preMer', 0.0), ('postMer', 180.0)][:counts['GE'] - 2 * k]:
+            rows.append(('GE', f'GE_{k:04d}_{suffix}', ra, dec, pa, nexp, priority))
+    n_ga = counts.get('GA', 0)
+    field = 0
+    while n_ga > 0:
+        ra, dec = position()
+        priority = int(rng.choice([1, 2]))
+        members = min(int(rng.integers(4, 13)), n_ga)
+        for k in range(members):
+            rows.append(('GA', f'GA_{field:04d}_{k+1}', ra, dec, 180.0, 2, priority))
+        n_ga -= members
+        field += 1
+
+    wg, name, ra, dec, pa, nexp, priority = zip(*rows)
+    table = Table([wg, name,
+                   Angle(np.mod(np.array(ra), 360.0), u.deg).to_string(unit=u.hourangle, sep=':', precision=2, pad=True),
+                   Angle(np.array(dec), u.deg).to_string(unit=u.deg, sep=':', precision=1, pad=True, alwayssign=True),
+                   pa, nexp, priority],
+                  names=['wg', 'name', 'ra', 'dec', 'pa', 'nexp', 'priority'])
+    table.write(fname, format='ascii.ecsv', overwrite=True)
+    return table
+
+def case_params(fname_params, workdir, fname_obsdate, fname_targets, time_limit=None, memory_budget=None):
+    """
+    ベンチマークの 1 つのケースの Params を作ります。入力と出力のファイルは workdir に置きます。
+    """
+    params = Params(fname_params)
+    params.params['fname_obsdate'] = fname_obsdate
+    params.params['fname_obsdate_finish'] = None
+    params.params['fname_targets'] = fname_targets
+    params.params['fname_targets_finish'] = None
+    params.params['fname_report'] = os.path.join(workdir, 'benchmark.pdf')
+    if time_limit is not None:
+        params.params['solver_time_limit'] = time_limit
+    if memory_budget is not None:
+        params.params['memory_budget'] = memory_budget
+    return params
+
+def run_case(fname_params, n_nights, n_pointings, workdir, start='2025-05-26', run_length=5, seed=0,
+             max_variables=200000, time_limit=None, memory_budget=None):
+    """
+    合成した入力で 1 つのケースを実行し、段階ごとの時間を測ります。
+
+    モデルの変数の数 (スロット数 x ターゲット数の見積もり) が max_variables を超える場合は、
+    model・slew・report の段階を省略します。
+
+    Returns:
+        dict: ケースの大きさ、段階ごとの時間 (秒)、関数ごとの合計時間、solve の結果、最大常駐メモリの辞書。
+    """
+    observer = MyObserver.at_site('Subaru', timezone='US/Hawaii')
+    case = f'n{n_nights}_p{n_pointings}_s{seed}'
+    fname_obsdate = os.path.join(workdir, f'obsdates_{case}.txt')
+    fname_targets = os.path.join(workdir, f'targets_{case}.ecsv')
+    dates = generate_obsdates(fname_obsdate, n_nights, start, run_length)
+    generate_targets(fname_targets, n_pointings, dates, observer, seed=seed)
+    params = case_params(fname_params, workdir, fname_obsdate, fname_targets, time_limit, memory_budget)
+
+    profiler = Profiler(trace_memory=False)
+    Profiling.enable(profiler)
+    result = {'nights': n_nights, 'pointings': n_pointings, 'seed': seed, 'skipped': []}
+    try:
+        with span('obsdate', stage=True):
+            obsdate = ObsDate(fname_obsdate, None, observer=observer, params=params)
+        obsSlotList = obsdate.obsSlotList
+        with span('targets', stage=True):
+            targetList = TargetManager(fname_targets).targetList
+        result['slots'] = obsSlotList.num_slots
+        result['ga_fields'] = len(set(field_name(t) for t in targetList.get_all_targets() if t.wg == 'GA'))
+
+        with span('visibility', stage=True):
+            visibility = VisibilityWindows(obsSlotList, targetList, observer, params)
+        with span('conditions', stage=True):
+            oc = ObservingConditions(obsSlotList, targetList, observer, params, visibility, scratch_dir=workdir)
+
+        # First priority stage of the 1st stage of sspplan.py
+        priority = targetList.priorities[0]
+        targets = targetList.get_observing_targets_by_priority(priority)
+        n_slots = min(obsSlotList.num_slots, sum(t.nexp - t.observed for t in targets))
+        result['variables'] = n_slots * (len(targets) + 1)
+        if result['variables'] > max_variables:
+            logger.warning(f"Case {case}: skipping the model, {result['variables']} variables > {max_variables}")
+            result['skipped'] += ['model', 'slew', 'report']
+        else:
+            with span('model', stage=True):
+                o, obs_slots, targets, dummy = OptimizeSchedule(obsSlotList, targetList, oc, params, observer,
+                                                                obsdate.nexp_max, priority)
+            with span('slew', stage=True):
+                transitions = slew_transitions(obs_slots, targets, oc, params, observer, ROTANG_MIN, ROTANG_MAX)
+                obsSlotList.updateSchedule(o, obs_slots, targets, targetList)
+                obsSlotList.updateTimeBySlew(oc, params)
+            result['transitions'] = len(transitions)
+            with span('report', stage=True):
+                formatSchedule(scheduleFrame(obsSlotList, observer, oc, params, obsdate.dates_local), obsdate.dates_local)
+                texts, tables, tablestyles = createTableContents(obsSlotList, observer, oc, params)
+                write_text_and_table_to_pdf(texts, tables, tablestyles, params, images={})
+    finally:
+        Profiling.enable(None)
+
+    result['stages'] = {record['name']: record['duration'] for record in profiler.spans if record['stage']}
+    result['functions'] = {name: total['total'] for name, total in profiler.summary().items()}
+    result['solve'] = [record['args'] for record in profiler.spans if record['name'] == 'solve' and 'args' in record]
+    if 'model' in result['stages']:
+        # The model stage is the build of the MILP followed by the CBC solve
+        result['stages']['model_solve'] = result['functions'].get('solve', 0.0)
+        result['stages']['model_build'] = result['stages']['model'] - result['stages']['model_solve']
+    result['rss_peak_mb'] = peak_rss_mb()
+    return result
+
+def run_isolated(*args, **kwargs):
+    """
+    run_case を新しいプロセスで実行します (最大常駐メモリをケースごとに測り、前のケースのキャッシュを持ち込まないため)。
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_case, *args, **kwargs).result()
+
+def environment():
+    """
+    結果を比べるための実行環境 (Python とライブラリの版、CPU 数) を返します。
+    """
+    import astropy
+    import pulp
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'astropy': astropy.__version__,
+            'pulp': pulp.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+def log_results(results):
+    """
+    ケースごとの段階の時間を表にしてログに出します。
+    """
+    logger.info(f"{'nights':>6s} {'points':>6s} {'slots':>6s} " + ' '.join(f'{stage:>11s}' for stage in SUMMARY_COLUMNS)
+                + f" {'RSS (MB)':>9s}")
+    for result in results:
+        times = ' '.join(f"{result['stages'][stage]:11.2f}" if stage in result['stages'] else f"{'-':>11s}"
+                         for stage in SUMMARY_COLUMNS)
+        logger.info(f"{result['nights']:6d} {result['pointings']:6d} {result.get('slots', 0):6d} {times} "
+                    f"{result['rss_peak_mb'] or 0:9.0f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the stages of the planner on synthetic nights and targets")
+    parser.add_argument('--params', default='parameters_2025May.yaml',
+                        help='Parameter file of the planner settings (default: parameters_2025May.yaml)')
+    parser.add_argument('--nights', type=int, nargs='+', default=[5, 30, 180],
+                        help='Numbers of nights of the cases (default: 5 30 180)')
+    parser.add_argument('--pointings', type=int, nargs='+', default=[50, 500, 2000, 10000],
+                        help='Numbers of pointings of the cases (default: 50 500 2000 10000)')
+    parser.add_argument('--start', default='2025-05-26', help='First night (HST) of the synthetic runs')
+    parser.add_argument('--run-length', type=int, default=5,
+                        help='Nights per observing run, one run per lunation (default: 5)')
+    parser.add_argument('--seed', type=int, nargs='+', default=[0],
+                        help='Seeds of the synthetic targets, one case per seed (default: 0)')
+    parser.add_argument('--max-variables', type=int, default=200000,
+                        help='Skip the model, slew and report stages of the larger cases (default: 200000 variables)')
+    parser.add_argument('--time-limit', type=float, default=60,
+                        help='Time limit of the CBC solve in seconds (default: 60)')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='Memory budget of the observing conditions in MB (default: memory_budget of the parameter file)')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory of the synthetic inputs and the outputs (default: a temporary directory)')
+    parser.add_argument('--output', default='benchmark.json', help='Results in JSON (default: benchmark.json)')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run the cases in this process instead of a new process per case')
+    parser.add_argument('--log-level', default='ERROR',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the logging level of the planner (default: ERROR)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sspplan_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    run = run_case if args.in_process else run_isolated
+
+    results = []
+    for n_nights in args.nights:
+        for n_pointings in args.pointings:
+            for seed in args.seed:
+                logger.info(f"Case: {n_nights} nights, {n_pointings} pointings, seed {seed}")
+                results.append(run(args.params, n_nights, n_pointings, workdir, args.start, args.run_length, seed,
+                                   args.max_variables, args.time_limit, args.memory_budget))
+                # Written after each case so that an interrupted suite keeps the finished cases
+                with open(args.output, 'w') as f:
+                    json.dump({'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                               'params': args.params, 'environment': environment(), 'results': results}, f, indent=1)
+
+    log_results(results)
+    logger.info(f"Results of {len(results)} cases written to {args.output} (inputs in {workdir})")
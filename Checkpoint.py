@@ -0,0 +1,250 @@
+from Targets import Target, TargetList
+from Profiling import profiled
+import numpy as np
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Stages of sspplan.py in order. The last one (plots, reports and exports) only records its key
+STAGES = ['slots', 'conditions', 'stage1', 'stage2', 'output']
+
+# Optimization parameters, shared by the two stages of the optimization
+OPTIMIZATION_PARAMS = ['frac', 'frac_margin', 'GA_last', 'aggregate_GA', 'coarse_block', 'n_continuous',
+                       'airmass', 'meridian', 'moonsep', 'planetssep', 'weight_comp', 'weight_pri', 'weight_slew',
+                       'slew_speed_az', 'slew_speed_el', 'inst_rot_speed', 'solver_time_limit']
+
+# Inputs of each stage: the Params keys (None: all of them) and the input files (Params keys of their names)
+# it reads, the stages it is computed from, and the output files (Params keys) that must exist.
+# The visibility windows and the slew times are cheap and recomputed by the stages that use them,
+# so their parameters are inputs of those stages and not of the condition grids.
+DEPENDENCIES = {
+    'slots': {'params': ['angle_twilight'], 'files': ['fname_obsdate'], 'stages': []},
+    'conditions': {'params': ['w_timeslot', 't_overhead', 'ephemeris_step', 'ephemeris_tolerance'],
+                   'files': ['fname_targets'], 'stages': ['slots']},
+    'stage1': {'params': OPTIMIZATION_PARAMS, 'files': ['fname_obsdate_finish', 'fname_targets_finish'],
+               'stages': ['conditions']},
+    'stage2': {'params': OPTIMIZATION_PARAMS, 'files': [], 'stages': ['stage1']},
+    'output': {'params': None, 'files': [], 'stages': ['stage2'],
+               'outputs': ['fname_schedule', 'fname_conditions', 'fname_cache']},
+}
+
+# Version of the layout of the checkpoints, part of their keys
+CHECKPOINT_VERSION = 2
+
+def file_digest(fname):
+    """
+    ファイルの内容の SHA256 を返します。ファイル名が None か、ファイルがない場合は None。
+    """
+    if not fname or not os.path.exists(fname):
+        return None
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class CheckpointStore:
+    """
+    Checkpoints of the stages of sspplan.py, stored as compressed .npz files of plain arrays.
+
+    The slots checkpoint holds the night boundaries, the conditions checkpoint the
+    ObservingConditions arrays, and the optimization stages the slot assignments and the
+    observed counts, so that no astropy object is pickled.
+
+    Each stage declares in DEPENDENCIES the Params keys and the input files it reads and the
+    stages it is computed from. Its key hashes the values of those parameters, the contents of
+    those files, the options of the stage and the keys of those stages, so that a change only
+    invalidates the stages that depend on it: editing an objective weight keeps the slots and
+    the condition grids, and the run goes straight to the solver.
+    With directory=None nothing is saved or restored.
+    """
+
+    def __init__(self, directory, params, options=None):
+        """
+        Args:
+            directory (str): チェックポイントのディレクトリ。None の場合は保存も復元もしません。
+            params: Params オブジェクト
+            options (dict): 段階名をキー、結果に影響するコマンドラインのオプションの辞書を値とする辞書。
+        """
+        self.directory = directory
+        self.params = params
+        self.options = options or {}
+        self._digests = {}
+        self._keys = {}
+
+    def _digest(self, fname):
+        if fname not in self._digests:
+            self._digests[fname] = file_digest(fname)
+        return self._digests[fname]
+
+    def inputs(self, stage):
+        """
+        段階 stage の入力 (パラメータの値、ファイルの内容のハッシュ、オプション、元の段階のキー) を返します。
+
+        Returns:
+            dict: 入力の名前をキーとする、JSON に変換できる辞書。
+        """
+        dependencies = DEPENDENCIES[stage]
+        names = dependencies['params'] if dependencies['params'] is not None else sorted(self.params.params)
+        inputs = {'version': CHECKPOINT_VERSION}
+        inputs.update({f'params.{name}': self.params[name] for name in names})
+        for name in dependencies['files']:
+            fname = getattr(self.params, name)
+            inputs[f'file.{name}'] = [fname, self._digest(fname)]
+        inputs.update({f'option.{name}': value for name, value in self.options.get(stage, {}).items()})
+        inputs.update({f'stage.{name}': self.key(name) for name in dependencies['stages']})
+        return inputs
+
+    def key(self, stage):
+        """
+        段階 stage のキー (入力のハッシュ) を返します。
+        """
+        if stage not in self._keys:
+            inputs = json.dumps(self.inputs(stage), sort_keys=True, default=str)
+            self._keys[stage] = hashlib.sha256(f'{stage}|{inputs}'.encode()).hexdigest()
+        return self._keys[stage]
+
+    def path(self, stage):
+        return os.path.join(self.directory, f'{stage}.npz')
+
+    def valid(self, stage):
+        """
+        段階 stage のチェックポイントがあり、キーが一致するかを返します。
+        """
+        if self.directory is None or not os.path.exists(self.path(stage)):
+            return False
+        missing = [name for name in DEPENDENCIES[stage].get('outputs', [])
+                   if not os.path.exists(getattr(self.params, name))]
+        if missing:
+            logger.info(f"Stage {stage} is out of date: {', '.join(missing)} missing")
+            return False
+        with np.load(self.path(stage)) as data:
+            if 'key' in data.files and str(data['key']) == self.key(stage):
+                return True
+            saved = json.loads(str(data['inputs'])) if 'inputs' in data.files else {}
+        current = json.loads(json.dumps(self.inputs(stage), default=str))
+        changed = sorted(name for name in set(saved) | set(current) if saved.get(name) != current.get(name))
+        logger.info(f"Stage {stage} is out of date: {', '.join(changed)} changed")
+        return False
+
+    def first_stage(self, from_stage=None):
+        """
+        計算を始める段階の番号を返します。それより前の段階はチェックポイントから復元できます。
+
+        Args:
+            from_stage (str): 計算し直す最初の段階。None の場合は有効なチェックポイントを全て使います。
+
+        Returns:
+            int: STAGES の中の番号。全ての段階が有効な場合は len(STAGES)。
+        """
+        first = STAGES.index(from_stage) if from_stage is not None else len(STAGES)
+        for k in range(first):
+            if not self.valid(STAGES[k]):
+                if from_stage is not None:
+                    logger.warning(f"No valid checkpoint of stage {STAGES[k]}: starting from it instead of {from_stage}")
+                return k
+        return first
+
+    @profiled()
+    def save(self, stage, **arrays):
+        """
+        段階 stage の結果の配列をキーと一緒に保存します。
+        """
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Written under a temporary name so that an interrupted save never leaves a valid-looking checkpoint
+        fname = self.path(stage)
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez_compressed(f, key=np.array(self.key(stage)),
+                                inputs=np.array(json.dumps(self.inputs(stage), sort_keys=True, default=str)), **arrays)
+        os.replace(fname + '.tmp', fname)
+        logger.info(f"Checkpoint of stage {stage} saved to {fname}")
+
+    @profiled()
+    def load(self, stage):
+        """
+        段階 stage のチェックポイントを読み込みます。
+
+        Returns:
+            dict: 保存した配列の辞書。
+
+        Raises:
+            ValueError: チェックポイントがないか、キーが一致しない場合。
+        """
+        if not self.valid(stage):
+            raise ValueError(f"No valid checkpoint of stage {stage} in {self.directory}")
+        with np.load(self.path(stage)) as data:
+            arrays = {name: data[name] for name in data.files if name not in ('key', 'inputs')}
+        logger.info(f"Stage {stage} restored from {self.path(stage)}")
+        return arrays
+
+def time_array(times):
+    """
+    Time 配列を、精度を落とさずに保存できる (2, n) の配列 (jd1, jd2) にします。
+    """
+    return np.stack([times.jd1, times.jd2])
+
+def assignment_arrays(obsSlotList):
+    """
+    スロットに割り当てたターゲットを配列にします (ターゲットがないスロットは空文字列)。
+    """
+    slots = obsSlotList.get_all_slots()
+    return {'slot_index': np.array([slot.index for slot in slots], dtype=int),
+            'slot_target': np.array([slot.target.name if slot.target is not None else '' for slot in slots], dtype=str)}
+
+def restore_assignments(obsSlotList, arrays, targets, targetList=None):
+    """
+    assignment_arrays で保存した割り当てを、初期状態の ObsSlotList に戻します。
+
+    Args:
+        obsSlotList: 保存した時と同じスロットを持つ初期状態の ObsSlotList オブジェクト
+        arrays (dict): assignment_arrays の配列。
+        targets (dict): ターゲット名をキー、スロットに割り当てる Target を値とする辞書。
+        targetList: 割り当てごとに観測数を 1 増やす TargetList オブジェクト (updateSchedule と同じ)。
+            None の場合は観測数を変えません。
+
+    Raises:
+        ValueError: スロットやターゲットが一致しない場合。
+    """
+    if list(arrays['slot_index']) != [slot.index for slot in obsSlotList.get_all_slots()]:
+        raise ValueError("The saved slot assignments do not match the observation slots")
+    for slot, name in zip(obsSlotList.get_all_slots(), arrays['slot_target']):
+        if not name:
+            continue
+        if name not in targets:
+            raise ValueError(f"Target {name} of the saved slot {slot.index} is not in the target list")
+        slot.target = targets[name]
+        obsSlotList.updateUsed(slot.index)
+        if targetList is not None:
+            targetList.update_observed(name, 1)
+
+def target_arrays(targetList):
+    """
+    ターゲットの露出数・priority・観測数を配列にします。
+    """
+    targets = targetList.get_all_targets()
+    return {'target_name': np.array([t.name for t in targets], dtype=str),
+            'target_nexp': np.array([t.nexp for t in targets], dtype=int),
+            'target_priority': np.array([t.priority for t in targets], dtype=int),
+            'target_observed': np.array([t.observed for t in targets], dtype=int)}
+
+def restore_targets(arrays, targetList):
+    """
+    target_arrays で保存したターゲットの TargetList を作ります。WG・座標・PA は targetList から取ります。
+
+    Returns:
+        TargetList: 保存した順序・露出数・priority・観測数を持つ TargetList。
+    """
+    base = {t.name: t for t in targetList.get_all_targets()}
+    restored = TargetList()
+    for name, nexp, priority, observed in zip(arrays['target_name'], arrays['target_nexp'],
+                                              arrays['target_priority'], arrays['target_observed']):
+        if name not in base:
+            raise ValueError(f"Saved target {name} is not in the target list")
+        t = base[name]
+        restored.add_target(Target(t.wg, str(name), t.coord, t.pa, int(nexp), int(priority), int(observed)))
+    return restored
@@ -0,0 +1,217 @@
+from Params import Params
+from Targets import TargetManager
+from Sequence import SequenceEvaluator, resequence, split_blocks, block_key
+from Export import load_cache
+from astropy.time import Time
+from astropy.coordinates import AltAz
+from collections import Counter
+import astropy.units as u
+import numpy as np
+import logging
+import argparse
+import time
+
+logger = logging.getLogger(__name__)
+
+class Recommendation:
+    """
+    Result of a dispatch: the next targets ranked by the score of the remainder of the night
+    starting with them, and the re-sequenced remainder of the night.
+    """
+
+    def __init__(self, now, ranked, sequence, starts, score, elapsed):
+        self.now = now
+        self.ranked = ranked
+        self.sequence = sequence
+        self.starts = starts
+        self.score = score
+        self.elapsed = elapsed
+
+    @property
+    def next_target(self):
+        return self.sequence[0] if self.sequence else None
+
+    def log(self):
+        logger.info(f"Dispatch at {self.now.iso} UTC ({self.elapsed*1e3:.1f} ms): "
+                    f"{len(self.sequence)} exposures left, violations {self.score[0]}, slew {self.score[1]:.1f} min")
+        for rank, (target, score) in enumerate(self.ranked, 1):
+            logger.info(f"  {rank}. {target.name:21s} ({target.wg}, priority {target.priority}): "
+                        f"violations {score[0]}, slew {score[1]:.1f} min")
+        for start, target in zip(self.starts, self.sequence):
+            logger.info(f"  {start.iso[11:16]} {target.name}")
+
+class Dispatcher:
+    """
+    Next-target recommendations during a night, by a fast local re-optimization of the plan.
+
+    The exposures left in the night are taken from the plan, corrected for the exposures actually
+    completed (repeated exposures consume the later planned ones, exposures delayed by an overrun
+    stay in the queue), truncated or filled to the time left in the night, and re-sequenced from
+    the current telescope position with a SequenceEvaluator on the ObservingConditions grids.
+    No MILP is built, so a dispatch takes a few tens of milliseconds.
+
+    The planned exposures of the nights before the current one are counted as observed:
+    use a plan from replan.py when the past nights were not observed as planned.
+    """
+
+    def __init__(self, obsSlotList, targetList, oc, params, observer, max_passes=3):
+        """
+        Args:
+            obsSlotList: 計画 (ターゲットが割り当てられた ObsSlotList)
+            targetList: 計画前の観測数を持つ TargetList オブジェクト
+            oc: 計画前のスロット時刻で計算した ObservingConditions オブジェクト
+            params: Params オブジェクト
+            observer: MyObserver オブジェクト
+            max_passes (int): 2-opt の最大反復回数。
+        """
+        self.obsSlotList = obsSlotList
+        self.targetList = targetList
+        self.oc = oc
+        self.params = params
+        self.observer = observer
+        self.max_passes = max_passes
+
+        names = set(oc.targetList.names)
+        self._targets = {t.name: t for t in targetList.get_all_targets() if t.name in names}
+        self._nights = {date: obsSlotList.get_slots_by_date(date) for date in obsSlotList.dates}
+
+    def remaining_exposures(self, date, completed):
+        """
+        夜 date の開始時点の計画に対して、completed の露出を終えた後の各ターゲットの残りの露出数を返します。
+        """
+        remaining = {name: t.nexp - t.observed for name, t in self._targets.items()}
+        for night in self.obsSlotList.dates[:self.obsSlotList.dates.index(date)]:
+            for slot in self._nights[night]:
+                if slot.target is not None and slot.target.name in remaining:
+                    remaining[slot.target.name] -= 1
+        for name, n in completed.items():
+            if name in remaining:
+                remaining[name] -= n
+        return remaining
+
+    def dispatch(self, now, altaz=None, rotang=None, completed=None, n_ranked=5):
+        """
+        現在時刻と望遠鏡の状態から、次に観測するターゲットの候補と夜の残りの順序を返します。
+
+        Args:
+            now (Time): 現在時刻 (次の露出の開始時刻)。
+            altaz: 望遠鏡の現在の方向 (az, alt を持つ AltAz など)。None の場合は最初のスリューを数えません。
+            rotang (Angle): 現在のローテーター角。
+            completed (list): この夜に終えた露出のターゲット名のリスト (1 露出ごとに 1 要素)。
+            n_ranked (int): 返す候補の数。
+
+        Returns:
+            Recommendation: 候補と夜の残りの順序。
+
+        Raises:
+            ValueError: now が観測夜の中にない場合。
+        """
+        t0 = time.perf_counter()
+        params = self.params
+        w_timeslot = params.w_timeslot
+        midpt = params.t_overhead + 0.5 * (w_timeslot - params.t_overhead)
+
+        # Night of the current time and number of exposures left in it
+        islot, offset = self.oc.locate(now + midpt)
+        date = self.obsSlotList[self.obsSlotList.get_index(int(islot[0]))].date
+        night_end = self.oc.slot_mid(self._nights[date][-1].index)[0] + (w_timeslot - midpt)
+        n_left = int(np.floor(((night_end - now) / w_timeslot).to_value(u.dimensionless_unscaled)))
+        if n_left <= 0 or offset[0] < -w_timeslot:
+            raise ValueError(f"{now.iso} UTC is not in an observing night")
+
+        # Queue of the planned exposures not completed yet
+        completed = Counter(completed or [])
+        remaining = self.remaining_exposures(date, completed)
+        consumed = Counter(completed)
+        queue = []
+        for slot in self._nights[date]:
+            if slot.target is None or slot.target.name not in self._targets:
+                continue
+            name = slot.target.name
+            if consumed[name] > 0:
+                consumed[name] -= 1
+            elif remaining[name] > 0:
+                queue.append(self._targets[name])
+                remaining[name] -= 1
+
+        # Keep the exposures of the best priorities when the queue overruns the night
+        if len(queue) > n_left:
+            kept = sorted(sorted(range(len(queue)), key=lambda k: (queue[k].priority, k))[:n_left])
+            queue = [queue[k] for k in kept]
+
+        # Positions of the exposures left, on the grids of the nearest slots
+        starts = now + np.arange(n_left) * w_timeslot
+        islots, offsets = self.oc.locate(starts + midpt)
+        candidates = [t for name, t in self._targets.items() if remaining[name] > 0]
+        if not queue and not candidates:
+            return Recommendation(now, [], [], starts[:0], (0, 0.0), time.perf_counter() - t0)
+        start = None
+        if altaz is not None:
+            start = (altaz.az.to(u.deg).value, altaz.alt.to(u.deg).value, rotang.to(u.deg).value)
+        evaluate = SequenceEvaluator(islots, queue + candidates, self.oc, params, self.observer, offsets, start)
+
+        # Fill the positions freed by the exposures done ahead of the plan
+        if len(queue) < n_left and candidates:
+            n_feasible = evaluate.feasible(candidates).sum(axis=0)
+            for k in sorted(range(len(candidates)), key=lambda k: (candidates[k].priority, -n_feasible[k])):
+                n = min(remaining[candidates[k].name], n_feasible[k], n_left - len(queue))
+                queue += [candidates[k]] * n
+                if len(queue) == n_left:
+                    break
+
+        sequence, score = resequence(queue, evaluate, params, self.max_passes)
+
+        # Rank the next targets by moving each block of the sequence to the front
+        blocks = split_blocks(sequence, block_key)
+        if params.GA_last and any(block[0].wg != 'GA' for block in blocks):
+            heads = [k for k, block in enumerate(blocks) if block[0].wg != 'GA']
+        else:
+            heads = list(range(len(blocks)))
+        ranked = {}
+        for k in heads:
+            order = [t for block in [blocks[k]] + blocks[:k] + blocks[k+1:] for t in block]
+            order_score = evaluate(order)
+            if order[0].name not in ranked or order_score < ranked[order[0].name][2]:
+                ranked[order[0].name] = (order[0], order, order_score)
+        ranked = sorted(ranked.values(), key=lambda r: r[2])
+        if ranked and ranked[0][2] < score:
+            sequence, score = ranked[0][1], ranked[0][2]
+
+        return Recommendation(now, [(t, s) for t, _, s in ranked[:n_ranked]], sequence,
+                              starts[:len(sequence)], score, time.perf_counter() - t0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recommend the next target during a night from the cached plan")
+    parser.add_argument('--params', default='parameters_2025May.yaml',
+                        help='Parameter file (default: parameters_2025May.yaml)')
+    parser.add_argument('--cache', default=None,
+                        help='Cache written by sspplan.py or replan.py (default: fname_cache of the parameter file)')
+    parser.add_argument('--time', default=None,
+                        help='Current time in UTC, e.g. "2025-05-27 08:30" (default: now)')
+    parser.add_argument('--az', type=float, default=None, help='Current azimuth of the telescope (deg)')
+    parser.add_argument('--alt', type=float, default=None, help='Current altitude of the telescope (deg)')
+    parser.add_argument('--rotang', type=float, default=None, help='Current rotator angle (deg)')
+    parser.add_argument('--completed', nargs='+', default=[],
+                        help='Targets of the exposures completed in the night (one name per exposure)')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the logging level for the application (default: INFO)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    params = Params(args.params)
+    cache = load_cache(args.cache or params.fname_cache)
+    targetList = TargetManager(params.fname_targets, params.fname_targets_finish).targetList
+    dispatcher = Dispatcher(cache['obsSlotList'], targetList, cache['observingConditions'], params, cache['observer'])
+
+    altaz = None
+    rotang = None
+    if args.az is not None and args.alt is not None and args.rotang is not None:
+        altaz = AltAz(az=args.az * u.deg, alt=args.alt * u.deg)
+        rotang = args.rotang * u.deg
+    now = Time(args.time, scale='utc') if args.time else Time.now()
+
+    dispatcher.dispatch(now, altaz, rotang, args.completed).log()
@@ -0,0 +1,177 @@
+from astropy.time import Time
+import astropy.units as u
+from astropy.coordinates import SkyCoord, GCRS, AltAz, get_body
+from astroplan import moon_illumination
+import numpy as np
+
+# Configure logging
+import logging
+logger = logging.getLogger(__name__)
+
+# Default sampling interval of the ephemerides
+DEFAULT_STEPS = {
+    'moon': 1 * u.hour,
+    'sun': 24 * u.hour,
+    'mars': 24 * u.hour,
+    'jupiter': 24 * u.hour,
+    'saturn': 24 * u.hour,
+}
+
+# Default tolerance of the interpolated positions
+DEFAULT_TOLERANCE = 0.02 * u.deg
+
+# Default tolerance of the interpolated moon illumination
+DEFAULT_ILLUMINATION_TOLERANCE = 0.002
+
+# Maximum number of times the sampling interval is halved to meet the tolerance
+MAX_REFINE = 6
+
+def interpolate_hour_angle(h0, h1, frac):
+    """
+    時角 (rad) を 2π の折り返しを考慮して線形補間します。
+    """
+    return h0 + frac * (np.mod(h1 - h0 + np.pi, 2 * np.pi) - np.pi)
+
+class EphemerisProvider:
+    """
+    Moon, Sun and planet positions sampled on a coarse time grid and interpolated to arbitrary times.
+
+    Only the grid points bracketing the requested times are evaluated, so the cost scales with
+    the number of nights rather than with the number of slots. The interpolated positions are
+    checked against exact ephemerides at a few times; the sampling interval is halved until the
+    error is within the tolerance.
+    """
+
+    def __init__(self, observer, steps=None, tolerance=None, illumination_tolerance=None, n_check=8):
+        self.observer = observer
+        self.steps = dict(DEFAULT_STEPS)
+        if steps is not None:
+            self.steps.update(steps)
+        self.tolerance = tolerance if tolerance is not None else DEFAULT_TOLERANCE
+        self.illumination_tolerance = illumination_tolerance if illumination_tolerance is not None \
+            else DEFAULT_ILLUMINATION_TOLERANCE
+        self.n_check = n_check
+
+    def _grid(self, jd, step):
+        """
+        時刻 jd を挟むグリッド点と、各時刻の補間位置を返します。
+
+        Returns:
+            tuple: グリッド点の時刻 (JD)、左側のグリッド点のインデックス、補間係数。
+        """
+        jd0 = np.floor(jd.min())
+        x = (jd - jd0) / step
+        k = np.floor(x)
+        knots = np.unique(np.concatenate([k, k + 1]))
+        left = np.searchsorted(knots, k)
+        return jd0 + knots * step, left, x - k
+
+    def _check_times(self, jd, step):
+        """
+        補間誤差の確認に使う時刻 (グリッド点の中間に最も近い時刻) を選びます。
+        """
+        frac = np.mod(jd - np.floor(jd.min()), step) / step
+        return np.sort(jd[np.argsort(np.abs(frac - 0.5))[:self.n_check]])
+
+    def _refine(self, name, jd, interpolate, exact, error, tolerance):
+        """
+        許容誤差に入るまでサンプリング間隔を半分にしながら補間します。
+        """
+        step = self.steps.get(name)
+        if step is None or step <= 0 or len(jd) == 0:
+            return exact(jd)
+        step = step.to(u.day).value
+        for _ in range(MAX_REFINE + 1):
+            jd_check = self._check_times(jd, step)
+            err = error(interpolate(jd_check, step), exact(jd_check))
+            if err <= tolerance:
+                logger.debug(f"Ephemeris {name}: step {step*24:.3f} h, max error {err:.3g}")
+                return interpolate(jd, step)
+            logger.debug(f"Ephemeris {name}: step {step*24:.3f} h, error {err:.3g} exceeds the tolerance {tolerance}")
+            step /= 2
+        logger.warning(f"Ephemeris {name}: tolerance {tolerance} not reached by interpolation, using exact positions")
+        return exact(jd)
+
+    def _exact_body(self, name):
+        def exact(jd):
+            body = get_body(name, Time(jd, format='jd'), self.observer.location)
+            return SkyCoord(ra=body.ra, dec=body.dec, frame=GCRS(obstime=Time(jd, format='jd')))
+        return exact
+
+    def _interpolate_body(self, name):
+        def interpolate(jd, step):
+            knots, left, frac = self._grid(jd, step)
+            body = get_body(name, Time(knots, format='jd'), self.observer.location)
+            xyz = body.represent_as('unitspherical').to_cartesian().xyz.value
+            xyz = xyz[:, left] + (xyz[:, left + 1] - xyz[:, left]) * frac
+            return SkyCoord(ra=np.arctan2(xyz[1], xyz[0]) * u.rad,
+                            dec=np.arctan2(xyz[2], np.hypot(xyz[0], xyz[1])) * u.rad,
+                            frame=GCRS(obstime=Time(jd, format='jd')))
+        return interpolate
+
+    def body(self, name, times):
+        """
+        天体の方向 (GCRS) を返します。
+        位置は観測地点から見た方向のみで、距離は持ちません (他の座標系へ変換しても視差が二重にかかりません)。
+
+        Args:
+            name (str): 天体名 ('moon', 'sun', 'mars', 'jupiter', 'saturn')。
+            times (Time): 時刻の配列。
+
+        Returns:
+            SkyCoord: 各時刻の天体の位置。
+        """
+        return self._refine(name, times.jd, self._interpolate_body(name), self._exact_body(name),
+                            lambda a, b: a.separation(b).max(), self.tolerance)
+
+    def _exact_moon_altaz(self, jd):
+        times = Time(jd, format='jd')
+        return get_body('moon', times, self.observer.location).transform_to(AltAz(obstime=times, location=self.observer.location))
+
+    def _interpolate_moon_altaz(self, jd, step):
+        # Interpolate the hour angle and the declination, which change smoothly during the night
+        knots, left, frac = self._grid(jd, step)
+        altaz = self._exact_moon_altaz(knots)
+        lat = self.observer.location.lat.rad
+        alt, az = altaz.alt.rad, altaz.az.rad
+        dec = np.arcsin(np.sin(lat) * np.sin(alt) + np.cos(lat) * np.cos(alt) * np.cos(az))
+        ha = np.arctan2(-np.sin(az) * np.cos(alt), np.cos(lat) * np.sin(alt) - np.sin(lat) * np.cos(alt) * np.cos(az))
+
+        ha = interpolate_hour_angle(ha[left], ha[left + 1], frac)
+        dec = dec[left] + (dec[left + 1] - dec[left]) * frac
+        alt = np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(ha))
+        az = np.arctan2(-np.cos(dec) * np.sin(ha), np.cos(lat) * np.sin(dec) - np.sin(lat) * np.cos(dec) * np.cos(ha))
+        return SkyCoord(az=az * u.rad, alt=alt * u.rad,
+                        frame=AltAz(obstime=Time(jd, format='jd'), location=self.observer.location))
+
+    def moon_altaz(self, times):
+        """
+        月の高度・方位角を返します。
+
+        Args:
+            times (Time): 時刻の配列。
+
+        Returns:
+            SkyCoord: AltAz 座標系での月の位置。
+        """
+        return self._refine('moon', times.jd, self._interpolate_moon_altaz, self._exact_moon_altaz,
+                            lambda a, b: a.separation(b).max(), self.tolerance)
+
+    def _interpolate_moon_illumination(self, jd, step):
+        knots, left, frac = self._grid(jd, step)
+        k = moon_illumination(Time(knots, format='jd'))
+        return k[left] + (k[left + 1] - k[left]) * frac
+
+    def moon_illumination(self, times):
+        """
+        月の輝面比を返します。
+
+        Args:
+            times (Time): 時刻の配列。
+
+        Returns:
+            ndarray: 各時刻の輝面比。
+        """
+        return self._refine('moon', times.jd, self._interpolate_moon_illumination,
+                            lambda jd: moon_illumination(Time(jd, format='jd')),
+                            lambda a, b: np.abs(a - b).max(), self.illumination_tolerance)
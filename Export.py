@@ -0,0 +1,198 @@
+from Report import scheduleFrame
+from Profiling import profiled
+from astropy.table import Table, vstack
+from astropy.time import Time
+import astropy.units as u
+import numpy as np
+import datetime
+import json
+import pickle
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Table formats by file extension
+FORMATS = {'.ecsv': 'ascii.ecsv', '.parquet': 'parquet', '.json': 'json'}
+
+# Units of the condition columns of the schedule
+UNITS = {'ra': u.deg, 'dec': u.deg, 'pa': u.deg, 'ha': u.hourangle, 'rotang_start': u.deg, 'rotang_end': u.deg,
+         'moon_sep': u.deg, 'moon_alt': u.deg, 'mars_sep': u.deg, 'jupiter_sep': u.deg, 'saturn_sep': u.deg}
+
+def table_format(fname, format=None):
+    """
+    ファイル名の拡張子から表の形式を返します。
+    """
+    if format is not None:
+        return format
+    ext = os.path.splitext(fname)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown schedule format for {fname}: use one of {list(FORMATS)}")
+    return FORMATS[ext]
+
+def scheduleTable(obsSlotList, observer, oc, params):
+    """
+    観測計画を、スロットごとの時刻・ターゲット・観測条件・分類コードの 1 つの表にまとめます。
+
+    Args:
+        obsSlotList: ObsSlotList オブジェクト
+        observer: MyObserver オブジェクト
+        oc: ObservingConditions オブジェクト
+        params: Params オブジェクト
+
+    Returns:
+        Table: ターゲットが割り当てられたスロットの表。時刻は UTC の ISO 形式、time は HST の観測開始時刻です。
+    """
+    frames = [frame for frame in scheduleFrame(obsSlotList, observer, oc, params).values() if len(frame)]
+    table = vstack(frames) if frames else Table(names=['index', 'date', 'name'], dtype=[int, str, str])
+
+    slots = {slot.index: slot for slot in obsSlotList}
+    rows = [slots[i] for i in table['index']]
+    for name in ['start', 'end', 'obs_start', 'obs_end']:
+        times = Time(np.array([getattr(slot, name).jd for slot in rows]), format='jd', scale='utc')
+        table[name] = np.array(times.isot if len(rows) else [], dtype=str)
+    table['date_utc'] = np.array([slot.date_utc for slot in rows], dtype=str)
+    table['priority'] = np.array([slot.target.priority for slot in rows], dtype=int)
+    table['ra'] = np.array([slot.target.coord.ra.deg for slot in rows])
+    table['dec'] = np.array([slot.target.coord.dec.deg for slot in rows])
+    table['pa'] = np.array([slot.target.pa.to(u.deg).value for slot in rows])
+    for name, unit in UNITS.items():
+        if name in table.colnames:
+            table[name].unit = unit
+
+    table.meta['site'] = observer.name
+    table.meta['utcoffset_hour'] = float(observer.utcoffset.to(u.hour).value)
+    table.meta['w_timeslot_min'] = float(params.w_timeslot.to(u.minute).value)
+    table.meta['t_overhead_min'] = float(params.t_overhead.to(u.minute).value)
+    table.meta['fname_obsdate'] = params.fname_obsdate
+    table.meta['fname_targets'] = params.fname_targets
+    table.meta['created'] = datetime.datetime.now().isoformat(timespec='seconds')
+    return table
+
+@profiled()
+def exportSchedule(fname, obsSlotList, observer, oc, params, format=None):
+    """
+    観測計画を ECSV・Parquet・JSON のいずれかで保存します (形式は拡張子から決めます)。
+
+    Args:
+        fname (str): ファイル名 (.ecsv, .parquet, .json)。
+        format (str): 表の形式。None の場合は拡張子から決めます。
+
+    Returns:
+        Table: 保存した表。
+    """
+    table = scheduleTable(obsSlotList, observer, oc, params)
+    format = table_format(fname, format)
+    if format == 'json':
+        # Records of the slots, with the units and the metadata
+        meta = dict(table.meta)
+        meta['units'] = {name: str(table[name].unit) for name in table.colnames if table[name].unit is not None}
+        records = [{name: row[name].item() for name in table.colnames} for row in table]
+        with open(fname, 'w') as f:
+            json.dump({'meta': meta, 'slots': records}, f, indent=1)
+    else:
+        # Parquet needs pyarrow
+        table.write(fname, format=format, overwrite=True)
+    logger.info(f"Schedule of {len(table)} slots exported to {fname}")
+    return table
+
+def loadSchedule(fname, format=None):
+    """
+    exportSchedule で保存した観測計画を読み込みます。
+
+    Returns:
+        Table: スロットごとの表。
+    """
+    format = table_format(fname, format)
+    if format != 'json':
+        return Table.read(fname, format=format)
+    with open(fname) as f:
+        data = json.load(f)
+    meta = data['meta']
+    units = meta.pop('units', {})
+    table = Table(rows=data['slots'], meta=meta) if data['slots'] else Table(meta=meta)
+    for name, unit in units.items():
+        table[name].unit = unit
+    return table
+
+@profiled()
+def exportConditions(fname, oc):
+    """
+    ObservingConditions のグリッドとスロットごとの量を .npz で保存します。
+    """
+    np.savez_compressed(fname, **oc.arrays())
+    logger.info(f"Observing conditions exported to {fname}")
+
+class ConditionGrids:
+    """
+    Observing conditions loaded from the .npz written by exportConditions.
+
+    The arrays are available as attributes (grid_<name>, visible, slot_mid_jd, moon_ill, ...);
+    values() looks up the grids by slot index and target name like ObservingConditions.values().
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self._slot_indices = {int(i): k for k, i in enumerate(self.slot_index)}
+        self._target_pointings = dict(zip(self.target_names, self.target_pointings))
+        self._target_rows = dict(zip(self.target_names, self.target_rows))
+
+    def values(self, name, slots, tnames):
+        """
+        グリッド name の値を (スロット, ターゲット) の配列で返します。引数はブロードキャストされます。
+        """
+        slots, tnames = np.broadcast_arrays(np.asarray(slots), np.asarray(tnames, dtype=object))
+        cols = np.array([self._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows = np.array([self._target_pointings[t] for t in tnames.ravel()], dtype=int)
+        return self.arrays[f'grid_{name}'][rows, cols].reshape(slots.shape)
+
+    def visible_mask(self, slots, tnames):
+        """
+        (スロット, ターゲット) が観測可能な時間帯に入るかを配列で返します。引数はブロードキャストされます。
+        """
+        slots, tnames = np.broadcast_arrays(np.asarray(slots), np.asarray(tnames, dtype=object))
+        cols = np.array([self._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows = np.array([self._target_rows[t] for t in tnames.ravel()], dtype=int)
+        return self.visible[rows, cols].reshape(slots.shape)
+
+def loadConditions(fname):
+    """
+    exportConditions で保存した観測条件を読み込みます。
+
+    Returns:
+        ConditionGrids: 配列と参照用のメソッドを持つオブジェクト。
+    """
+    with np.load(fname) as data:
+        return ConditionGrids({name: data[name] for name in data.files})
+
+@profiled()
+def save_cache(fname, obsdate, observer, visibility, oc, obsSlotList, done=(), lost=()):
+    """
+    再計画に必要な観測夜・観測条件・計画をファイルに保存します。
+
+    Args:
+        fname (str): キャッシュファイル名。
+        obsdate: ObsDate オブジェクト
+        observer: MyObserver オブジェクト
+        visibility: VisibilityWindows オブジェクト
+        oc: 計画前のスロット時刻で計算した ObservingConditions オブジェクト
+        obsSlotList: 計画 (ターゲットが割り当てられた ObsSlotList)
+        done (list): 再計画で計画どおりに観測されたとした夜。次の再計画でも割り当てを固定します。
+        lost (list): 再計画で観測できなかったとした夜。次の再計画でも使いません。
+    """
+    cache = {'obsdate': obsdate, 'observer': observer, 'visibility': visibility,
+             'observingConditions': oc, 'obsSlotList': obsSlotList, 'done': list(done), 'lost': list(lost)}
+    with open(fname, 'wb') as f:
+        pickle.dump(cache, f)
+    logger.info(f"Cache saved to {fname}")
+
+def load_cache(fname):
+    """
+    save_cache で保存したキャッシュを読み込みます。
+    """
+    with open(fname, 'rb') as f:
+        cache = pickle.load(f)
+    logger.info(f"Cache loaded from {fname}")
+    return cache
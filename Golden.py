@@ -0,0 +1,284 @@
+from Params import Params
+from MyObserver import MyObserver
+from Targets import TargetManager
+from Artifacts import ArtifactQueue
+from Checkpoint import STAGES, CheckpointStore
+from Export import loadSchedule, loadConditions
+from Report import WARN, LIMIT
+from Benchmark import environment
+from Profiling import Profiler
+from sspplan import run_pipeline
+import Profiling
+from pulp import LpSolution, LpSolutionOptimal
+from collections import Counter
+import contextlib
+import datetime
+import tempfile
+import argparse
+import json
+import io
+import os
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Frozen inputs of the regression cases: parameter file and the keys overridden in it
+GOLDEN_CASES = {
+    # Bundled May 2025 run, with the coarse-to-fine model: the 2nd stage of the full model does not reach
+    # optimality in a bounded time, and a plan cut by the time limit is not reproducible. The time limit
+    # only bounds the run; a solve stopped by it shows up as not_optimal
+    '2025May': {'params': 'parameters_2025May.yaml', 'overrides': {'coarse_block': 4, 'solver_time_limit': 600}},
+    # First night of the May 2025 run, quick enough to check every change of the solver or the model
+    '2025May_night1': {'params': 'parameters_2025May.yaml',
+                       'overrides': {'fname_obsdate': 'golden/obsdates_2025May_night1.txt'}},
+}
+
+# Directory of the baselines (<case>.json) and of the frozen inputs that are not bundled
+GOLDEN_DIR = 'golden'
+
+# Input files of the parameter file, resolved before the run moves to its working directory
+INPUT_KEYS = ['fname_obsdate', 'fname_obsdate_finish', 'fname_targets', 'fname_targets_finish']
+
+# Output files of the parameter file, written to the working directory of the run
+OUTPUT_KEYS = ['fname_report', 'fname_schedule', 'fname_conditions', 'fname_cache']
+
+# Tolerances of the comparison with the baselines: kind of metric -> (direction, absolute, relative).
+# direction +1: higher is better, -1: lower is better, 0: any change is a regression.
+# A metric regresses when it is worse than its baseline by more than absolute + relative * |baseline|
+TOLERANCES = {
+    'objective': (+1, 1e-6, 1e-3),
+    'not_optimal': (-1, 0, 0.0),
+    'wg_fraction': (0, 0.02, 0.0),
+    'completed_targets': (+1, 0, 0.0),
+    'dummy_slots': (-1, 0, 0.0),
+    'violations_limit': (-1, 0, 0.0),
+    'violations_warn': (-1, 2, 0.0),
+    'timing': (-1, 5.0, 0.5),
+}
+
+def case_params(name, workdir):
+    """
+    回帰テストのケース name の Params を作ります。入力は絶対パスにし、出力は workdir に置きます。
+    """
+    case = GOLDEN_CASES[name]
+    params = Params(case['params'])
+    params.params.update(case['overrides'])
+    for key in INPUT_KEYS:
+        if params[key]:
+            params.params[key] = os.path.abspath(params[key])
+    for key in OUTPUT_KEYS:
+        params.params[key] = os.path.join(workdir, os.path.basename(getattr(params, key)))
+    return params
+
+def run_case(name, workdir, workers=2):
+    """
+    ケース name の入力で sspplan.py の全ての段階をチェックポイントなしで実行し、計画の指標を返します。
+
+    プロットは workdir に書き、端末用の観測計画は表示しません。
+
+    Returns:
+        dict: schedule_metrics の指標に、段階ごとの時間 (秒) と各 solve の結果を加えた辞書。
+    """
+    params = case_params(name, workdir)
+    subaru = MyObserver.at_site('Subaru', timezone='US/Hawaii')
+    args = argparse.Namespace(from_stage=None, to_stage=STAGES[-1], print_windows=False, no_sequence=False,
+                              pdf_per_night=False)
+
+    profiler = Profiler(trace_memory=False)
+    Profiling.enable(profiler)
+    cwd = os.getcwd()
+    # The plots are written to the working directory, also by the rendering processes
+    os.chdir(workdir)
+    try:
+        artifacts = ArtifactQueue(workers, intermediate=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_pipeline(args, params, subaru, CheckpointStore(None, params), artifacts)
+            artifacts.join()
+    finally:
+        os.chdir(cwd)
+        Profiling.enable(None)
+
+    targetList = TargetManager(params.fname_targets, params.fname_targets_finish).targetList
+    metrics = schedule_metrics(loadSchedule(params.fname_schedule), len(loadConditions(params.fname_conditions).slot_index),
+                               targetList)
+
+    # Objective of the solves of each stage (the 1st stage solves each priority)
+    stages = [record for record in profiler.spans if record['stage']]
+    solves = [record for record in profiler.spans if record['name'] == 'solve' and 'args' in record]
+    metrics['objective'] = {}
+    for solve in solves:
+        stage = next(s['name'] for s in stages if s['start'] <= solve['start'] <= s['start'] + s['duration'])
+        metrics['objective'][stage] = metrics['objective'].get(stage, 0.0) + (solve['args']['objective'] or 0.0)
+    metrics['solves'] = [solve['args'] for solve in solves]
+    # A solve stopped by the time limit keeps the status Optimal: the state of its solution tells
+    metrics['not_optimal'] = sum(solve['args']['solution'] != LpSolution[LpSolutionOptimal] for solve in solves)
+    metrics['timings'] = {stage['name']: stage['duration'] for stage in stages}
+    metrics['timings']['total'] = sum(stage['duration'] for stage in stages)
+    return metrics
+
+def schedule_metrics(table, num_slots, targetList):
+    """
+    書き出した観測計画の品質の指標を計算します。
+
+    Args:
+        table (Table): exportSchedule で書いた観測計画 (loadSchedule で読んだ表)。
+        num_slots (int): 全てのスロットの数。
+        targetList: 計画前の観測数を持つ TargetList オブジェクト
+
+    Returns:
+        dict: 露出数、dummy (ターゲットのない) スロット数、WG ごとのスロットの割合、計画で完了するターゲット、
+            条件の列ごとの WARN と LIMIT の数の辞書。
+    """
+    exposures = Counter(str(name) for name in table['name'])
+    completed = sorted(t.name for t in targetList.get_all_targets()
+                       if t.observed < t.nexp <= t.observed + exposures.get(t.name, 0))
+    wgs = Counter(str(wg) for wg in table['wg'])
+    violations = {}
+    for column in table.colnames:
+        if column.endswith('_code'):
+            codes = table[column].data
+            violations[column[:-len('_code')]] = {'warn': int((codes == WARN).sum()), 'limit': int((codes == LIMIT).sum())}
+    return {'slots': num_slots,
+            'exposures': len(table),
+            'dummy_slots': num_slots - len(table),
+            'wg_fractions': {wg: wgs.get(wg, 0) / num_slots if num_slots else 0.0 for wg in targetList.wg_list},
+            'completed_targets': len(completed),
+            'completed': completed,
+            'violations': violations}
+
+def compared_values(metrics, timings=True):
+    """
+    基準と比べる指標を (名前, TOLERANCES の種類, 値) のリストにします。
+    """
+    values = [(f'objective.{stage}', 'objective', value) for stage, value in metrics['objective'].items()]
+    values.append(('not_optimal', 'not_optimal', metrics['not_optimal']))
+    values += [(f'wg_fraction.{wg}', 'wg_fraction', value) for wg, value in metrics['wg_fractions'].items()]
+    values.append(('completed_targets', 'completed_targets', metrics['completed_targets']))
+    values.append(('dummy_slots', 'dummy_slots', metrics['dummy_slots']))
+    for name, counts in metrics['violations'].items():
+        values.append((f'violations.{name}.limit', 'violations_limit', counts['limit']))
+        values.append((f'violations.{name}.warn', 'violations_warn', counts['warn']))
+    if timings:
+        values += [(f'timing.{stage}', 'timing', value) for stage, value in metrics['timings'].items()]
+    return values
+
+def compare(metrics, baseline, timings=True):
+    """
+    指標を基準と比べます。
+
+    Args:
+        metrics (dict): run_case の指標。
+        baseline (dict): 基準の指標。
+        timings (bool): 段階の時間も比べるか (基準と違う計算機では False)。
+
+    Returns:
+        list: 指標ごとの name, kind, baseline, current, status ('ok', 'improved', 'regressed', 'new') の辞書のリスト。
+            基準にあって今回ない指標は regressed です。
+    """
+    current = {name: (kind, value) for name, kind, value in compared_values(metrics, timings)}
+    reference = {name: (kind, value) for name, kind, value in compared_values(baseline, timings)}
+    results = []
+    for name in list(reference) + [name for name in current if name not in reference]:
+        kind, base = reference.get(name, current.get(name))
+        value = current[name][1] if name in current else None
+        if name not in reference:
+            status = 'new'
+        elif value is None:
+            status = 'regressed'
+        else:
+            direction, absolute, relative = TOLERANCES[kind]
+            allowed = absolute + relative * abs(base)
+            gain = value - base if direction >= 0 else base - value
+            if direction == 0:
+                status = 'regressed' if abs(gain) > allowed else 'ok'
+            else:
+                status = 'regressed' if gain < -allowed else 'improved' if gain > allowed else 'ok'
+        results.append({'name': name, 'kind': kind, 'baseline': base if name in reference else None,
+                        'current': value, 'status': status})
+    return results
+
+def baseline_path(name):
+    return os.path.join(GOLDEN_DIR, f'{name}.json')
+
+def save_baseline(name, metrics):
+    """
+    ケース name の指標を基準として保存します。
+    """
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(baseline_path(name), 'w') as f:
+        json.dump({'case': name, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'inputs': GOLDEN_CASES[name], 'environment': environment(), 'metrics': metrics}, f, indent=1)
+    logger.info(f"Baseline of case {name} saved to {baseline_path(name)}")
+
+def load_baseline(name):
+    """
+    ケース name の基準の指標を読み込みます。基準がない場合は None。
+    """
+    if not os.path.exists(baseline_path(name)):
+        return None
+    with open(baseline_path(name)) as f:
+        return json.load(f)['metrics']
+
+def log_comparison(name, results):
+    """
+    基準から変わった指標をログに出し、悪化した指標の数を返します。
+    """
+    regressed = [r for r in results if r['status'] == 'regressed']
+    for r in results:
+        if r['status'] in ('regressed', 'improved'):
+            log = logger.error if r['status'] == 'regressed' else logger.info
+            log(f"  {name}: {r['name']} {r['status']}: {r['baseline']} -> {r['current']}")
+    logger.info(f"Case {name}: {len(regressed)} regressed, "
+                f"{sum(r['status'] == 'improved' for r in results)} improved, "
+                f"{sum(r['status'] == 'ok' for r in results)} unchanged metrics")
+    return len(regressed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the plans of the frozen inputs with their golden baselines")
+    parser.add_argument('--cases', nargs='+', default=list(GOLDEN_CASES), choices=list(GOLDEN_CASES),
+                        help=f'Cases to run (default: all of {list(GOLDEN_CASES)})')
+    parser.add_argument('--update', action='store_true',
+                        help=f'Save the metrics of this run as the baselines in {GOLDEN_DIR}/ instead of comparing')
+    parser.add_argument('--no-timings', action='store_true',
+                        help='Do not compare the stage timings (baselines recorded on another machine)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of processes rendering the plots and reports (0: render them synchronously)')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory of the outputs of the runs (default: a temporary directory)')
+    parser.add_argument('--output', default=None, help='Write the metrics and the comparisons to this JSON file')
+    parser.add_argument('--log-level', default='ERROR',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the logging level of the planner (default: ERROR)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    report = {}
+    n_regressed = 0
+    n_missing = 0
+    for name in args.cases:
+        # A case without a baseline fails without running: there is nothing to compare with
+        if not args.update and not os.path.exists(baseline_path(name)):
+            logger.error(f"Case {name}: no baseline in {baseline_path(name)}, record it with --update")
+            n_missing += 1
+            continue
+        workdir = os.path.abspath(os.path.join(args.workdir, name)) if args.workdir else tempfile.mkdtemp(prefix=f'golden_{name}_')
+        os.makedirs(workdir, exist_ok=True)
+        logger.info(f"Case {name}: running the pipeline in {workdir}")
+        metrics = run_case(name, workdir, args.workers)
+        report[name] = {'metrics': metrics}
+        if args.update:
+            save_baseline(name, metrics)
+            continue
+        baseline = load_baseline(name)
+        report[name]['comparison'] = compare(metrics, baseline, timings=not args.no_timings)
+        n_regressed += log_comparison(name, report[name]['comparison'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    sys.exit(1 if n_regressed or n_missing else 0)
@@ -1,8 +1,11 @@
 from astropy.table import Table
 from astropy.time import Time
 import astropy.units as u
-from ObservingConditions import slewTime
+import numpy as np
 import logging
+import copy
+from Targets import TargetField
+from Profiling import profiled
 import os # for os.path.exists
 
 # Configure logging
@@ -121,16 +124,30 @@ class ObsSlotList:
         else:
             raise ValueError("Invalid index for ObsSlotList")
 
+    @profiled('ObsSlotList.updateSchedule')
     def updateSchedule(self, o, obs_slots, targets, targetList):
         for slot in obs_slots:
             for target in targets:
                 if o[(slot.index, target.name)].varValue > 0.5:
+                    # Slots of an aggregated GA field go to its sub-pointings in (priority, name) order
+                    if isinstance(target, TargetField):
+                        target = target.next_member()
                     slot.target = target
                     self.updateUsed(slot.index)
                     targetList.update_observed(target.name, 1)
                     break
 
+    @profiled('ObsSlotList.updateTimeBySlew')
     def updateTimeBySlew(self, oc, params):
+        # Slew times of all the consecutive pairs of the same night in one vectorized call
+        pairs = [i for i in range(self.num_slots-1)
+                 if self.slots[i].date == self.slots[i+1].date
+                 and self.slots[i].target is not None and self.slots[i+1].target is not None]
+        slew_times = oc.slew_times([self.slots[i].index for i in pairs],
+                                   [self.slots[i].target.name for i in pairs],
+                                   [self.slots[i+1].target.name for i in pairs])
+        slew_times = dict(zip(pairs, slew_times))
+
         slew_overhead = 0.0 * u.minute
         for i in range(self.num_slots-1):
             cur_slot = self.slots[i]
@@ -144,11 +161,7 @@ class ObsSlotList:
             if cur_target == None or tgt_target == None:
                 logger.warning(f"Slot {cur_slot.index} or {tgt_slot.index} is empty during slew time calculation")
                 continue
-            cur_altaz = oc.altaz(cur_slot.index, cur_target.name)
-            tgt_altaz = oc.altaz(tgt_slot.index, tgt_target.name)
-            cur_rotang = oc.rotang_end(cur_slot.index, cur_target.name)
-            tgt_rotang = oc.rotang_start(tgt_slot.index, tgt_target.name)
-            slew_time = slewTime(cur_altaz, cur_rotang, tgt_altaz, tgt_rotang, params)
+            slew_time = slew_times[i]
             logger.info(f"Slew Time: {cur_slot.index:3d} -> {tgt_slot.index:3d} ({cur_target.name:21s} -> {tgt_target.name:21s}) = {slew_time.to(u.minute).value:4.1f} min. Cumulative slew: {slew_overhead.to(u.minute).value:4.1f} min")
             slew_overhead += slew_time
 
@@ -194,7 +207,52 @@ class ObsDate:
             date = (Time(date, format='iso') + 1 * u.day).iso.split(' ')[0]
         return Time(date+' '+time) - utcoffset
 
-    def __init__(self, fname_obsdate, fname_obsdate_finish=None, observer=None, params=None):
+    # Vectorized version of get_time for arrays of dates and local times
+    def get_times(self, dates, times, utcoffset):
+        seconds = []
+        for time in times:
+            hms = (time.split(':') + ['0', '0'])[:3]
+            seconds.append(int(hms[0]) * 3600 + int(hms[1]) * 60 + float(hms[2]))
+        return Time([date+' 00:00:00' for date in dates]) + np.array(seconds) * u.second - utcoffset
+
+    @profiled('ObsDate.night_boundaries')
+    def night_boundaries(self, dates, starts, ends, observer, params):
+        """
+        全ての観測夜の開始・終了時刻 (UTC) をまとめて計算します。
+
+        Args:
+            dates (list): 観測日 (HST) のリスト。
+            starts (list): 開始時刻 ('sun_set' または HH:MM) のリスト。
+            ends (list): 終了時刻 ('sun_rise' または HH:MM) のリスト。
+            observer: MyObserver オブジェクト。
+            params: Params オブジェクト。
+
+        Returns:
+            tuple: 開始時刻と終了時刻の Time 配列。
+        """
+        # Set time to noon at Hawaii to calculate the "next" sunset and sunrise
+        noon = Time([date+' 12:00:00' for date in dates]) - observer.utcoffset
+
+        boundaries = []
+        for times, event in [(starts, 'sun_set'), (ends, 'sun_rise')]:
+            is_event = np.array([time == event for time in times])
+            jd = np.empty(len(dates))
+            if is_event.any():
+                if event == 'sun_set':
+                    jd[is_event] = observer.sun_set_time(noon[is_event], which='next', horizon=params.angle_twilight).jd
+                else:
+                    jd[is_event] = observer.sun_rise_time(noon[is_event], which='next', horizon=params.angle_twilight).jd
+            if not is_event.all():
+                jd[~is_event] = self.get_times([d for d, e in zip(dates, is_event) if not e],
+                                               [t for t, e in zip(times, is_event) if not e],
+                                               observer.utcoffset).jd
+            boundaries.append(Time(jd, format='jd', scale='utc'))
+
+        return boundaries[0], boundaries[1]
+
+    def __init__(self, fname_obsdate, fname_obsdate_finish=None, observer=None, params=None, boundaries=None):
+        # boundaries: (start, end) Time arrays of the nights saved from a previous run (night_start, night_end),
+        # to skip the computation of the sunset and sunrise times
 
         obsdate_table = Table.read(fname_obsdate, format='ascii')
 
@@ -208,58 +266,92 @@ class ObsDate:
         else:
             self.dates_finish = []
 
-        self.dates_local = []
-        self.dates_utc = []
-
-        midpt = params.t_overhead + 0.5 * (params.w_timeslot - params.t_overhead)
+        starts = [str(start) for start in obsdate_table.columns[1]]
+        ends = [str(end) for end in obsdate_table.columns[2]]
+        if boundaries is None:
+            start_times, end_times = self.night_boundaries(self.dates, starts, ends, observer, params)
+        else:
+            start_times, end_times = boundaries
+            if len(start_times) != len(self.dates) or len(end_times) != len(self.dates):
+                raise ValueError(f"The night boundaries do not match the {len(self.dates)} nights of {fname_obsdate}")
+        self.night_start = start_times
+        self.night_end = end_times
 
-        self.obsSlotList = ObsSlotList()
-        slot_index = 0
+        # Print the time range for the observation in HST
+        for date, start_time, end_time in zip(self.dates, start_times + observer.utcoffset, end_times + observer.utcoffset):
+            logger.info(f"ObsDate processing: {date} HST Start: {start_time.iso} HST End: {end_time.iso}")
 
-        for i, (date, start, end) in enumerate(obsdate_table):
-            # Set time to noon at Hawaii to calculate the "next" sunset and sunrise
-            time = Time(date+' 12:00:00') - observer.utcoffset
-            
-            if start == 'sun_set':
-                start_time = observer.sun_set_time(time, which='next', horizon=params.angle_twilight)
-            else:
-                start_time = self.get_time(date, start, observer.utcoffset)
-            if end == 'sun_rise':
-                end_time = sun_rise = observer.sun_rise_time(time, which='next', horizon=params.angle_twilight)
-            else:
-                end_time = self.get_time(date, end, observer.utcoffset)
-            # Print the time range for the observation in HST
-            logger.info(f"ObsDate processing: {date} HST Start: {(start_time+observer.utcoffset).iso} HST End: {(end_time+observer.utcoffset).iso}")
+        self._night_dates_utc = list(start_times.strftime('%Y-%m-%d'))
 
+        self.dates_local = []
+        self.dates_utc = []
+        for date, date_utc in zip(self.dates, self._night_dates_utc):
             if not date in self.dates_finish:
                 if not date in self.dates_local:
                     self.dates_local.append(date)
-                date_utc = start_time.strftime('%Y-%m-%d')
                 if not date_utc in self.dates_utc:
                     self.dates_utc.append(date_utc)
 
-            used = False
-            if date in self.dates_finish:
-                used = True
-
-            current = start_time
-            while current + midpt < end_time:
-                slot_index += 1
-                obsSlot = ObsSlot(index=slot_index,
-                                  start=current,
-                                  end=current + params.w_timeslot,
-                                  mid=current + midpt,    
-                                  obs_start=current + params.t_overhead,
-                                  obs_end=current + params.w_timeslot,
-                                  date=date,
-                                  date_utc=date_utc,
-                                  used=used)
-                self.obsSlotList.add_slot(obsSlot)
-                current += params.w_timeslot
+        # Lay out the slots of all nights at once:
+        # the k-th slot of a night starts at start_time + k * w_timeslot as long as its mid-point is before end_time
+        midpt = params.t_overhead + 0.5 * (params.w_timeslot - params.t_overhead)
+        nslot = np.ceil(((end_times - start_times - midpt) / params.w_timeslot).to_value(u.dimensionless_unscaled))
+        nslot = np.maximum(nslot, 0).astype(int)
+        self._slot_night = np.repeat(np.arange(len(self.dates)), nslot)
+        k = np.arange(nslot.sum()) - np.repeat(np.cumsum(nslot) - nslot, nslot)
+        self._slot_start = start_times[self._slot_night] + k * params.w_timeslot
+
+        self.obsSlotList = self._build_slot_list()
 
         self.dates_local.sort()
         self.dates_utc.sort()
 
+    def _build_slot_list(self):
+        """
+        ObsDate の時刻配列から新しい ObsSlotList を作成します。
+
+        Returns:
+            ObsSlotList: 未割り当ての観測スロットのリスト。
+        """
+        params = self.params
+        midpt = params.t_overhead + 0.5 * (params.w_timeslot - params.t_overhead)
+
+        starts = self._slot_start
+        ends = starts + params.w_timeslot
+        mids = starts + midpt
+        obs_starts = starts + params.t_overhead
+
+        obsSlotList = ObsSlotList()
+        for i, night in enumerate(self._slot_night):
+            date = self.dates[night]
+            obsSlot = ObsSlot(index=i+1,
+                              start=starts[i],
+                              end=ends[i],
+                              mid=mids[i],
+                              obs_start=obs_starts[i],
+                              obs_end=ends[i],
+                              date=date,
+                              date_utc=self._night_dates_utc[night],
+                              used=date in self.dates_finish)
+            obsSlotList.add_slot(obsSlot)
+        return obsSlotList
+
+    def clone(self, dates_finish=None):
+        """
+        観測夜の計算をやり直さずに、新しい ObsSlotList を持つ ObsDate を作成します。
+
+        Args:
+            dates_finish (list): 観測済みとして扱う夜 (スロットは使用済みになります)。None の場合は元のまま。
+
+        Returns:
+            ObsDate: スロットが初期状態の ObsDate。
+        """
+        obsdate = copy.copy(self)
+        if dates_finish is not None:
+            obsdate.dates_finish = list(dates_finish)
+        obsdate.obsSlotList = obsdate._build_slot_list()
+        return obsdate
+
     @property
     def nexp_max(self):
         return {w: int((self.params.frac[w] + 0.5 * self.params.frac_margin) * self.obsSlotList.num_slots) for w in self.params.frac.keys()}
@@ -1,12 +1,15 @@
 from astropy.time import Time
 import astropy.units as u
-from astropy.coordinates import Angle, get_body, AltAz
-from astroplan import moon_illumination
+from astropy.coordinates import Angle, AltAz, SkyCoord
 from Moon import MoonBrightnessModel as MBM
-import math
+from Ephemeris import EphemerisProvider
+from Visibility import unit_vectors, separation_matrix
+from Profiling import span, profiled
 import numpy as np
-import pickle
+import tempfile
+import os
 import hashlib
+from functools import lru_cache
 import json
 import base64
 from tqdm import tqdm
@@ -69,120 +72,422 @@ def generate_unique_id_base64(obsSlotList, targetList, observer, num_bytes=10):
 
     return unique_id
 
+# Grids stored for each (pointing, slot) cell
+GRID_NAMES = ['alt', 'az', 'airmass', 'ha', 'rotang_start', 'rotang_end', 'teff',
+              'moon_sep', 'mars_sep', 'jupiter_sep', 'saturn_sep']
+
+# Period of the angular grids, used when interpolating them in time
+GRID_PERIODS = {'az': 360.0, 'ha': 24.0, 'rotang_start': 360.0, 'rotang_end': 360.0}
+
+# Approximate number of float64 temporaries per (pointing, slot) cell while computing a block
+BLOCK_WORK_CELLS = 48
+
 class ObservingConditions:
 
-    def __init__(self, obsSlotList, targetList, observer, params):
+    @profiled('ObservingConditions')
+    def __init__(self, obsSlotList, targetList, observer, params, visibility=None,
+                 memory_budget=None, scratch_dir=None):
+        """
+        Args:
+            obsSlotList: ObsSlotList オブジェクト
+            targetList: TargetList オブジェクト
+            observer: MyObserver オブジェクト
+            params: Params オブジェクト
+            visibility: VisibilityWindows オブジェクト。None の場合は全ての組み合わせを観測可能とします。
+            memory_budget (float): 計算に使うメモリの上限 (MB)。指定するとターゲットをブロックに分けて計算し、
+                各グリッドを scratch_dir のメモリマップファイルに保存します。None の場合は params.memory_budget。
+            scratch_dir (str): メモリマップファイルのディレクトリ。None の場合は一時ディレクトリ。
+        """
+
+        pointing_targets, mid_times = self._index(obsSlotList, targetList, observer, params, visibility)
+        start_times = Time([slot.obs_start for slot in obsSlotList.get_all_slots()])
+        end_times = Time([slot.obs_end for slot in obsSlotList.get_all_slots()])
+
+        target_coords = [target.coord for target in pointing_targets]
+        target_pa     = np.array([target.pa.to(u.deg).value for target in pointing_targets])
+        num_targets = len(target_coords)
+        num_slots = obsSlotList.num_slots
+        logger.info(f"{num_targets} unique pointings for {targetList.num_targets} targets")
+
+        # (target, slot) pairs inside the visibility windows. All pairs are visible without windows.
+        if visibility is not None:
+            self._visible = visibility.mask(obsSlotList, targetList)
+        else:
+            self._visible = np.ones((targetList.num_targets, num_slots), dtype=bool)
+        self._visible_pointings = self._pointing_mask(self._visible)
 
+        # (pointing, night) blocks with a visibility window. The other blocks are never feasible,
+        # so their positions and effective exposure times are not computed.
+        if visibility is not None:
+            observable = self._pointing_mask(visibility.observable_mask(targetList, list(self._night_indices)))
+        else:
+            observable = np.ones((num_targets, len(self._night_indices)), dtype=bool)
+        night_slots = np.split(self._night_order, self._night_starts[1:])
+        logger.info(f"{np.count_nonzero(observable)} of {observable.size} (pointing, night) blocks are observable")
+
+        uniq_id = generate_unique_id_base64(obsSlotList, targetList, observer)
+        logger.info(f"Unique ID for ObservingConditions: {uniq_id}")
+
+        # Storage of the (pointing, slot) grids: in memory, or memory-mapped files within the memory budget
+        if memory_budget is None:
+            memory_budget = params.memory_budget
+        block_size = num_targets
+        if memory_budget is not None:
+            block_size = max(1, int(memory_budget * 1024**2 / (num_slots * 8 * BLOCK_WORK_CELLS)))
+        self._scratch = None
+        if block_size < num_targets:
+            if scratch_dir is None:
+                self._scratch = tempfile.TemporaryDirectory(prefix=f'oc_{uniq_id}_')
+                scratch_dir = self._scratch.name
+            os.makedirs(scratch_dir, exist_ok=True)
+            logger.info(f"Chunked mode: {block_size} pointings per block, grids stored in {scratch_dir}")
+            self._grids = {name: np.lib.format.open_memmap(os.path.join(scratch_dir, f'{uniq_id}_{name}.npy'), mode='w+',
+                                                           dtype=np.float64, shape=(num_targets, num_slots))
+                           for name in GRID_NAMES}
+        else:
+            self._grids = {name: np.empty((num_targets, num_slots)) for name in GRID_NAMES}
+        self._scratch_dir = scratch_dir
+        self._block_size = block_size
+
+        with span('ephemeris'):
+            # Per-slot quantities shared by all the pointings
+            lst = mid_times.sidereal_time('mean', longitude=observer.longitude).hour
+
+            logger.info("Calculating the Moon and Planets")
+            # Moon, Sun and planets are interpolated from coarse-sampled ephemerides
+            ephemeris = EphemerisProvider(observer, params.ephemeris_step, params.ephemeris_tolerance)
+            moon = ephemeris.body('moon', mid_times)
+            self._moon_ill = ephemeris.moon_illumination(mid_times)
+
+            sun = ephemeris.body('sun', mid_times)
+            self._moon_phase = moon.separation(sun, origin_mismatch="ignore")
+
+            self._moon_altaz = ephemeris.moon_altaz(mid_times)
+
+            # Separations (deg) are computed as dense (pointing, slot) arrays from unit vectors
+            body_vectors = {'moon': unit_vectors(moon.ra.rad, moon.dec.rad)}
+            for planet in ["mars", "jupiter", "saturn"]:
+                planet_pos = ephemeris.body(planet, mid_times)
+                body_vectors[planet] = unit_vectors(planet_pos.ra.rad, planet_pos.dec.rad)
+
+        with span('grids'):
+            mbm = MBM()
+            moon_alt = self._moon_altaz.alt.deg
+            for b0 in tqdm(range(0, num_targets, block_size), desc="Calculating observing conditions",
+                           disable=block_size >= num_targets):
+                rows = slice(b0, min(b0 + block_size, num_targets))
+                coords = target_coords[rows]
+                ra = np.array([c.ra.rad for c in coords])
+                dec = np.array([c.dec.rad for c in coords])
+
+                self._grids['ha'][rows] = lst[np.newaxis, :] - np.degrees(ra)[:, np.newaxis] / 15.0
+
+                logger.debug("Calculating the separation from the Moon and Planets")
+                vectors = unit_vectors(ra, dec)
+                for body, body_vector in body_vectors.items():
+                    self._grids[f'{body}_sep'][rows] = separation_matrix(vectors, body_vector)
+
+                # Sentinels of the blocks outside the visibility windows
+                for name in ['alt', 'az', 'rotang_start', 'rotang_end']:
+                    self._grids[name][rows] = np.nan
+                self._grids['airmass'][rows] = 100.0
+                self._grids['teff'][rows] = 0.0
+
+                # Calculate the minimum zenith distance for the tareget
+                zmin = np.abs(dec - observer.location.lat.rad)
+
+                # Normalize the effective exposure time at the minimum zenith distance
+                airmass0 = 1.0 / np.cos(zmin)
+                teff0 = 1.0 / (airmass0 * 10**(0.8*mbm.k['r']*(airmass0-1.0)))
+
+                for n, cols in enumerate(night_slots):
+                    block = np.flatnonzero(observable[rows, n])
+                    if len(block) == 0 or len(cols) == 0:
+                        continue
+                    cells = np.ix_(rows.start + block, cols)
+                    block_coords = [coords[k] for k in block]
+
+                    logger.debug(f"Calculating airmass and hour angle for {len(block)} pointings in night {n}")
+                    altaz = observer.altaz(mid_times[cols], block_coords, grid_times_targets=True)
+                    alt = altaz.alt.deg
+                    self._grids['alt'][cells] = alt
+                    self._grids['az'][cells] = altaz.az.deg
+                    airmass = altaz.secz.value
+                    # Set airmass to a larget value for targets below 0.573 deg (=> airmass = 100)
+                    airmass[alt < 0.573] = 100.0
+                    self._grids['airmass'][cells] = airmass
+                    del altaz
+
+                    logger.debug("Calculating rotator angle")
+                    for name, times in [('rotang_start', start_times), ('rotang_end', end_times)]:
+                        parallactic_angle = observer.parallactic_angle(times[cols], block_coords, grid_times_targets=True).deg
+                        self._grids[name][cells] = np.mod(parallactic_angle + target_pa[rows][block, np.newaxis] + 180.0, 360.0) - 180.0
+
+                    logger.debug("Calculating effective exposure time")
+                    dmu = mbm.deltaMag("r",
+                                       self._moon_phase.deg[cols],
+                                       90.-moon_alt[cols],
+                                       90.-alt,
+                                       self._grids['moon_sep'][cells])
+                    dmu = np.broadcast_to(dmu, alt.shape).copy()
+                    dmu[:, moon_alt[cols] < 0] = 0.0
+                    self._grids['teff'][cells] = (1.0 / (10**(-0.4*dmu) * airmass * 10**(0.8*mbm.k['r']*(airmass-1.0)))) / teff0[block, np.newaxis]
+
+        for grid in self._grids.values():
+            if isinstance(grid, np.memmap):
+                grid.flush()
+
+        self._moon_sep = self._grids['moon_sep']
+        self._planet_seps = {planet: self._grids[f'{planet}_sep'] for planet in ["mars", "jupiter", "saturn"]}
+        self._teff = self._grids['teff']
+
+        # Minimum separation of each pointing in each night
+        self._moon_sep_min = self._night_min(self._moon_sep)
+        self._planet_seps_min = {planet: self._night_min(sep) for planet, sep in self._planet_seps.items()}
+
+        # Slew times are computed on demand
+        self.slew = SlewModel(self, params)
+
+    def _index(self, obsSlotList, targetList, observer, params, visibility):
+        """
+        ターゲット・スロット・夜のインデックスを作ります。
+
+        Returns:
+            tuple: 各ポインティング (座標と PA が同じターゲットのまとまり) の代表のターゲットのリストと、
+                スロットの中央時刻。
+        """
         self.obsSlotList = obsSlotList
         self.targetList = targetList
         self.observer = observer
         self.params = params
+        self.visibility = visibility
 
         # Pre-compute and store target indices
-        self._target_indices = {target.name: i for i, target in enumerate(targetList.get_all_targets())}
+        # Targets sharing the same pointing (coord, pa) are mapped onto one computed row
+        pointing_rows = {}
+        pointing_targets = []
+        self._target_indices = {}
+        for target in targetList.get_all_targets():
+            key = (target.coord.ra.deg, target.coord.dec.deg, target.pa.to(u.deg).value)
+            if key not in pointing_rows:
+                pointing_rows[key] = len(pointing_targets)
+                pointing_targets.append(target)
+            self._target_indices[target.name] = pointing_rows[key]
+
+        # Rows of the visibility mask, which depends on the WG of each target
+        self._target_rows = {target.name: i for i, target in enumerate(targetList.get_all_targets())}
 
         # Pre-compute and store slot indices
         self._slot_indices = {slot.index: i for i, slot in enumerate(obsSlotList.get_all_slots())}
 
-        mid_times = Time([slot.mid for slot in obsSlotList.get_all_slots()])
-        start_times = Time([slot.obs_start for slot in obsSlotList.get_all_slots()])
-        end_times = Time([slot.obs_end for slot in obsSlotList.get_all_slots()])
-        
-        target_coords = [target.coord for target in targetList.get_all_targets()]
-        target_pa     = [target.pa for target in targetList.get_all_targets()]
-        num_targets = len(target_coords)
-        
-        logger.info("Calculating airmass and hour angle")
-        self._altaz = observer.altaz(mid_times, target_coords, 
-                                     grid_times_targets=True)
-        
-        self._airmass = self._altaz.secz
-        # Set airmass to a larget value for targets below 0.573 deg (=> airmass = 100)
-        self._airmass[self._altaz.alt < 0.573 * u.deg] = 100.0 
-
-        hour_angles = []
-        for i, t in enumerate(target_coords):
-            hour_angle = mid_times.sidereal_time('mean', longitude=observer.longitude) - t.ra
-            #hour_angle = hour_angle.wrap_at(180 * u.deg)
-            hour_angles.append(hour_angle)
-        self._hour_angles = Angle(hour_angles)
-
-        logger.info("Calculating rotator angle")
-        parallactic_angle_at_start = observer.parallactic_angle(start_times, target_coords,
-                                                                grid_times_targets=True)
-        parallactic_angle_at_end   = observer.parallactic_angle(end_times,   target_coords,
-                                                                grid_times_targets=True)
-        self._rot_angle_at_start = Angle([parallactic_angle_at_start[i] + target_pa[i] for i in range(num_targets)]).wrap_at(180 * u.deg)
-        self._rot_angle_at_end   = Angle([parallactic_angle_at_end[i]   + target_pa[i] for i in range(num_targets)]).wrap_at(180 * u.deg)
-        
-        logger.info("Calculating the separation from the Moon and Planets")
-        moon = get_body('moon', mid_times, observer.location)
-        self._moon_sep = [moon.separation(target_coords[i], origin_mismatch="ignore") for i in range(num_targets)]
-
-        self._moon_ill = moon_illumination(mid_times)
-
-        sun = get_body('sun', mid_times, observer.location)
-        self._moon_phase = moon.separation(sun, origin_mismatch="ignore")
-
-        frame = AltAz(obstime=mid_times, location=observer.location)
-        self._moon_altaz = moon.transform_to(frame)
-
-        self._planet_seps = {}
-        for planet in ["mars", "jupiter", "saturn"]:
-            planet_pos = get_body(planet, mid_times, observer.location)
-            self._planet_seps[planet] = [planet_pos.separation(target_coords[i], origin_mismatch="ignore") for i in range(num_targets)]
-
-        logger.info("Calculating effective exposure time")
-        mbm = MBM()
-
-        self._teff = []
-        for i in range(num_targets):
-            # Calculate the minimum zenith distance for the tareget
-            zmin = abs(target_coords[i].dec - observer.location.lat)
-            
-            # Normalize the effective exposure time at the minimum zenith distance
-            airmass0 = 1.0 / math.cos(zmin.to(u.rad).value)
-            teff0 = 1.0 / (airmass0 * 10**(0.8*mbm.k['r']*(airmass0-1.0)))
-            dmu = mbm.deltaMag("r",
-                               self._moon_phase.deg,
-                               90.-self._moon_altaz.alt.deg,
-                               90.-self._altaz[i].alt.deg,
-                               self._moon_sep[i].deg)
-            dmu[self._moon_altaz.alt < 0] = 0.0
-            self._teff.append((1.0 / (10**(-0.4*dmu) * self._airmass[i] * 10**(0.8*mbm.k['r']*(self._airmass[i]-1.0))) / teff0).value)
-
-        self._teff = np.array(self._teff)
+        # Slots grouped by night for the per-night minimum of the separations
+        slot_dates = [slot.date for slot in obsSlotList.get_all_slots()]
+        self._night_indices = {date: i for i, date in enumerate(dict.fromkeys(slot_dates))}
+        slot_nights = np.array([self._night_indices[date] for date in slot_dates], dtype=int)
+        self._night_order = np.argsort(slot_nights, kind='stable')
+        self._night_starts = np.searchsorted(slot_nights[self._night_order], np.arange(len(self._night_indices)))
 
-        uniq_id = generate_unique_id_base64(obsSlotList, targetList, observer)
-        logger.info(f"Unique ID for ObservingConditions cache: {uniq_id}")
-
-        logger.info("Calculating slew time")
-        self.calc_slewTime(uniq_id)
+        mid_times = Time([slot.mid for slot in obsSlotList.get_all_slots()])
+        self._slot_mid = mid_times.jd
+        self._num_pointings = len(pointing_targets)
+        return pointing_targets, mid_times
+
+    def _pointing_mask(self, visible):
+        # A pointing is visible if any of its targets is visible
+        visible_pointings = np.zeros((self._num_pointings, visible.shape[1]), dtype=bool)
+        np.logical_or.at(visible_pointings, [self._target_indices[name] for name in self._target_rows], visible)
+        return visible_pointings
+
+    @classmethod
+    @profiled('ObservingConditions.from_arrays')
+    def from_arrays(cls, arrays, obsSlotList, targetList, observer, params, visibility=None):
+        """
+        arrays() で保存した配列から、天体暦やグリッドを計算し直さずに ObservingConditions を作ります。
+
+        Args:
+            arrays (dict): arrays() の辞書 (Export.exportConditions の .npz など)。
+            obsSlotList: グリッドを計算した時と同じ ObsSlotList オブジェクト
+            targetList: グリッドを計算した時と同じ TargetList オブジェクト
+            observer: MyObserver オブジェクト
+            params: Params オブジェクト
+            visibility: VisibilityWindows オブジェクト。None の場合は保存した観測可能なマスクを使います。
+
+        Returns:
+            ObservingConditions: 保存した時と同じ条件を持つオブジェクト。
+
+        Raises:
+            ValueError: スロットやターゲットが保存した時と一致しない場合。
+        """
+        oc = cls.__new__(cls)
+        _, mid_times = oc._index(obsSlotList, targetList, observer, params, visibility)
+        names = list(oc._target_rows)
+        if list(arrays['target_names']) != names \
+                or list(arrays['target_pointings']) != [oc._target_indices[name] for name in names] \
+                or list(arrays['slot_index']) != list(oc._slot_indices) \
+                or not np.allclose(arrays['slot_mid_jd'], oc._slot_mid, rtol=0.0, atol=1e-8):
+            raise ValueError("The saved observing conditions do not match the slots and targets")
+
+        # The visibility mask depends on the limits of the parameters, not on the grids
+        if visibility is not None:
+            oc._visible = visibility.mask(obsSlotList, targetList)
+        else:
+            oc._visible = np.asarray(arrays['visible'], dtype=bool)
+        oc._visible_pointings = oc._pointing_mask(oc._visible)
+        oc._grids = {name: np.asarray(arrays[f'grid_{name}']) for name in GRID_NAMES}
+        oc._scratch = None
+        oc._scratch_dir = None
+        oc._block_size = oc._num_pointings
+
+        oc._moon_ill = np.asarray(arrays['moon_ill'])
+        oc._moon_phase = Angle(arrays['moon_phase'], u.deg)
+        oc._moon_altaz = SkyCoord(az=arrays['moon_az'] * u.deg, alt=arrays['moon_alt'] * u.deg,
+                                  frame=AltAz(obstime=mid_times, location=observer.location))
+
+        oc._moon_sep = oc._grids['moon_sep']
+        oc._planet_seps = {planet: oc._grids[f'{planet}_sep'] for planet in ["mars", "jupiter", "saturn"]}
+        oc._teff = oc._grids['teff']
+        oc._moon_sep_min = np.asarray(arrays['moon_sep_min'])
+        oc._planet_seps_min = {planet: np.asarray(arrays[f'{planet}_sep_min']) for planet in ["mars", "jupiter", "saturn"]}
+        oc.slew = SlewModel(oc, params)
+        return oc
+
+    def __getstate__(self):
+        # The scratch directory is not pickled: memory-mapped grids are pickled as arrays
+        state = self.__dict__.copy()
+        state['_scratch'] = None
+        state['slew'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.slew = SlewModel(self, self.params)
+
+    def arrays(self):
+        """
+        グリッドとスロットごとの量を、ファイルに保存できる配列の辞書で返します (Export.exportConditions 用)。
+
+        Returns:
+            dict: grid_<name> (ポインティング, スロット) のグリッド、visible (ターゲット, スロット) のマスク、
+                ターゲット名とその行、スロットのインデックス・中央時刻・日付、月の量、夜ごとの最小離角。
+        """
+        names = list(self._target_rows)
+        arrays = {f'grid_{name}': np.asarray(grid) for name, grid in self._grids.items()}
+        arrays.update({
+            'visible': np.asarray(self._visible, dtype=bool),
+            'target_names': np.array(names, dtype=str),
+            'target_pointings': np.array([self._target_indices[name] for name in names], dtype=int),
+            'target_rows': np.array([self._target_rows[name] for name in names], dtype=int),
+            'slot_index': np.fromiter(self._slot_indices, dtype=int),
+            'slot_mid_jd': np.asarray(self._slot_mid),
+            'slot_date': np.array([slot.date for slot in self.obsSlotList.get_all_slots()], dtype=str),
+            'night_dates': np.array(list(self._night_indices), dtype=str),
+            'moon_ill': np.asarray(self._moon_ill),
+            'moon_alt': self._moon_altaz.alt.deg,
+            'moon_az': self._moon_altaz.az.deg,
+            'moon_phase': self._moon_phase.deg,
+            'moon_sep_min': np.asarray(self._moon_sep_min),
+        })
+        for planet, sep_min in self._planet_seps_min.items():
+            arrays[f'{planet}_sep_min'] = np.asarray(sep_min)
+        return arrays
+
+    def add_alias(self, name, tname):
+        """
+        ターゲット tname と同じ条件を別名 name で参照できるようにします (GA フィールドの集約用)。
+        """
+        self._target_indices[name] = self._target_indices[tname]
+        self._target_rows[name] = self._target_rows[tname]
+
+    def values(self, name, slots, tnames):
+        """
+        グリッド name の値を (スロット, ターゲット) の配列で返します。引数はブロードキャストされます。
+
+        Args:
+            name (str): グリッド名 (GRID_NAMES)。
+            slots: スロットのインデックス (slot.index)。
+            tnames: ターゲット名。
+
+        Returns:
+            ndarray: グリッドの値。
+        """
+        slots, tnames = np.broadcast_arrays(np.asarray(slots), np.asarray(tnames, dtype=object))
+        cols = np.array([self._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows = np.array([self._target_indices[t] for t in tnames.ravel()], dtype=int)
+        return self._grids[name][rows, cols].reshape(slots.shape)
+
+    def visible_mask(self, slots, tnames):
+        """
+        (スロット, ターゲット) が観測可能な時間帯に入るかを配列で返します。引数はブロードキャストされます。
+        """
+        slots, tnames = np.broadcast_arrays(np.asarray(slots), np.asarray(tnames, dtype=object))
+        cols = np.array([self._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows = np.array([self._target_rows[t] for t in tnames.ravel()], dtype=int)
+        return self._visible[rows, cols].reshape(slots.shape)
+
+    def slot_mid(self, slots):
+        """
+        スロットの中央時刻 (グリッドを計算した時刻) を返します。
+        """
+        cols = np.array([self._slot_indices[i] for i in np.atleast_1d(slots)], dtype=int)
+        return Time(self._slot_mid[cols], format='jd', scale='utc')
+
+    def locate(self, times):
+        """
+        各時刻に中央時刻が最も近いスロットと、その中央時刻からのずれを返します。
+
+        Args:
+            times (Time): 時刻の配列。
+
+        Returns:
+            tuple: スロットのインデックス (slot.index) の配列と、ずれ (Quantity, 分) の配列。
+        """
+        jd = np.atleast_1d(times.jd)
+        islots = np.fromiter(self._slot_indices, dtype=int)
+        order = np.argsort(self._slot_mid)
+        mids = self._slot_mid[order]
+        k = np.searchsorted(mids, jd)
+        lower = np.maximum(k - 1, 0)
+        upper = np.minimum(k, len(mids) - 1)
+        k = np.where(np.abs(jd - mids[lower]) <= np.abs(mids[upper] - jd), lower, upper)
+        cols = order[k]
+        return islots[cols], ((jd - self._slot_mid[cols]) * u.day).to(u.minute)
+
+    def _cell(self, name, islot, tname):
+        return self._grids[name][self._target_indices[tname], self._slot_indices[islot]]
 
     def airmass(self, islot, tname):
         # Use the pre-computed indices for fast lookup
-        return self._airmass[self._target_indices[tname]][self._slot_indices[islot]]
+        return self._cell('airmass', islot, tname) * u.dimensionless_unscaled
 
     def altaz(self, islot, tname):
-        return self._altaz[self._target_indices[tname]][self._slot_indices[islot]]
+        return AltAz(az=self._cell('az', islot, tname) * u.deg, alt=self._cell('alt', islot, tname) * u.deg)
 
     def ha(self, islot, tname):
-        return self._hour_angles[self._target_indices[tname]][self._slot_indices[islot]]
+        return Angle(self._cell('ha', islot, tname), u.hourangle)
 
     def rotang_start(self, islot, tname):
-        return self._rot_angle_at_start[self._target_indices[tname]][self._slot_indices[islot]]
+        return Angle(self._cell('rotang_start', islot, tname), u.deg)
     
     def rotang_end(self, islot, tname):
-        return self._rot_angle_at_end[self._target_indices[tname]][self._slot_indices[islot]]
+        return Angle(self._cell('rotang_end', islot, tname), u.deg)
     
     def teff(self, islot, tname):
         if tname == 'dummy':
             return 0.0
         else:
-            return self._teff[self._target_indices[tname]][self._slot_indices[islot]]
+            return self._cell('teff', islot, tname)
     
+    def visible(self, islot, tname):
+        if tname == 'dummy':
+            return True
+        else:
+            return bool(self._visible[self._target_rows[tname]][self._slot_indices[islot]])
+
     def moon_sep(self, islot, tname):
-        return self._moon_sep[self._target_indices[tname]][self._slot_indices[islot]]
+        return Angle(self._cell('moon_sep', islot, tname), u.deg)
+
+    def moon_sep_min(self, tname, date):
+        return Angle(self._moon_sep_min[self._target_indices[tname]][self._night_indices[date]], u.deg)
 
     def moon_ill(self, islot):
         return self._moon_ill[self._slot_indices[islot]]
@@ -193,46 +498,177 @@ class ObservingConditions:
     def moon_phase(self, islot):
         return self._moon_phase[self._slot_indices[islot]]
 
+    def moon_values(self, slots, offsets=None):
+        """
+        スロットの月の輝面比と高度 (deg) を配列で返します。
+
+        Args:
+            slots: スロットのインデックス (slot.index)。
+            offsets (Quantity): 時刻のずれ。指定すると interpolate と同じく同じ夜の隣のスロットとの線形補間で返します。
+        """
+        cols = np.array([self._slot_indices[i] for i in np.atleast_1d(slots)], dtype=int)
+        values = [np.asarray(self._moon_ill), self._moon_altaz.alt.deg]
+        if offsets is None:
+            return tuple(v[cols] for v in values)
+        neighbours, frac = self._interpolation_weights(cols, np.atleast_1d(offsets.to(u.day).value))
+        return tuple(v[cols] + frac * (v[neighbours] - v[cols]) for v in values)
+
     def planet_sep(self, name, islot, tname):
         if name not in self._planet_seps:
             raise ValueError(f"Planet {name} not found.")
-        return self._planet_seps[name][self._target_indices[tname]][self._slot_indices[islot]]
-
-    def calc_slewTime(self, uniq_id):
-        # Load the slew time from a pickle file if available
-        try:
-            with open(f'slew_time_{uniq_id}.pkl', 'rb') as f:
-                self._slewTime = pickle.load(f)
-                logger.info(f"Slew time loaded from file: slew_time_{uniq_id}.pkl")
-            return
-        except FileNotFoundError:
-            logger.info(f"Slew time file slew_time_{uniq_id}.pkl not found. Calculating slew time.")
-
-            pbar = tqdm(total=self.targetList.num_targets * self.targetList.num_targets * (self.obsSlotList.num_slots-1), desc="Calculating slew time")
-
-            self._slewTime = create_3d_array(self.targetList.num_targets, self.targetList.num_targets, self.obsSlotList.num_slots-1)
-        
-            for j in range(self.obsSlotList.num_slots-1):
-                if self.obsSlotList[j].date != self.obsSlotList[j+1].date:
-                    continue
-                for i1 in range(self.targetList.num_targets):
-                    for i2 in range(self.targetList.num_targets):
-                        cur_altaz = self._altaz[i1][j]
-                        cur_rotang = self._rot_angle_at_end[i1][j]
-                        tgt_altaz = self._altaz[i2][j+1]
-                        tgt_rotang = self._rot_angle_at_start[i2][j+1]
-
-                        self._slewTime[i1][i2][j] = slewTime(cur_altaz, cur_rotang, tgt_altaz, tgt_rotang, self.params)
-
-                        pbar.update(1)
-            pbar.close()
-
-            # Save the slew time to a pickle file for future use
-            try:
-                with open(f'slew_time_{uniq_id}.pkl', 'wb') as f:
-                    pickle.dump(self._slewTime, f)
-            except Exception as e:
-                logger.error(f"Error saving slew time to slew_time_{uniq_id}.pkl: {e}")
+        return Angle(self._planet_seps[name][self._target_indices[tname]][self._slot_indices[islot]], u.deg)
+
+    def planet_sep_min(self, name, tname, date):
+        if name not in self._planet_seps_min:
+            raise ValueError(f"Planet {name} not found.")
+        return Angle(self._planet_seps_min[name][self._target_indices[tname]][self._night_indices[date]], u.deg)
+
+    def _night_min(self, values):
+        # Minimum over the slots of each night for each row of a (pointing, slot) array
+        result = np.empty((values.shape[0], len(self._night_starts)))
+        for b0 in range(0, values.shape[0], self._block_size):
+            block = np.asarray(values[b0:b0 + self._block_size])
+            result[b0:b0 + self._block_size] = np.minimum.reduceat(block[:, self._night_order], self._night_starts, axis=1)
+        return result
+
+    def slew_time(self, islot, tname1, tname2):
+        """
+        スロット islot の終了時の tname1 から次のスロットの開始時の tname2 までのスリュー時間を返します。
+        次のスロットが同じ夜にない場合は None。
+        """
+        slew_time = self.slew.slew_times(islot, tname1, tname2)
+        return None if np.isnan(slew_time) else slew_time
+
+    def slew_times(self, slots, from_targets, to_targets):
+        return self.slew.slew_times(slots, from_targets, to_targets)
+
+    def interpolate(self, name, slots, tnames, offsets):
+        """
+        スロットの時刻を offsets だけずらした時の値を、同じ夜の隣のスロットとの線形補間で返します。
+        夜の最後のスロットでは前のスロットから外挿します。角度は折り返しを考慮します。
+
+        Args:
+            name (str): グリッド名 (GRID_NAMES)。
+            slots: スロットのインデックス (slot.index)。
+            tnames: ターゲット名。
+            offsets (Quantity): 時刻のずれ。
+
+        Returns:
+            ndarray: 補間した値。
+        """
+        slots, tnames, offsets = np.broadcast_arrays(np.asarray(slots), np.asarray(tnames, dtype=object),
+                                                     np.asarray(offsets.to(u.day).value))
+        cols = np.array([self._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows = np.array([self._target_indices[t] for t in tnames.ravel()], dtype=int)
+        if len(cols) == 0:
+            return np.zeros(slots.shape)
+
+        neighbours, frac = self._interpolation_weights(cols, offsets.ravel())
+        v0 = self._grids[name][rows, cols]
+        diff = self._grids[name][rows, neighbours] - v0
+        period = GRID_PERIODS.get(name)
+        if period is not None:
+            diff = np.mod(diff + 0.5 * period, period) - 0.5 * period
+        values = v0 + frac * diff
+        # Wrap the angles back into the range of the grids (the hour angle is kept on the branch of the slot)
+        if name == 'az':
+            values = np.mod(values, 360.0)
+        elif name in ('rotang_start', 'rotang_end'):
+            values = np.mod(values + 180.0, 360.0) - 180.0
+        return values.reshape(slots.shape)
+
+    def _interpolation_weights(self, cols, offsets):
+        # Neighbouring slot of the same night (the column itself for a night of a single slot)
+        # and the fraction of the interval to it for the offsets (days)
+        next_cols = self.slew._next
+        prev_cols = np.full(len(next_cols), -1, dtype=int)
+        prev_cols[next_cols[next_cols >= 0]] = np.flatnonzero(next_cols >= 0)
+        neighbours = np.where(next_cols[cols] >= 0, next_cols[cols], prev_cols[cols])
+        neighbours = np.where(neighbours >= 0, neighbours, cols)
+        dt = self._slot_mid[neighbours] - self._slot_mid[cols]
+        frac = np.divide(offsets, dt, out=np.zeros(len(cols)), where=dt != 0)
+        return neighbours, frac
+
+class SlewModel:
+    """
+    Slew time between consecutive slots, computed on demand from the ObservingConditions grids.
+
+    slew_times() evaluates arbitrary (slot, from_target, to_target) transitions with NumPy.
+    transitions() returns the matrix between the pointings visible in a slot and in the next
+    one, memoized with an LRU cache, for users that need all the feasible transitions of a slot.
+    """
+
+    def __init__(self, oc, params, maxsize=256):
+        self.oc = oc
+        self.params = params
+
+        # Column of the next slot in the same night, -1 at the end of each night
+        slots = oc.obsSlotList.get_all_slots()
+        self._next = np.full(len(slots), -1, dtype=int)
+        for j in range(len(slots)-1):
+            if slots[j].date == slots[j+1].date:
+                self._next[j] = j + 1
+
+        self.transitions = lru_cache(maxsize=maxsize)(self._transitions)
+
+    def _slew_times(self, rows_from, cols_from, rows_to, cols_to):
+        grids = self.oc._grids
+        return slew_times_deg(grids['az'][rows_from, cols_from], grids['alt'][rows_from, cols_from],
+                              grids['rotang_end'][rows_from, cols_from],
+                              grids['az'][rows_to, cols_to], grids['alt'][rows_to, cols_to],
+                              grids['rotang_start'][rows_to, cols_to], self.params)
+
+    def slew_times(self, slots, from_targets, to_targets):
+        """
+        スロットの終了時のターゲットから次のスロットの開始時のターゲットまでのスリュー時間を計算します。
+        引数はブロードキャストされます。
+
+        Args:
+            slots: 遷移元のスロットのインデックス (slot.index)。
+            from_targets: 遷移元のターゲット名。
+            to_targets: 遷移先のターゲット名。
+
+        Returns:
+            Quantity: スリュー時間 (分)。次のスロットが同じ夜にない場合は NaN。
+        """
+        slots, from_targets, to_targets = np.broadcast_arrays(np.asarray(slots), np.asarray(from_targets, dtype=object),
+                                                              np.asarray(to_targets, dtype=object))
+        cols = np.array([self.oc._slot_indices[i] for i in slots.ravel()], dtype=int)
+        rows_from = np.array([self.oc._target_indices[t] for t in from_targets.ravel()], dtype=int)
+        rows_to = np.array([self.oc._target_indices[t] for t in to_targets.ravel()], dtype=int)
+        cols_to = self._next[cols] if len(cols) else cols
+
+        values = np.full(len(cols), np.nan)
+        valid = cols_to >= 0
+        values[valid] = self._slew_times(rows_from[valid], cols[valid], rows_to[valid], cols_to[valid])
+        return values.reshape(slots.shape) * u.minute
+
+    def _transitions(self, islot):
+        """
+        スロット islot とその次のスロットの両方で観測可能なポインティングの間のスリュー時間を計算します。
+
+        Returns:
+            tuple: 遷移元と遷移先のポインティングの行番号、スリュー時間 (分) の行列。次のスロットがない場合は None。
+        """
+        j = self.oc._slot_indices[islot]
+        if self._next[j] < 0:
+            return None
+        rows_from = np.flatnonzero(self.oc._visible_pointings[:, j])
+        rows_to = np.flatnonzero(self.oc._visible_pointings[:, self._next[j]])
+        values = self._slew_times(rows_from[:, np.newaxis], j, rows_to[np.newaxis, :], self._next[j])
+        return rows_from, rows_to, values.astype(np.float32)
+
+def slew_times_deg(cur_az, cur_alt, cur_rotang, tgt_az, tgt_alt, tgt_rotang, params):
+    """
+    slewTime をベクトル化したものです。角度は deg の配列で与え、スリュー時間 (分) の配列を返します。
+    """
+    az_diff = np.mod(tgt_az - cur_az + 180.0, 360.0) - 180.0
+    el_diff = tgt_alt - cur_alt
+    rot_diff = tgt_rotang - cur_rotang
+
+    slew_time = np.maximum(np.abs(az_diff) / params.slew_speed_az.to(u.deg / u.minute).value,
+                           np.abs(el_diff) / params.slew_speed_el.to(u.deg / u.minute).value)
+    return np.maximum(slew_time, np.abs(rot_diff) / params.inst_rot_speed.to(u.deg / u.minute).value)
 
 def slewTime(cur_altaz, cur_rotang, tgt_altaz, tgt_rotang, params):
     """
@@ -255,25 +691,3 @@ def slewTime(cur_altaz, cur_rotang, tgt_altaz, tgt_rotang, params):
                     abs(rot_diff) / rate_rot)
 
     return slew_time
-    
-def create_3d_array(depth, height, width, initial_value=None):
-    """
-    指定された次元数の3次元配列を作成します。
-
-    Args:
-        depth (int): 奥行きの次元数。
-        height (int): 高さの次元数。
-        width (int): 幅の次元数。
-        initial_value: 配列の初期値。デフォルトは None。
-
-    Returns:
-        list: 3次元配列。
-    """
-    array_3d = []
-    for _ in range(depth):
-        array_2d = []
-        for _ in range(height):
-            array_1d = [initial_value] * width
-            array_2d.append(array_1d)
-        array_3d.append(array_2d)
-    return array_3d
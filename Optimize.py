@@ -1,11 +1,19 @@
-from pulp import LpVariable, LpProblem, LpMaximize, lpSum, LpStatus, PULP_CBC_CMD
-from Targets import Target
+from pulp import LpVariable, LpProblem, LpMaximize, lpSum, LpStatus, LpSolution, PULP_CBC_CMD, value
+from pulp import LpSolutionOptimal, LpSolutionIntegerFeasible
+from Targets import Target, TargetField, aggregate_fields
+from Profiling import span, profiled
+import astropy.units as u
+import numpy as np
 import pprint
 import logging
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Rotator limits (degrees) for each WG
+ROTANG_MIN = {'CO': -164, 'GE': -164, 'GA': -164}
+ROTANG_MAX = {'CO':  164, 'GE':  164, 'GA':  164}
+
 def split_into_continuous_sequences(numbers):
     """
     Split a list of integers into sublists of continuous sequences.
@@ -41,16 +49,125 @@ def split_into_continuous_sequences(numbers):
         
     return result
 
-# Define the optimazation problem
-def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, priority=-1):
+@profiled()
+def feasible_mask(oc, params, observer, slots, targets, rotang_min=ROTANG_MIN, rotang_max=ROTANG_MAX):
+    """
+    各スロットで各ターゲットが全ての観測条件 (OptimizeSchedule の制約) を満たすかを判定します。
 
-    dummy = Target('dummy', 'dummy', None, None, obsSlotList.num_slots, 10, 0)
+    Args:
+        oc: ObservingConditions オブジェクト
+        params: Params オブジェクト
+        observer: MyObserver オブジェクト
+        slots (list): ObsSlot のリスト。
+        targets (list): Target のリスト (dummy を除く)。
+
+    Returns:
+        ndarray: 形状 (slot, target) の bool 配列。
+    """
+    if not slots or not targets:
+        return np.zeros((len(slots), len(targets)), dtype=bool)
+    islots = np.array([slot.index for slot in slots])[:, np.newaxis]
+    names = np.array([t.name for t in targets], dtype=object)[np.newaxis, :]
+
+    feasible = oc.visible_mask(islots, names)
+    feasible &= oc.values('moon_sep', islots, names) >= params.moonsep['limit'].to(u.deg).value
+    for planet in ["mars", "jupiter", "saturn"]:
+        feasible &= oc.values(f'{planet}_sep', islots, names) >= params.planetssep['limit'].to(u.deg).value
+    feasible &= oc.values('airmass', islots, names) <= np.array([params.airmass['limit'][t.wg] for t in targets])
+    is_north = np.array([t.coord.dec > observer.location.lat for t in targets])
+    feasible &= ~is_north | (np.abs(oc.values('ha', islots, names)) >= params.meridian['warn'].to(u.hourangle).value)
+    for name in ['rotang_start', 'rotang_end']:
+        rotang = oc.values(name, islots, names)
+        feasible &= (rotang >= np.array([rotang_min[t.wg] for t in targets])) \
+            & (rotang <= np.array([rotang_max[t.wg] for t in targets]))
+    return feasible
+
+def adjacent_pairs(obs_slots):
+    """
+    obs_slots の中で時間的に隣り合うスロットの組 (同じ夜で slot.index が連続するもの) を返します。
+    前の priority で埋まったスロットの前後は組になりません。
+
+    Returns:
+        list: (slot1, slot2) のリスト。
+    """
+    return [(slot1, slot2) for slot1, slot2 in zip(obs_slots[:-1], obs_slots[1:])
+            if slot1.date == slot2.date and slot2.index == slot1.index + 1]
+
+@profiled()
+def slew_transitions(obs_slots, targets, oc, params, observer, rotang_min, rotang_max):
+    """
+    連続するスロットの組について、両方のスロットで観測可能なターゲットの間の遷移とスリュー時間を返します。
+
+    Returns:
+        dict: (slot.index, target1.name, target2.name) をキー、スリュー時間 (分) を値とする辞書。
+    """
+    mask = feasible_mask(oc, params, observer, obs_slots, targets, rotang_min, rotang_max)
+    feasible = {slot.index: [t.name for t, ok in zip(targets, row) if ok] for slot, row in zip(obs_slots, mask)}
+
+    keys = []
+    for slot1, slot2 in adjacent_pairs(obs_slots):
+        keys += [(slot1.index, t1, t2) for t1 in feasible[slot1.index] for t2 in feasible[slot2.index]]
+    if not keys:
+        return {}
 
+    slots, names1, names2 = zip(*keys)
+    slew_times = oc.slew_times(list(slots), list(names1), list(names2)).to(u.minute).value
+    # NaN: the slots are not consecutive in the night
+    return {key: value for key, value in zip(keys, slew_times) if not np.isnan(value)}
+
+def record_solution(record, prob):
+    """
+    プロファイル中であれば、解いた問題の状態・解の状態・目的関数の値・変数と制約の数を solve の範囲に記録します。
+    時間制限で止まった解は status が Optimal のままなので、最適かどうかは solution で判定します。
+    """
+    if record is not None:
+        record.setdefault('args', {}).update(status=LpStatus[prob.status], solution=LpSolution[prob.sol_status],
+                                             objective=value(prob.objective),
+                                             variables=prob.numVariables(), constraints=prob.numConstraints())
+
+def select_targets(targetList, oc, params, priority=-1):
+    """
+    最適化の対象とするターゲットを選びます。aggregate_GA の場合は GA のフィールドをまとめます。
+    """
     if priority == -1:
         targets = targetList.get_all_targets()
     else:        
         targets = targetList.get_observing_targets_by_priority(priority)
     logger.info(f'Total {len(targets)} targets available for priority targets (priority <= {priority})')
+    if params.aggregate_GA:
+        # The GA sub-pointings of a field share the pointing: optimize the field as a single target
+        targets = aggregate_fields(targets)
+        for t in targets:
+            if isinstance(t, TargetField):
+                oc.add_alias(t.name, t.members[0].name)
+        logger.info(f'Total {len(targets)} targets after aggregating the GA fields')
+    return targets
+
+# Define the optimazation problem
+@profiled()
+def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, priority=-1,
+                     obs_slots=None, wg_allowed=None, target_limits=None, wg_limits=None):
+    """
+    観測スケジュールを最適化します。
+
+    params.coarse_block が設定されている場合は OptimizeScheduleCoarseToFine で二段階に解きます。
+    以下の引数はその夜ごとの詳細化で使います。
+
+    Args:
+        obs_slots (list): 最適化するスロット。None の場合は必要な数の空きスロット。
+        wg_allowed (dict): スロットのインデックスをキー、そのスロットで観測できる WG の集合を値とする辞書。
+        target_limits (dict): ターゲット名をキー、この最適化での観測数の上限を値とする辞書。
+        wg_limits (dict): WG をキー、この最適化での観測数の上限を値とする辞書。
+
+    Returns:
+        tuple: 変数 o、最適化したスロット、ターゲット、dummy ターゲット。
+    """
+    if params.coarse_block and obs_slots is None:
+        return OptimizeScheduleCoarseToFine(obsSlotList, targetList, oc, params, observer, nexp_max, priority)
+
+    dummy = Target('dummy', 'dummy', None, None, obsSlotList.num_slots, 10, 0)
+
+    targets = select_targets(targetList, oc, params, priority)
     for wg in targetList.wg_list:
         logger.info(f"  WG {wg}: {[t.name for t in targets if t.wg == wg]}")
     targets_with_dummy = targets + [dummy]
@@ -59,7 +176,8 @@ def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, pr
     nslot_required = sum([(t.nexp - t.observed) for t in targets])
     logger.info(f'Total {nslot_required} slots required for priority targets (priority <= {priority})')
 
-    obs_slots = obsSlotList.get_available_slots(nslot_required)
+    if obs_slots is None:
+        obs_slots = obsSlotList.get_available_slots(nslot_required)
     logger.info(f'Total {len(obs_slots)} slots available for priority targets (priority <= {priority})')
     
     dates_utc = list(set([slot.start.strftime('%Y-%m-%d') for slot in obs_slots]))
@@ -77,16 +195,40 @@ def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, pr
     # Define the Variable : y[date, target] = 1 if the obsevation of the target is completed on the date
     y = LpVariable.dicts('y', [(date, t.name) for date in dates_utc for t in targets_with_dummy], cat='Binary')
 
+    rotang_min = ROTANG_MIN
+    rotang_max = ROTANG_MAX
+
     # Objective function: maximize the sum of the effective exposure time of the targets that are observed
-    prob += lpSum([o[(slot.index, t.name)] * oc.teff(slot.index, t.name) for slot in obs_slots for t in targets_with_dummy]) \
+    objective = lpSum([o[(slot.index, t.name)] * oc.teff(slot.index, t.name) for slot in obs_slots for t in targets_with_dummy]) \
             + params.weight_comp * lpSum([y[(date, t.name)] for date in dates_utc for t in targets_with_dummy]) \
-            - params.weight_pri * lpSum([t.priority * o[(slot.index, t.name)] for slot in obs_slots for t in targets]) \
-            #- weight_slew * lpSum([x[(obs_slots[j].index, t1.name, t2.name)] * slewTime[(obs_slots[j].index, t1.name, t2.name)].to(u.minute).value for j in range(len(obs_slots)-1) if obs_slots[j]['date'] == obs_slots[j+1]['date'] for t1 in targets_with_dummy for t2 in targets_with_dummy])  # - slew time
-            #- weight_slew * lpSum([o[(obs_slots[j].index, t1.name)] * o[(obs_slots[j+1].index, t2.name)] * slewTime[(obs_slots[j].index, t1.name, t2.name)].to(u.minute).value for j in range(len(obs_slots)-1) if obs_slots[j]['date'] == obs_slots[j+1]['date'] for t1 in targets_with_dummy for t2 in targets_with_dummy])  # - slew time
+            - params.weight_pri * lpSum([t.priority * o[(slot.index, t.name)] for slot in obs_slots for t in targets])
+
+    # Slew time penalty, linearized with x[slot, t1, t2] >= o[slot, t1] + o[next slot, t2] - 1
+    # Only the transitions between the targets feasible in both slots are considered
+    # (the transitions from/to the dummy target cost nothing)
+    if params.weight_slew:
+        slew_times = slew_transitions(obs_slots, targets, oc, params, observer, rotang_min, rotang_max)
+        logger.info(f"Slew penalty: {len(slew_times)} transitions (weight_slew = {params.weight_slew})")
+        next_slot = {slot1.index: slot2.index for slot1, slot2 in adjacent_pairs(obs_slots)}
+        x = LpVariable.dicts('x', list(slew_times.keys()), lowBound=0, upBound=1)
+        for (islot, t1, t2) in slew_times:
+            prob += x[(islot, t1, t2)] >= o[(islot, t1)] + o[(next_slot[islot], t2)] - 1
+        objective -= params.weight_slew * lpSum([x[key] * slew_time for key, slew_time in slew_times.items()])
+
+    prob += objective
 
     # Constraints: each target is observed at most nexp times
     for t in targets_with_dummy:
         prob += lpSum([o[(slot.index, t.name)] for slot in obs_slots]) + t.observed <= t.nexp
+        if target_limits is not None and t.name != dummy.name:
+            prob += lpSum([o[(slot.index, t.name)] for slot in obs_slots]) <= target_limits.get(t.name, 0)
+
+    # Constraints: only the targets of the WGs allowed in the slot (or the dummy target) can be observed
+    if wg_allowed is not None:
+        for slot in obs_slots:
+            for t in targets:
+                if t.wg not in wg_allowed.get(slot.index, ()):
+                    o[(slot.index, t.name)].upBound = 0
 
     # Constraints: y = 1 if the target is observed nexp times on the date
     for date in dates_utc:
@@ -101,6 +243,9 @@ def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, pr
     for w in targetList.wg_list:
         prob += lpSum([o[(slot.index, t.name)] for t in targets if t.wg == w for slot in obs_slots]) \
             <= nexp_max[w] - targetList.nexp_wg_finished[w]
+        if wg_limits is not None:
+            prob += lpSum([o[(slot.index, t.name)] for t in targets if t.wg == w for slot in obs_slots]) \
+                <= wg_limits.get(w, 0)
     
     # Variable indicating whether each WG targets are observed (True) or not (False) at each timeslot
     wg_obs = LpVariable.dicts('wg_obs', [(date, i, w) for date in dates_utc for i in slots_by_date[date] for w in wg_list_with_dummy], cat='Bianry')
@@ -239,18 +384,24 @@ def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, pr
     #
     ######################################################################################################################
 
-    rotang_min = {'CO': -164, 'GE': -164, 'GA': -164}
-    rotang_max = {'CO':  164, 'GE':  164, 'GA':  164}
     for slot in obs_slots:
         for t in targets:
+            # Targets outside their visibility window cannot be observed: no need for the other constraints
+            if not oc.visible(slot.index, t.name):
+                o[(slot.index, t.name)].upBound = 0
+                continue
+
             # Constraints: the moon is at least 60 degrees away from each target
-            prob += oc.moon_sep(slot.index, t.name).degree * o[(slot.index, t.name)] \
-                >= params.moonsep['limit'].value * o[(slot.index, t.name)]
+            # (always satisfied if the minimum separation of the night is above the limit)
+            if oc.moon_sep_min(t.name, slot.date) < params.moonsep['limit']:
+                prob += oc.moon_sep(slot.index, t.name).degree * o[(slot.index, t.name)] \
+                    >= params.moonsep['limit'].value * o[(slot.index, t.name)]
 
             # Constraints: the Mars is at least 10 degrees away from each target
             for planet in ["mars", "jupiter", "saturn"]:
-                prob += oc.planet_sep(planet, slot.index, t.name).degree * o[(slot.index, t.name)] \
-                    >= params.planetssep['limit'].value * o[(slot.index, t.name)]
+                if oc.planet_sep_min(planet, t.name, slot.date) < params.planetssep['limit']:
+                    prob += oc.planet_sep(planet, slot.index, t.name).degree * o[(slot.index, t.name)] \
+                        >= params.planetssep['limit'].value * o[(slot.index, t.name)]
             
             # Constraints: the airmass is less than the limit
             prob += oc.airmass(slot.index, t.name).value * o[(slot.index, t.name)] \
@@ -271,8 +422,170 @@ def OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, pr
                 <= rotang_max[t.wg] * o[(slot.index, t.name)]
             
     # Solve the problem
-    prob.solve(PULP_CBC_CMD(msg=0, threads=8))
+    with span('solve') as record:
+        prob.solve(PULP_CBC_CMD(msg=0, threads=8, timeLimit=params.solver_time_limit))
+    record_solution(record, prob)
 
     logger.info(f"Optimization status: {LpStatus[prob.status]}")
 
     return o, obs_slots, targets, dummy
+
+def coarse_blocks(obs_slots, block_size):
+    """
+    各夜の連続したスロットを block_size 個ずつのブロックに分けます。
+
+    Returns:
+        list: スロットのリストのリスト (夜・時刻の順)。
+    """
+    blocks = []
+    slots_by_index = {slot.index: slot for slot in obs_slots}
+    for date in dict.fromkeys(slot.date for slot in obs_slots):
+        indices = [slot.index for slot in obs_slots if slot.date == date]
+        for sub_slot in split_into_continuous_sequences(indices):
+            for i0 in range(0, len(sub_slot), block_size):
+                blocks.append([slots_by_index[i] for i in sub_slot[i0:i0 + block_size]])
+    return blocks
+
+def count_exposures(o, obs_slots, targets):
+    """
+    最適化の結果で観測されるスロットの数を返します。
+    """
+    return sum(1 for slot in obs_slots for t in targets if (o[(slot.index, t.name)].varValue or 0.0) > 0.5)
+
+@profiled()
+def OptimizeScheduleCoarseToFine(obsSlotList, targetList, oc, params, observer, nexp_max, priority=-1):
+    """
+    二段階 (粗い時間分解能から細かい時間分解能) でスケジュールを最適化します。
+
+    1. params.coarse_block 個の連続したスロットを 1 ブロックとし、各ブロックを観測する WG と
+       各ターゲットの露出数をブロック単位で決めます (変数はスロット単位の数分の一)。
+    2. 夜ごとに、ブロックの WG と 1 で決めた露出数を上限として、スロット単位で OptimizeSchedule を解きます。
+
+    Returns:
+        tuple: OptimizeSchedule と同じ (o, obs_slots, targets, dummy)。
+    """
+    targets = select_targets(targetList, oc, params, priority)
+    nslot_required = sum([(t.nexp - t.observed) for t in targets])
+    obs_slots = obsSlotList.get_available_slots(nslot_required)
+    blocks = coarse_blocks(obs_slots, params.coarse_block)
+    wg_list_with_dummy = targetList.wg_list + ['dummy']
+    logger.info(f"Coarse model: {len(blocks)} blocks of up to {params.coarse_block} slots for {len(obs_slots)} slots")
+
+    # Number of feasible slots and mean effective exposure time of each target in each block
+    feasible = feasible_mask(oc, params, observer, obs_slots, targets)
+    teff = oc.values('teff', np.array([slot.index for slot in obs_slots])[:, np.newaxis],
+                     np.array([t.name for t in targets], dtype=object)[np.newaxis, :]) if targets else feasible * 0.0
+    position = {slot.index: k for k, slot in enumerate(obs_slots)}
+    capacity = {}
+    teff_mean = {}
+    for b, block in enumerate(blocks):
+        rows = [position[slot.index] for slot in block]
+        n_feasible = feasible[rows].sum(axis=0)
+        teff_sum = np.where(feasible[rows], teff[rows], 0.0).sum(axis=0)
+        for k, t in enumerate(targets):
+            if n_feasible[k] > 0:
+                capacity[(b, t.name)] = int(n_feasible[k])
+                teff_mean[(b, t.name)] = teff_sum[k] / n_feasible[k]
+
+    prob = LpProblem("ObservingPlanCoarse", LpMaximize)
+
+    # z[block, wg] = 1 if the block is given to the WG, q[block, target] = number of exposures in the block
+    z = LpVariable.dicts('z', [(b, w) for b in range(len(blocks)) for w in wg_list_with_dummy], cat='Binary')
+    q = LpVariable.dicts('q', list(capacity.keys()), lowBound=0, cat='Integer')
+    for key, value in capacity.items():
+        q[key].upBound = value
+
+    prob += lpSum([q[key] * teff_mean[key] for key in q]) \
+        - params.weight_pri * lpSum([t.priority * q[(b, t.name)] for b in range(len(blocks)) for t in targets
+                                     if (b, t.name) in q])
+
+    # Exposures of a WG in a block are limited by the slots where any of its targets is feasible
+    for b, block in enumerate(blocks):
+        rows = [position[slot.index] for slot in block]
+        prob += lpSum([z[(b, w)] for w in wg_list_with_dummy]) == 1
+        for w in targetList.wg_list:
+            cover = int(np.any(feasible[rows][:, [k for k, t in enumerate(targets) if t.wg == w]], axis=1).sum())
+            prob += lpSum([q[(b, t.name)] for t in targets if t.wg == w and (b, t.name) in q]) <= cover * z[(b, w)]
+
+    # Each WG keeps the blocks for at least n_continuous slots, as in the slot-level model
+    s = LpVariable.dicts('s', [(b, w) for b in range(len(blocks)) for w in wg_list_with_dummy], lowBound=0, upBound=1)
+    for b, block in enumerate(blocks):
+        first = b == 0 or blocks[b-1][0].date != block[0].date or blocks[b-1][-1].index + 1 != block[0].index
+        for w in wg_list_with_dummy:
+            prob += s[(b, w)] >= z[(b, w)] - (0 if first else z[(b-1, w)])
+            n_blocks = -(-params.n_continuous[w] // params.coarse_block)
+            for j in range(1, n_blocks):
+                if b + j < len(blocks) and blocks[b+j][0].date == block[0].date \
+                        and blocks[b+j-1][-1].index + 1 == blocks[b+j][0].index:
+                    prob += z[(b+j, w)] >= s[(b, w)]
+
+    for t in targets:
+        prob += lpSum([q[(b, t.name)] for b in range(len(blocks)) if (b, t.name) in q]) + t.observed <= t.nexp
+
+    for w in targetList.wg_list:
+        prob += lpSum([q[key] for key in q for t in targets if t.wg == w and key[1] == t.name]) \
+            <= nexp_max[w] - targetList.nexp_wg_finished[w]
+
+    # GA blocks are the last ones of the night
+    if params.GA_last and 'GA' in targetList.wg_list:
+        for b1 in range(len(blocks)):
+            for b2 in range(b1):
+                if blocks[b1][0].date == blocks[b2][0].date:
+                    prob += z[(b1, 'GA')] >= z[(b2, 'GA')]
+
+    with span('solve') as record:
+        prob.solve(PULP_CBC_CMD(msg=0, threads=8, timeLimit=params.solver_time_limit))
+    record_solution(record, prob)
+    logger.info(f"Coarse optimization status: {LpStatus[prob.status]}")
+
+    # Without a solution (infeasible, or no solution within solver_time_limit) the blocks would all go
+    # to the first WG with no exposure planned: solve the slots at the slot resolution instead
+    if prob.sol_status not in (LpSolutionOptimal, LpSolutionIntegerFeasible):
+        logger.warning(f"Coarse model not solved ({LpSolution[prob.sol_status]}): "
+                       f"optimizing the {len(obs_slots)} slots without the coarse blocks")
+        return OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max, priority, obs_slots=obs_slots)
+
+    # Refine each night at the slot resolution with the WG of each block fixed.
+    # The slots of a block may also be used by the WGs of the adjacent blocks, so that the boundaries
+    # between the WGs can move to the edges of the feasible windows, which the blocks do not resolve.
+    owners = [max(wg_list_with_dummy, key=lambda w: z[(b, w)].varValue or 0.0) for b in range(len(blocks))]
+    o = {}
+    dummy = None
+    for date in dict.fromkeys(slot.date for slot in obs_slots):
+        night_blocks = [b for b, block in enumerate(blocks) if block[0].date == date]
+        wg_allowed = {}
+        for b in night_blocks:
+            allowed = {owners[b]}
+            if b > 0 and blocks[b-1][0].date == date:
+                allowed.add(owners[b-1])
+            if b + 1 < len(blocks) and blocks[b+1][0].date == date:
+                allowed.add(owners[b+1])
+            wg_allowed.update({slot.index: allowed for slot in blocks[b]})
+        target_limits = {t.name: int(round(sum(q[(b, t.name)].varValue or 0.0 for b in night_blocks if (b, t.name) in q)))
+                         for t in targets}
+        wg_limits = {w: sum(target_limits[t.name] for t in targets if t.wg == w) for w in targetList.wg_list}
+        night_slots = [slot for b in night_blocks for slot in blocks[b]]
+        logger.info(f"Refining {date}: {len(night_slots)} slots, WG blocks {[owners[b] for b in night_blocks]}")
+
+        o_night, _, targets_night, dummy_night = OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max,
+                                                                  priority, obs_slots=night_slots, wg_allowed=wg_allowed,
+                                                                  target_limits=target_limits, wg_limits=wg_limits)
+
+        # The blocks give the numbers of feasible slots but not their contiguity: if the night cannot
+        # realize the coarse plan, it is also solved with the WG blocks released and the better plan is kept
+        n_planned = sum(target_limits.values())
+        n_refined = count_exposures(o_night, night_slots, targets_night)
+        if n_refined < n_planned:
+            o_free, _, targets_free, dummy_free = OptimizeSchedule(obsSlotList, targetList, oc, params, observer, nexp_max,
+                                                                   priority, obs_slots=night_slots,
+                                                                   target_limits=target_limits, wg_limits=wg_limits)
+            n_free = count_exposures(o_free, night_slots, targets_free)
+            logger.info(f"Refining {date}: {n_refined} of {n_planned} exposures placed with the WG blocks, {n_free} without")
+            if n_free > n_refined:
+                o_night, dummy_night = o_free, dummy_free
+        o.update(o_night)
+        dummy = dummy or dummy_night
+
+    if dummy is None:
+        dummy = Target('dummy', 'dummy', None, None, obsSlotList.num_slots, 10, 0)
+    return o, obs_slots, targets, dummy
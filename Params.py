@@ -28,7 +28,23 @@ class Params:
     @property
     def fname_report(self):
         return self.params.get('fname_report', None)
+
+    @property
+    def fname_cache(self):
+        return self.params.get('fname_cache', 'sspplan_cache.pickle')
+    
+    @property
+    def fname_schedule(self):
+        return self.params.get('fname_schedule', 'obsplan.ecsv')
+
+    @property
+    def fname_conditions(self):
+        return self.params.get('fname_conditions', 'conditions.npz')
     
+    @property
+    def dir_checkpoint(self):
+        return self.params.get('dir_checkpoint', 'checkpoints')
+
     @property
     def frac(self):
         return self.params.get('frac', None)
@@ -41,6 +57,14 @@ class Params:
     def GA_last(self):
         return self.params.get('GA_last', None)
     
+    @property
+    def aggregate_GA(self):
+        return self.params.get('aggregate_GA', False)
+
+    @property
+    def coarse_block(self):
+        return self.params.get('coarse_block', None)
+
     @property
     def n_continuous(self):
         return self.params.get('n_continuous', None)
@@ -93,6 +117,10 @@ class Params:
     def weight_pri(self):
         return self.params.get('weight_pri', None)
 
+    @property
+    def weight_slew(self):
+        return self.params.get('weight_slew', None)
+
     @property
     def slew_speed_az(self):
         return self.params.get('slew_speed_az', None) * u.degree / u.second
@@ -103,4 +131,24 @@ class Params:
     
     @property
     def inst_rot_speed(self):
-        return self.params.get('inst_rot_speed', None) * u.degree / u.second
\ No newline at end of file
+        return self.params.get('inst_rot_speed', None) * u.degree / u.second
+
+    @property
+    def solver_time_limit(self):
+        return self.params.get('solver_time_limit', None)
+
+    @property
+    def ephemeris_step(self):
+        _ = self.params.get('ephemeris_step', None)
+        if _ is None:
+            return None
+        return {key: value * u.hour for key, value in _.items()}
+
+    @property
+    def ephemeris_tolerance(self):
+        _ = self.params.get('ephemeris_tolerance', None)
+        return _ * u.degree if _ is not None else None
+
+    @property
+    def memory_budget(self):
+        return self.params.get('memory_budget', None)
@@ -1,9 +1,13 @@
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend: the figures are only saved to files
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
-import datetime
+import numpy as np
+from Profiling import profiled
 from astropy.time import Time
 import astropy.units as u
 from collections import OrderedDict
+import io
 
 
 # Define distinct colormaps for each wg
@@ -20,188 +24,224 @@ def get_color_for_point(wg, i, length):
         frac = 0.5
     return cmap_dict[wg](frac)
 
-def plotSchedule(schedule, dates, obscond, targetList, observer, priority=-1):
-    nrow = max(len(dates), 7)
-    fig, axes = plt.subplots(nrow, 1, figsize=(10, 7), sharex=True, sharey=True)
-
-    for k in range(len(dates)):
-        xx = list()
-        yy = list()
-        zz = list()
-        for slot in schedule.get_used_slots():
-            if slot.date != dates[k]:
-                continue
-            t = slot.target
-            tt = datetime.datetime.strptime((slot.mid+observer.utcoffset).iso[:-4], '%Y-%m-%d %H:%M:%S').time()
-            _tt = tt.hour + tt.minute/60
-            if _tt < 15:
-                _tt += 24
-            xx.append(_tt)
-            yy.append(obscond.altaz(slot.index, t.name).alt.deg)
-            zz.append(get_color_for_point(t.wg, targetList.wg_objects[t.wg].index(t.name), len(targetList.wg_objects[t.wg])))
+# Panels drawn by SchedulePlotter (the key is the file prefix): y label, y range, y ticks, position of the date label, red bands
+PANELS = {
+    'elevation': ('Elevation (degree)', (0, 90), range(0, 91, 30), 97, [(0, 30)]),
+    'rot_angle': ('Rot Angle (degree)', (-180, 180), range(-180, 181, 90), 185, [(-180, -174), (174, 180)]),
+    'hour_angle': ('Hour Angle (hour)', (-5, 5), range(-4, 6, 2), 5.06, [(-0.3, 0.3)]),
+}
 
-        xm = list()
-        ma = list()
-        for slot in schedule:
-            if slot.date != dates[k]:
-                continue
-            tt = datetime.datetime.strptime((slot.mid+observer.utcoffset).iso[:-4], '%Y-%m-%d %H:%M:%S').time()
-            _tt = tt.hour + tt.minute/60
-            if _tt < 15:
-                _tt += 24
-            xm.append(_tt)
-            ma.append(obscond.moon_altaz(slot.index).alt.deg)
-                
-        axes[k].scatter(xx, yy, c=zz)
-        axes[k].plot(xm, ma, c='gray', linestyle='--')
-
-        time = Time(dates[k]+' 12:00:00') - observer.utcoffset
-        for _horizon in [-18, -12, -6, 0]:
-            sun_set = observer.sun_set_time(time, which='next', horizon=_horizon*u.degree)
-            sun_rise = observer.sun_rise_time(time, which='next', horizon=_horizon*u.degree)
-            _set = (sun_set+observer.utcoffset).datetime.hour + (sun_set+observer.utcoffset).datetime.minute/60
-            _rise = (sun_rise+observer.utcoffset).datetime.hour + (sun_rise+observer.utcoffset).datetime.minute/60
-            if _rise < 15:
-                _rise += 24
-            axes[k].axvspan(18, _set, color='gold', alpha=0.25)
-            axes[k].axvspan(_rise, 30, color='gold', alpha=0.25)
-
-        axes[k].set_yticks(range(0, 91, 30))
-        axes[k].set_xlim(18, 30)
-        axes[k].set_ylim(0, 90)
-        axes[k].text(18.05, 97, dates[k], fontsize=10)
-        axes[k].grid()
-        if k == len(dates)-1:
-            axes[k].set_xlabel('Time (HST)')
-
-        axes[k].fill_between([18,30], 0, 30, color='red', alpha=0.3)
-
-    for k in range(len(dates), nrow):
-        axes[k].axis('off')
-
-    fig.text(0.07, 0.5, 'Elevation (degree)', va='center', rotation='vertical')
-    
-    plt.subplots_adjust(hspace=0.4)
-
-    if priority >= 0:
-        plt.savefig(f'elevation_{priority}.png')
-    else:
-        plt.savefig(f'elevation.png')
+# Twilight horizons (degrees) shaded in the panels
+TWILIGHT_HORIZONS = [-18, -12, -6, 0]
+
+def save_png(fig, fname):
+    """
+    図を PNG に一度だけ描画し、ファイルに書いてバイト列を返します。
+    """
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    with open(fname, 'wb') as f:
+        f.write(buffer.getvalue())
+    return buffer.getvalue()
+
+def local_hours(jd, utcoffset):
+    """
+    時刻 (JD) をローカル時刻の時間 (15 時より前は 24 を加えて夜が連続するように) に変換します。
+    """
+    hours = np.mod(np.asarray(jd) - 0.5 + utcoffset.to(u.day).value, 1.0) * 24.0
+    return np.where(hours < 15, hours + 24, hours)
+
+class SchedulePlotter:
+    """
+    Draws the elevation, rotator angle and hour angle panels of a schedule.
+
+    The local times, colours and conditions of the scheduled slots are computed once per
+    schedule as arrays shared by the three panels, and the twilight times of each date are
+    computed once per plotter. The figures are created once per panel and cleared before each
+    redraw, so that plotting the successive stages does not accumulate figures; call close()
+    when done.
+    """
+
+    def __init__(self, observer):
+        self.observer = observer
+        self._twilights = {}
+        self._figures = {}
+
+    def twilights(self, dates):
+        """
+        各日付の薄明の時刻 (ローカル時刻の時間) を、TWILIGHT_HORIZONS の順の (日没, 日出) のリストで返します。
+        """
+        new_dates = [date for date in dates if date not in self._twilights]
+        if new_dates:
+            noon = Time([date+' 12:00:00' for date in new_dates]) - self.observer.utcoffset
+            spans = []
+            for horizon in TWILIGHT_HORIZONS:
+                sun_set = self.observer.sun_set_time(noon, which='next', horizon=horizon*u.degree)
+                sun_rise = self.observer.sun_rise_time(noon, which='next', horizon=horizon*u.degree)
+                # A single date gives scalar times
+                spans.append((np.atleast_1d(local_hours(sun_set.jd, self.observer.utcoffset)),
+                              np.atleast_1d(local_hours(sun_rise.jd, self.observer.utcoffset))))
+            for k, date in enumerate(new_dates):
+                self._twilights[date] = [(span[0][k], span[1][k]) for span in spans]
+        return [self._twilights[date] for date in dates]
+
+    def data(self, schedule, dates, obscond, targetList):
+        """
+        日付ごとに、使用スロットの時刻・色・高度・ローテーター角・時角と、全スロットの月の高度を配列で返します。
+        """
+        colors = {}
+        for wg, names in targetList.wg_objects.items():
+            for i, name in enumerate(names):
+                colors[name] = get_color_for_point(wg, i, len(names))
+
+        utcoffset = self.observer.utcoffset
+        data = []
+        for date in dates:
+            used = [slot for slot in schedule.get_used_slots() if slot.date == date]
+            slots = [slot for slot in schedule if slot.date == date]
+            islots = np.array([slot.index for slot in used], dtype=int)
+            names = np.array([slot.target.name for slot in used], dtype=object)
+            values = {name: obscond.values(name, islots, names) if len(used) else np.zeros(0)
+                      for name in ['alt', 'rotang_start', 'rotang_end', 'ha']}
+            moon_alt = obscond.moon_values([slot.index for slot in slots])[1] if slots else np.zeros(0)
+            data.append({
+                'x': local_hours([slot.mid.jd for slot in used], utcoffset),
+                'colors': [colors[slot.target.name] for slot in used],
+                'values': values,
+                'x_moon': local_hours([slot.mid.jd for slot in slots], utcoffset),
+                'moon_alt': moon_alt,
+            })
+        return data
+
+    def figure(self, panel, nrow):
+        """
+        パネルの図を返します。既にある場合は軸を消去して再利用します。
+        """
+        if panel in self._figures and len(self._figures[panel][1]) != nrow:
+            plt.close(self._figures[panel][0])
+            del self._figures[panel]
+        if panel not in self._figures:
+            fig, axes = plt.subplots(nrow, 1, figsize=(10, 7), sharex=True, sharey=True)
+            fig.text(0.07, 0.5, PANELS[panel][0], va='center', rotation='vertical')
+            fig.subplots_adjust(hspace=0.4)
+            self._figures[panel] = (fig, axes)
+        fig, axes = self._figures[panel]
+        for ax in axes:
+            ax.cla()
+            ax.set_axis_on()
+        return fig, axes
+
+    @profiled()
+    def snapshot(self, schedule, dates, obscond, targetList, priority=-1):
+        """
+        パネルを描くのに必要な配列をまとめます。スケジュールや ObservingConditions を参照しないので、
+        別のプロセスで描くことができます (renderPanels)。
+
+        Returns:
+            dict: 日付、日付ごとの配列と薄明の時刻、priority。
+        """
+        return {'dates': list(dates), 'data': self.data(schedule, dates, obscond, targetList),
+                'twilights': self.twilights(dates), 'priority': priority}
+
+    def plot(self, schedule, dates, obscond, targetList, priority=-1, panels=tuple(PANELS)):
+        """
+        パネルを描いて <パネル名>[_<priority>].png に保存します。
+
+        Args:
+            schedule: ObsSlotList オブジェクト
+            dates (list): 描く日付 (ローカル)。
+            obscond: ObservingConditions オブジェクト
+            targetList: TargetList オブジェクト
+            priority (int): ファイル名に付ける priority。負の場合は付けません。
+            panels (tuple): 描くパネル (PANELS のキー)。
+        """
+        return self.draw(self.snapshot(schedule, dates, obscond, targetList, priority), panels)
+
+    @profiled()
+    def draw(self, snapshot, panels=tuple(PANELS)):
+        """
+        snapshot のパネルを描いて保存します。
+
+        Returns:
+            dict: パネル名をキー、PNG のバイト列を値とする辞書 (PDF に埋め込むため)。
+        """
+        images = {}
+        dates = snapshot['dates']
+        priority = snapshot['priority']
+        nrow = max(len(dates), 7)
+        for panel in panels:
+            _, ylim, yticks, ytext, bands = PANELS[panel]
+            fig, axes = self.figure(panel, nrow)
+            for k, (date, night) in enumerate(zip(dates, snapshot['data'])):
+                ax = axes[k]
+                if panel == 'elevation':
+                    ax.scatter(night['x'], night['values']['alt'], c=night['colors'])
+                    ax.plot(night['x_moon'], night['moon_alt'], c='gray', linestyle='--')
+                elif panel == 'rot_angle':
+                    ax.scatter(night['x'], night['values']['rotang_start'], c=night['colors'])
+                    ax.scatter(night['x'], night['values']['rotang_end'], c=night['colors'])
+                else:
+                    ax.scatter(night['x'], night['values']['ha'], c=night['colors'])
+
+                for sun_set, sun_rise in snapshot['twilights'][k]:
+                    ax.axvspan(18, sun_set, color='gold', alpha=0.25)
+                    ax.axvspan(sun_rise, 30, color='gold', alpha=0.25)
+
+                ax.set_yticks(yticks)
+                ax.set_xlim(18, 30)
+                ax.set_ylim(*ylim)
+                ax.text(18.05, ytext, date, fontsize=10)
+                ax.grid()
+                if k == len(dates)-1:
+                    ax.set_xlabel('Time (HST)')
+                for y0, y1 in bands:
+                    ax.fill_between([18, 30], y0, y1, color='red', alpha=0.3)
+
+            for k in range(len(dates), nrow):
+                axes[k].axis('off')
+
+            images[panel] = save_png(fig, f'{panel}_{priority}.png' if priority >= 0 else f'{panel}.png')
+        return images
+
+    def close(self):
+        """
+        図を閉じます。
+        """
+        for fig, _ in self._figures.values():
+            plt.close(fig)
+        self._figures = {}
+
+# Plotter of the rendering process, whose figures are reused by the successive snapshots
+_render_plotter = None
+
+def renderPanels(snapshot, panels=tuple(PANELS)):
+    """
+    SchedulePlotter.snapshot で作った配列からパネルを描きます (Artifacts.ArtifactQueue から呼ばれます)。
+
+    Returns:
+        dict: パネル名をキー、PNG のバイト列を値とする辞書。
+    """
+    global _render_plotter
+    if _render_plotter is None:
+        _render_plotter = SchedulePlotter(None)
+    return _render_plotter.draw(snapshot, panels)
 
-def plotSchedule_rotang(schedule, dates, obscond, targetList, observer, priority=-1):
-    nrow = max(len(dates), 7)
-    fig, axes = plt.subplots(nrow, 1, figsize=(10, 7), sharex=True, sharey=True)
-
-    for k in range(len(dates)):
-        xx = list()
-        ys = list()
-        ye = list()
-        zz = list()
-        for slot in schedule.get_used_slots():
-            if slot.date != dates[k]:
-                continue
-            t = slot.target
-            tt = datetime.datetime.strptime((slot.mid+observer.utcoffset).iso[:-4], '%Y-%m-%d %H:%M:%S').time()
-            _tt = tt.hour + tt.minute/60
-            if _tt < 15:
-                _tt += 24
-            xx.append(_tt)
-            ys.append(obscond.rotang_start(slot.index, t.name).degree)
-            ye.append(obscond.rotang_end(slot.index, t.name).degree)
-            zz.append(get_color_for_point(t.wg, targetList.wg_objects[t.wg].index(t.name), len(targetList.wg_objects[t.wg])))
+def plotSchedule(schedule, dates, obscond, targetList, observer, priority=-1):
+    plotter = SchedulePlotter(observer)
+    plotter.plot(schedule, dates, obscond, targetList, priority, panels=('elevation',))
+    plotter.close()
 
-        axes[k].scatter(xx, ys, c=zz)
-        axes[k].scatter(xx, ye, c=zz)
-
-        time = Time(dates[k]+' 12:00:00') - observer.utcoffset
-        for _horizon in [-18, -12, -6, 0]:
-            sun_set = observer.sun_set_time(time, which='next', horizon=_horizon*u.degree)
-            sun_rise = observer.sun_rise_time(time, which='next', horizon=_horizon*u.degree)
-            _set = (sun_set+observer.utcoffset).datetime.hour + (sun_set+observer.utcoffset).datetime.minute/60
-            _rise = (sun_rise+observer.utcoffset).datetime.hour + (sun_rise+observer.utcoffset).datetime.minute/60
-            if _rise < 15:
-                _rise += 24
-            axes[k].axvspan(18, _set, color='gold', alpha=0.25)
-            axes[k].axvspan(_rise, 30, color='gold', alpha=0.25)
-
-        axes[k].set_yticks(range(-180, 181, 90))
-        axes[k].set_xlim(18, 30)
-        axes[k].set_ylim(-180, 180)
-        axes[k].text(18.05, 185, dates[k], fontsize=10)
-        axes[k].grid()
-        if k == len(dates)-1:
-            axes[k].set_xlabel('Time (HST)')
-
-        axes[k].fill_between([18,30], -180, -174, color='red', alpha=0.3)
-        axes[k].fill_between([18,30],  174,  180, color='red', alpha=0.3)
-
-    for k in range(len(dates), nrow):
-        axes[k].axis('off')
-
-    fig.text(0.07, 0.5, 'Rot Angle (degree)', va='center', rotation='vertical')
-    
-    plt.subplots_adjust(hspace=0.4)
-
-    if priority >= 0:
-        plt.savefig(f'rot_angle_{priority}.png')
-    else:
-        plt.savefig(f'rot_angle.png')
+def plotSchedule_rotang(schedule, dates, obscond, targetList, observer, priority=-1):
+    plotter = SchedulePlotter(observer)
+    plotter.plot(schedule, dates, obscond, targetList, priority, panels=('rot_angle',))
+    plotter.close()
 
 def plotSchedule_ha(schedule, dates, obscond, targetList, observer, priority=-1):
-    nrow = max(len(dates), 7)
-    fig, axes = plt.subplots(nrow, 1, figsize=(10, 7), sharex=True, sharey=True)
-
-    for k in range(len(dates)):
-        xx = list()
-        yy = list()
-        zz = list()
-        for slot in schedule.get_used_slots():
-            if slot.date != dates[k]:
-                continue
-            t = slot.target
-            tt = datetime.datetime.strptime((slot.mid+observer.utcoffset).iso[:-4], '%Y-%m-%d %H:%M:%S').time()
-            _tt = tt.hour + tt.minute/60
-            if _tt < 15:
-                _tt += 24
-            xx.append(_tt)
-            yy.append(obscond.ha(slot.index, t.name).value)
-            zz.append(get_color_for_point(t.wg, targetList.wg_objects[t.wg].index(t.name), len(targetList.wg_objects[t.wg])))
-
-        axes[k].scatter(xx, yy, c=zz)
-
-        time = Time(dates[k]+' 12:00:00') - observer.utcoffset
-        for _horizon in [-18, -12, -6, 0]:
-            sun_set = observer.sun_set_time(time, which='next', horizon=_horizon*u.degree)
-            sun_rise = observer.sun_rise_time(time, which='next', horizon=_horizon*u.degree)
-            _set = (sun_set+observer.utcoffset).datetime.hour + (sun_set+observer.utcoffset).datetime.minute/60
-            _rise = (sun_rise+observer.utcoffset).datetime.hour + (sun_rise+observer.utcoffset).datetime.minute/60
-            if _rise < 15:
-                _rise += 24
-            axes[k].axvspan(18, _set, color='gold', alpha=0.25)
-            axes[k].axvspan(_rise, 30, color='gold', alpha=0.25)
-
-        axes[k].set_yticks(range(-4, 6, 2))
-        axes[k].set_xlim(18, 30)
-        axes[k].set_ylim(-5, 5)
-        axes[k].text(18.05, 5.06, dates[k], fontsize=10)
-        axes[k].grid()
-        if k == len(dates)-1:
-            axes[k].set_xlabel('Time (HST)')
-
-        axes[k].fill_between([18,30], -0.3, 0.3, color='red', alpha=0.3)
-
-    for k in range(len(dates), nrow):
-        axes[k].axis('off')
-
-    fig.text(0.07, 0.5, 'Hour Angle (hour)', va='center', rotation='vertical')
-    
-    plt.subplots_adjust(hspace=0.4)
-
-    if priority >= 0:
-        plt.savefig(f'hour_angle_{priority}.png')
-    else:
-        plt.savefig(f'hour_angle.png')
+    plotter = SchedulePlotter(observer)
+    plotter.plot(schedule, dates, obscond, targetList, priority, panels=('hour_angle',))
+    plotter.close()
 
+@profiled()
 def plotObservedCounts(targetList):
     nexp_wg_finished = OrderedDict(sorted(targetList.nexp_wg_finished.items(), key=lambda x: x[0]))
     print(nexp_wg_finished)
@@ -289,4 +329,6 @@ def plotObservedCounts(targetList):
     ax_inset.set_title('Observed Counts by WG')
     ax_inset.set_ylim(0, max(nexp_wg_finished.values()) * 1.1)
 
-    plt.savefig('observed_counts.png')
\ No newline at end of file
+    image = save_png(fig, 'observed_counts.png')
+    plt.close(fig)
+    return image
\ No newline at end of file
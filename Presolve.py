@@ -0,0 +1,163 @@
+from Optimize import feasible_mask, select_targets, split_into_continuous_sequences
+from Profiling import profiled
+import numpy as np
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class ScheduleInfeasibleError(ValueError):
+    """
+    Raised when the optimization problem is known to be infeasible before it is solved.
+    """
+    pass
+
+def run_bound(feasible, sub_slot_lengths, n_continuous):
+    """
+    WG の連続観測の制約 (n_continuous) の下で使えるスロット数の上限を計算します。
+
+    連続したスロットの並びが n_continuous より短い場合は制約がかからないので、観測可能なスロットを全て数えます。
+    それ以外では、観測可能なスロットの連続が n_continuous 以上のもの、または並びの端に接するものを数えます
+    (OptimizeSchedule は並びの端の n_continuous - 1 スロットでは開始・終了の制約を課さないため)。
+
+    Args:
+        feasible (ndarray): スロットごとに WG のいずれかのターゲットが観測可能かを示す bool 配列。
+        sub_slot_lengths (list): 連続したスロットの並びの長さ (feasible の順)。
+        n_continuous (int): 最小の連続スロット数。
+
+    Returns:
+        int: スロット数の上限。
+    """
+    bound = 0
+    i0 = 0
+    for length in sub_slot_lengths:
+        sub = feasible[i0:i0 + length]
+        i0 += length
+        if length < n_continuous:
+            bound += int(sub.sum())
+            continue
+        k = 0
+        while k < length:
+            if not sub[k]:
+                k += 1
+                continue
+            k_end = k
+            while k_end < length and sub[k_end]:
+                k_end += 1
+            if k_end - k >= n_continuous or k == 0 or k_end == length:
+                bound += k_end - k
+            k = k_end
+    return bound
+
+class CapacityCheck:
+    """
+    Upper bounds on the exposures achievable by OptimizeSchedule, computed before solving.
+
+    The bounds combine the slot capacity, the (slot, target) feasibility, the remaining number
+    of exposures of each target, the WG quotas and the n_continuous constraints. Conditions
+    that make the MILP infeasible are collected in errors, conditions that make the plan
+    degenerate or miss the minimum quotas in warnings.
+    """
+
+    def __init__(self, obs_slots, targets, targetList, oc, params, observer, nexp_max, nexp_min=None):
+        self.errors = []
+        self.warnings = []
+        self.capacity = len(obs_slots)
+
+        # Conditions under which the constraints of OptimizeSchedule cannot be satisfied
+        for w in targetList.wg_list:
+            if w not in nexp_max:
+                self.errors.append(f"WG {w} has no quota (nexp_max), add it to 'frac' in the parameter file")
+            elif nexp_max[w] - targetList.nexp_wg_finished[w] < 0:
+                self.errors.append(f"WG {w}: {targetList.nexp_wg_finished[w]} exposures already done exceed "
+                                   f"the quota nexp_max = {nexp_max[w]}")
+        for t in targets:
+            if t.observed > t.nexp:
+                self.errors.append(f"Target {t.name}: observed {t.observed} exceeds nexp {t.nexp}")
+
+        feasible = feasible_mask(oc, params, observer, obs_slots, targets)
+        n_feasible = feasible.sum(axis=0) if len(obs_slots) else np.zeros(len(targets), dtype=int)
+
+        # Per target: remaining exposures and feasible slots
+        self.target_bounds = {t.name: int(min(max(t.nexp - t.observed, 0), n)) for t, n in zip(targets, n_feasible)}
+        for t, n in zip(targets, n_feasible):
+            if t.nexp > t.observed and n == 0:
+                self.warnings.append(f"Target {t.name} ({t.wg}): no feasible slot for {t.nexp - t.observed} remaining exposures")
+
+        # Per WG: quota, targets and runs of at least n_continuous feasible slots
+        # Slots ordered by night and time, split into the continuous sequences of OptimizeSchedule
+        dates = list(dict.fromkeys(slot.date for slot in obs_slots))
+        date_positions = {date: k for k, date in enumerate(dates)}
+        order = sorted(range(len(obs_slots)), key=lambda k: (date_positions[obs_slots[k].date], obs_slots[k].index))
+        sub_slot_lengths = [len(sub_slot) for date in dates
+                            for sub_slot in split_into_continuous_sequences([slot.index for slot in obs_slots if slot.date == date])]
+        self.wg_bounds = {}
+        for w in targetList.wg_list:
+            columns = [k for k, t in enumerate(targets) if t.wg == w]
+            if not columns:
+                continue
+            quota = nexp_max.get(w, 0) - targetList.nexp_wg_finished[w]
+            wg_feasible = np.any(feasible[order][:, columns], axis=1)
+            runs = run_bound(wg_feasible, sub_slot_lengths, params.n_continuous[w])
+            self.wg_bounds[w] = max(0, min(quota, runs, sum(self.target_bounds[targets[k].name] for k in columns)))
+            if runs < int(wg_feasible.sum()):
+                self.warnings.append(f"WG {w}: only {runs} of {int(wg_feasible.sum())} feasible slots are in runs "
+                                     f"of at least n_continuous = {params.n_continuous[w]} slots")
+            if nexp_min is not None and w in nexp_min \
+                    and self.wg_bounds[w] + targetList.nexp_wg_finished[w] < nexp_min[w]:
+                self.warnings.append(f"WG {w}: at most {self.wg_bounds[w] + targetList.nexp_wg_finished[w]} exposures "
+                                     f"are achievable, below the minimum quota nexp_min = {nexp_min[w]}")
+
+        # Per priority (cumulative)
+        self.priority_bounds = {}
+        for priority in sorted(set(t.priority for t in targets)):
+            selected = [t for t in targets if t.priority <= priority]
+            by_wg = {w: sum(self.target_bounds[t.name] for t in selected if t.wg == w) for w in self.wg_bounds}
+            self.priority_bounds[priority] = min(self.capacity,
+                                                 sum(min(n, self.wg_bounds[w]) for w, n in by_wg.items()))
+
+        self.upper_bound = min(self.capacity, sum(self.wg_bounds.values()))
+        if not self.errors and self.upper_bound == 0:
+            self.warnings.append(f"No exposure is achievable in the {self.capacity} slots: every slot would be dummy")
+
+    @property
+    def infeasible(self):
+        return len(self.errors) > 0
+
+    def log(self):
+        logger.info(f"Pre-solve check: capacity {self.capacity} slots, at most {self.upper_bound} exposures achievable")
+        logger.info(f"  Upper bounds per WG: { {str(w): int(n) for w, n in self.wg_bounds.items()} }")
+        logger.info(f"  Upper bounds per priority (cumulative): { {int(p): int(n) for p, n in self.priority_bounds.items()} }")
+        for message in self.warnings:
+            logger.warning(f"  {message}")
+        for message in self.errors:
+            logger.error(f"  {message}")
+
+@profiled()
+def presolveCheck(obsSlotList, targetList, oc, params, observer, nexp_max, nexp_min=None, priority=-1):
+    """
+    OptimizeSchedule と同じターゲットとスロットについて、解く前に達成可能な観測数の上限を調べます。
+
+    Args:
+        obsSlotList: ObsSlotList オブジェクト
+        targetList: TargetList オブジェクト
+        oc: ObservingConditions オブジェクト
+        params: Params オブジェクト
+        observer: MyObserver オブジェクト
+        nexp_max (dict): WG ごとの観測数の上限。
+        nexp_min (dict): WG ごとの観測数の下限 (警告のみ)。
+        priority (int): OptimizeSchedule に渡す priority。
+
+    Returns:
+        CapacityCheck: 上限と警告。upper_bound が 0 の場合は最適化を省略できます。
+
+    Raises:
+        ScheduleInfeasibleError: 最適化問題の制約を満たせない場合。
+    """
+    targets = select_targets(targetList, oc, params, priority)
+    obs_slots = obsSlotList.get_available_slots(sum([(t.nexp - t.observed) for t in targets]))
+    check = CapacityCheck(obs_slots, targets, targetList, oc, params, observer, nexp_max, nexp_min)
+    check.log()
+    if check.infeasible:
+        raise ScheduleInfeasibleError(f"The optimization (priority <= {priority}) is infeasible:\n  " + "\n  ".join(check.errors))
+    return check
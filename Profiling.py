@@ -0,0 +1,212 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+import logging
+
+logger = logging.getLogger(__name__)
+
+def peak_rss_mb():
+    """
+    プロセスの最大常駐メモリ (MB) を返します。resource モジュールがない場合は None。
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+def current_rss_mb():
+    """
+    プロセスの現在の常駐メモリ (MB) を返します。/proc がない場合は None。
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Profiler:
+    """
+    Nested timed spans of a run of the pipeline.
+
+    Each span records its wall time, its parent and the current and peak RSS of the process at
+    its end. The spans of the stages also record the peak traced memory and the top allocations
+    (tracemalloc, by line) made during the stage, and can be profiled with cProfile.
+    The spans are written to a JSON report and to a Chrome trace-event file, which can be opened
+    in chrome://tracing or https://ui.perfetto.dev.
+
+    tracemalloc slows down the allocations: with trace_memory=True the times are inflated,
+    typically by some tens of percent for the ephemeris and the model build.
+    """
+
+    def __init__(self, trace_memory=True, cprofile=(), prefix='profile', top=10):
+        """
+        Args:
+            trace_memory (bool): 段階ごとに tracemalloc でメモリの割り当てを記録するか。
+            cprofile (list): cProfile で計測する段階の名前。
+            prefix (str): cProfile の出力ファイル名の接頭辞 (<prefix>.<段階>.prof)。
+            top (int): 記録するメモリの割り当ての数。
+        """
+        self.trace_memory = trace_memory
+        self.cprofile = set(cprofile)
+        self.prefix = prefix
+        self.top = top
+        self.spans = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def span(self, name, stage=False, **args):
+        """
+        with 文の範囲の時間を記録します。
+
+        Args:
+            name (str): 範囲の名前。
+            stage (bool): パイプラインの段階か (メモリの割り当てと cProfile を記録します)。
+            args: 記録に加える値。
+        """
+        record = {'name': name, 'start': time.perf_counter() - self._t0, 'depth': len(self._stack),
+                  'parent': self._stack[-1]['name'] if self._stack else None, 'stage': stage}
+        if args:
+            record['args'] = args
+        self._stack.append(record)
+
+        snapshot = None
+        if stage and self.trace_memory:
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        profile = None
+        if stage and name in self.cprofile:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.perf_counter() - self._t0 - record['start']
+            if profile is not None:
+                profile.disable()
+                record['cprofile'] = f'{self.prefix}.{name}.prof'
+                profile.dump_stats(record['cprofile'])
+            if snapshot is not None:
+                stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+                record['top_allocations'] = [{'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                                              'size_diff_mb': stat.size_diff / 1024**2, 'count_diff': stat.count_diff}
+                                             for stat in stats[:self.top]]
+            record['rss_mb'] = current_rss_mb()
+            record['rss_peak_mb'] = peak_rss_mb()
+            self._stack.pop()
+            self.spans.append(record)
+
+    def summary(self):
+        """
+        名前ごとの回数・合計時間・自身の時間 (子の範囲を除いた時間) を返します。
+
+        Returns:
+            dict: 範囲の名前をキーとする辞書 (合計時間の大きい順)。
+        """
+        nested = {}
+        for record in self.spans:
+            if record['parent'] is not None:
+                nested[record['parent']] = nested.get(record['parent'], 0.0) + record['duration']
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record['name'], {'count': 0, 'total': 0.0})
+            total['count'] += 1
+            total['total'] += record['duration']
+        for name, total in totals.items():
+            total['self'] = total['total'] - nested.get(name, 0.0)
+        return dict(sorted(totals.items(), key=lambda item: -item[1]['total']))
+
+    def trace_events(self):
+        """
+        Chrome trace-event 形式のイベントのリストを返します (時刻はマイクロ秒)。
+        """
+        pid = os.getpid()
+        events = []
+        for record in sorted(self.spans, key=lambda r: (r['start'], r['depth'])):
+            args = dict(record.get('args', {}))
+            for name in ['rss_mb', 'rss_peak_mb', 'traced_peak_mb']:
+                if record.get(name) is not None:
+                    args[name] = round(record[name], 1)
+            events.append({'name': record['name'], 'cat': 'stage' if record['stage'] else 'span', 'ph': 'X',
+                           'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6,
+                           'pid': pid, 'tid': 0, 'args': args})
+            if record.get('rss_mb') is not None:
+                events.append({'name': 'RSS (MB)', 'ph': 'C', 'ts': (record['start'] + record['duration']) * 1e6,
+                               'pid': pid, 'args': {'rss': round(record['rss_mb'], 1)}})
+        return events
+
+    def write(self, fname_report, fname_trace=None):
+        """
+        範囲の記録を JSON に、イベントを Chrome trace-event 形式のファイルに書きます。
+
+        Args:
+            fname_report (str): JSON の報告のファイル名。
+            fname_trace (str): trace-event のファイル名。None の場合は書きません。
+        """
+        report = {'wall_time': time.perf_counter() - self._t0, 'rss_peak_mb': peak_rss_mb(),
+                  'stages': [record for record in self.spans if record['stage']],
+                  'summary': self.summary(),
+                  'spans': sorted(self.spans, key=lambda r: r['start'])}
+        with open(fname_report, 'w') as f:
+            json.dump(report, f, indent=1)
+        if fname_trace is not None:
+            with open(fname_trace, 'w') as f:
+                json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+        logger.info(f"Profile written to {fname_report}" + (f" and {fname_trace}" if fname_trace else ""))
+
+    def log(self, n=15):
+        """
+        段階ごとの時間とメモリ、合計時間の大きい範囲をログに出します。
+        """
+        for record in self.spans:
+            if record['stage']:
+                memory = f", traced peak {record['traced_peak_mb']:.1f} MB" if 'traced_peak_mb' in record else ''
+                logger.info(f"Stage {record['name']}: {record['duration']:.2f} s, "
+                            f"peak RSS {record['rss_peak_mb'] or 0:.0f} MB{memory}")
+        for name, total in list(self.summary().items())[:n]:
+            logger.info(f"  {name:32s} {total['count']:4d} x  total {total['total']:8.2f} s  self {total['self']:8.2f} s")
+
+# Profiler of the run, None when profiling is off
+_profiler = None
+
+def enable(profiler):
+    """
+    span() と profiled() で記録する Profiler を設定します (None で無効)。
+    """
+    global _profiler
+    _profiler = profiler
+
+def span(name, stage=False, **args):
+    """
+    有効な Profiler があれば、with 文の範囲の時間を記録します。なければ何もしません。
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.span(name, stage, **args)
+
+def profiled(name=None):
+    """
+    関数の呼び出しを span で記録するデコレータです。name が None の場合は関数の修飾名を使います。
+    """
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
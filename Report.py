@@ -1,6 +1,10 @@
 import datetime
+import io
+import numpy as np
 import astropy.units as u
-from matplotlib.colors import LinearSegmentedColormap
+from astropy.table import Table as AstropyTable
+from Profiling import profiled
+from astropy.time import Time
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import inch
@@ -19,230 +23,196 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+# Classification codes of the conditions in the schedule frame
+OK = 0
+WARN = 1
+LIMIT = 2
+
+# Thresholds of the report classification that are not in the parameter file
+TEFF_WARN = 0.8
+TEFF_LIMIT = 0.6
+ROTANG_WARN = 150.0
+ROTANG_LIMIT = 170.0
+
+PLANETS = ["mars", "jupiter", "saturn"]
+
+def classify(limit, warn):
+    """
+    limit と warn の条件 (bool 配列) から分類コード (OK, WARN, LIMIT) の配列を作ります。limit が優先されます。
+    """
+    return np.where(limit, LIMIT, np.where(warn, WARN, OK))
+
+@profiled()
+def scheduleFrame(obsSlotList, observer, oc, params, dates=None):
+    """
+    観測計画のスロットごとの条件と分類コードを、夜ごとの表にまとめます。
+    全てのスロットの条件を ObservingConditions のグリッドから一度に取り出します。スリューでスロットの時刻が
+    グリッドを計算した時刻からずれている場合は、ObservingConditions.interpolate でずれた時刻の値にします。
+
+    各表の列は index, name, wg, time (HST の観測開始時刻), airmass, teff, rotang_start, rotang_end, ha,
+    moon_sep, moon_ill, moon_alt, mars_sep, jupiter_sep, saturn_sep と、条件の列ごとの分類コード
+    (<列名>_code, OK/WARN/LIMIT) です。
+
+    Args:
+        obsSlotList: ObsSlotList オブジェクト
+        observer: MyObserver オブジェクト
+        oc: ObservingConditions オブジェクト
+        params: Params オブジェクト
+        dates (list): 表を作る夜 (ローカルの日付)。None の場合は obsSlotList の全ての夜。
+
+    Returns:
+        dict: 夜をキー、Table を値とする辞書 (ターゲットが割り当てられたスロットのみ)。
+    """
+    if dates is None:
+        dates = obsSlotList.dates
+    slots = [slot for slot in obsSlotList if slot.target is not None and slot.date in set(dates)]
+
+    frame = AstropyTable()
+    frame['index'] = np.array([slot.index for slot in slots], dtype=int)
+    frame['date'] = np.array([slot.date for slot in slots], dtype=str)
+    frame['name'] = np.array([slot.target.name for slot in slots], dtype=str)
+    frame['wg'] = np.array([slot.target.wg for slot in slots], dtype=str)
+    obs_start = Time(np.array([slot.obs_start.jd for slot in slots]), format='jd', scale='utc')
+    frame['time'] = np.array([iso[:-7] for iso in (obs_start + observer.utcoffset).iso], dtype=str)
+
+    islots = frame['index'].data
+    names = frame['name'].data.astype(object)
+
+    # Offsets of the slot times from the times of the grids (e.g. cached conditions of a replanned schedule)
+    offsets = np.zeros(len(slots)) * u.minute
+    if len(slots):
+        offsets = ((np.array([slot.mid.jd for slot in slots]) - oc.slot_mid(islots).jd) * u.day).to(u.minute)
+    shifted = bool(np.any(offsets.value != 0.0))
+
+    def grid_values(name):
+        if not len(slots):
+            return np.zeros(0)
+        return oc.interpolate(name, islots, names, offsets) if shifted else oc.values(name, islots, names)
+
+    for name in ['airmass', 'teff', 'rotang_start', 'rotang_end', 'ha', 'moon_sep']:
+        frame[name] = grid_values(name)
+    frame['moon_ill'], frame['moon_alt'] = oc.moon_values(islots, offsets if shifted else None) if len(slots) \
+        else (np.zeros(0), np.zeros(0))
+    for planet in PLANETS:
+        frame[f'{planet}_sep'] = grid_values(f'{planet}_sep')
+
+    # Classification of the conditions
+    airmass_limit = np.array([params.airmass['limit'][slot.target.wg] for slot in slots])
+    frame['airmass_code'] = classify(frame['airmass'] > airmass_limit, frame['airmass'] > params.airmass['warn'])
+    frame['teff_code'] = classify(frame['teff'] <= TEFF_LIMIT, frame['teff'] <= TEFF_WARN)
+    for name in ['rotang_start', 'rotang_end']:
+        frame[f'{name}_code'] = classify(np.abs(frame[name]) >= ROTANG_LIMIT, np.abs(frame[name]) >= ROTANG_WARN)
+    is_north = np.array([slot.target.coord.dec > observer.location.lat for slot in slots], dtype=bool)
+    frame['ha_code'] = classify(is_north & (np.abs(frame['ha']) < params.meridian['limit'].to(u.hourangle).value),
+                                is_north & (np.abs(frame['ha']) < params.meridian['warn'].to(u.hourangle).value))
+    frame['moon_sep_code'] = classify(frame['moon_sep'] < params.moonsep['limit'].to(u.deg).value,
+                                      frame['moon_sep'] < params.moonsep['warn'].to(u.deg).value)
+    moon_down = frame['moon_alt'] < params.moonalt['limit'].to(u.deg).value
+    frame['moon_ill_code'] = classify(~moon_down & (frame['moon_ill'] >= params.moonill['warn']),
+                                      ~moon_down & (frame['moon_ill'] >= params.moonill['limit']))
+    frame['moon_alt_code'] = classify(frame['moon_alt'] >= params.moonalt['warn'].to(u.deg).value, ~moon_down)
+    for planet in PLANETS:
+        frame[f'{planet}_sep_code'] = classify(frame[f'{planet}_sep'] < params.planetssep['limit'].to(u.deg).value,
+                                               frame[f'{planet}_sep'] < params.planetssep['warn'].to(u.deg).value)
+
+    # Split by night, keeping the order of the slots
+    return {date: frame[frame['date'] == date] for date in dates}
+
+@profiled()
+def formatSchedule(frames, dates_local):
+    """
+    scheduleFrame の表から、端末に表示する観測計画の文字列を作ります。
+
+    Args:
+        frames (dict): 夜をキー、Table を値とする辞書。
+        dates_local (list): 表示する夜。
+
+    Returns:
+        str: ANSI カラーコードを含む観測計画。
+    """
+    ansi = {OK: bcolors.OKGREEN, WARN: bcolors.WARNING, LIMIT: bcolors.FAIL}
+    columns = [('airmass', '7.2f'), ('teff', '7.2f'), ('rotang_start', '+7.2f'), ('rotang_end', '+7.2f'),
+               ('ha', '6.2f'), ('moon_sep', '7.2f'), ('moon_ill', '7.2f'), ('moon_alt', '7.2f')] \
+        + [(f'{planet}_sep', '9.2f') for planet in PLANETS]
+    lines = []
+    for date in dates_local:
+        frame = frames[date]
+        lines.append(f'Observing plan for {date}')
+        lines.append('Name                  Time (HST)       Airmass t_eff   RotAngs RotAnge HA     MoonSep MoonIll MoonAlt MarsSep  JupiterSep SaturnSep')
+        lines.append('--------------------- ---------------- ------- ------- ------- ------- ------ ------- ------- ------- --------- --------- ---------')
+        values = [(frame[name].data, frame[f'{name}_code'].data, fmt) for name, fmt in columns]
+        for k in range(len(frame)):
+            cells = [f'{ansi[codes[k]]}{format(v[k], fmt)}{bcolors.ENDC}' for v, codes, fmt in values]
+            lines.append(f'{frame["name"][k]:21s} {frame["time"][k]} ' + ' '.join(cells) + ' ')
+        lines.append('')
+    return ''.join(line + '\n' for line in lines)
+
 def printSchedule(obsSlotList, dates_local, observer, oc, params):
-    for k in range(len(dates_local)):
-        xx = list()
-        yy = list()
-        zz = list()
-        ma = list()
-        print(f'Observing plan for {dates_local[k]}')
-        print('Name                  Time (HST)       Airmass t_eff   RotAngs RotAnge HA     MoonSep MoonIll MoonAlt MarsSep  JupiterSep SaturnSep')
-        print('--------------------- ---------------- ------- ------- ------- ------- ------ ------- ------- ------- --------- --------- ---------')
-        for slot in obsSlotList:
-            if slot.date == dates_local[k]:
-                t = slot.target
-                if t is None:
-                    continue
-
-                print(f'{t.name:21s} {(slot.obs_start+observer.utcoffset).iso[:-7]}', end=' ')
-
-                # airmass
-                if oc.airmass(slot.index, t.name) > params.airmass['limit'][t.wg]:
-                    print(f'{bcolors.FAIL}{oc.airmass(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.airmass(slot.index, t.name) > params.airmass['warn']:
-                    print(f'{bcolors.WARNING}{oc.airmass(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.OKGREEN}{oc.airmass(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-
-                # effective exposure time
-                if oc.teff(slot.index, t.name) > 0.8:
-                    print(f'{bcolors.OKGREEN}{oc.teff(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.teff(slot.index, t.name) > 0.6:
-                    print(f'{bcolors.WARNING}{oc.teff(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.FAIL}{oc.teff(slot.index, t.name):7.2f}{bcolors.ENDC}', end=' ')
-
-                rotang_warn = 150 * u.deg
-                rotang_limit = 170 * u.deg
-                # rotator angle
-                if oc.rotang_start(slot.index, t.name) < rotang_warn and oc.rotang_start(slot.index, t.name) > -rotang_warn:
-                    print(f'{bcolors.OKGREEN}{oc.rotang_start(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.rotang_start(slot.index, t.name) < rotang_limit and oc.rotang_start(slot.index, t.name) > -rotang_limit:
-                    print(f'{bcolors.WARNING}{oc.rotang_start(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.FAIL}{oc.rotang_start(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-
-                # rotator angle
-                if oc.rotang_end(slot.index, t.name) < rotang_warn and oc.rotang_end(slot.index, t.name) > -rotang_warn:
-                    print(f'{bcolors.OKGREEN}{oc.rotang_end(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.rotang_end(slot.index, t.name) < rotang_limit and oc.rotang_end(slot.index, t.name) > -rotang_limit:
-                    print(f'{bcolors.WARNING}{oc.rotang_end(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.FAIL}{oc.rotang_end(slot.index, t.name).degree:+7.2f}{bcolors.ENDC}', end=' ')
-
-
-                ha_warn = (0.3 * u.hourangle).value
-                ha_limit = (0.1 * u.hourangle).value
-                is_north = t.coord.dec > observer.location.lat
-                # hour angle
-                if abs(oc.ha(slot.index, t.name).value) < ha_limit and is_north:
-                    print(f'{bcolors.FAIL}{oc.ha(slot.index, t.name).value:6.2f}{bcolors.ENDC}', end=' ')
-                elif abs(oc.ha(slot.index, t.name).value) < ha_warn and is_north:
-                    print(f'{bcolors.WARNING}{oc.ha(slot.index, t.name).value:6.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.OKGREEN}{oc.ha(slot.index, t.name).value:6.2f}{bcolors.ENDC}', end=' ')
-
-                # moon separation
-                if oc.moon_sep(slot.index, t.name) < params.moonsep['limit']:
-                    print(f'{bcolors.FAIL}{oc.moon_sep(slot.index, t.name).degree:7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.moon_sep(slot.index, t.name) < params.moonsep['warn']:
-                    print(f'{bcolors.WARNING}{oc.moon_sep(slot.index, t.name).degree:7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.OKGREEN}{oc.moon_sep(slot.index, t.name).degree:7.2f}{bcolors.ENDC}', end=' ')
-
-                # moon illumination
-                if oc.moon_ill(slot.index) < params.moonill['limit'] or oc.moon_altaz(slot.index).alt < params.moonalt['limit']:
-                    print(f'{bcolors.OKGREEN}{oc.moon_ill(slot.index):7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.moon_ill(slot.index) < params.moonill['warn']:
-                    print(f'{bcolors.WARNING}{oc.moon_ill(slot.index):7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.FAIL}{oc.moon_ill(slot.index):7.2f}{bcolors.ENDC}', end=' ')
-
-                # Moon altitude
-                if oc.moon_altaz(slot.index).alt < params.moonalt['limit']:
-                    print(f'{bcolors.OKGREEN}{oc.moon_altaz(slot.index).alt.deg:7.2f}{bcolors.ENDC}', end=' ')
-                elif oc.moon_altaz(slot.index).alt < params.moonalt['warn']:
-                    print(f'{bcolors.WARNING}{oc.moon_altaz(slot.index).alt.deg:7.2f}{bcolors.ENDC}', end=' ')
-                else:
-                    print(f'{bcolors.FAIL}{oc.moon_altaz(slot.index).alt.deg:7.2f}{bcolors.ENDC}', end=' ')
-                
-                # Planet separation
-                for planet in ["mars", "jupiter", "saturn"]:
-                    if oc.planet_sep(planet, slot.index, t.name) < params.planetssep['limit']:
-                        print(f'{bcolors.FAIL}{oc.planet_sep(planet, slot.index, t.name).degree:9.2f}{bcolors.ENDC}', end=' ')
-                    elif oc.planet_sep(planet, slot.index, t.name) < params.planetssep['warn']:
-                        print(f'{bcolors.WARNING}{oc.planet_sep(planet, slot.index, t.name).degree:9.2f}{bcolors.ENDC}', end=' ')
-                    else:
-                        print(f'{bcolors.OKGREEN}{oc.planet_sep(planet, slot.index, t.name).degree:9.2f}{bcolors.ENDC}', end=' ')
-                print()
+    frames = scheduleFrame(obsSlotList, observer, oc, params, dates_local)
+    print(formatSchedule(frames, dates_local), end='')
+
+def printVisibilityWindows(visibility, targetList, dates_local, observer):
+    for date in dates_local:
+        print(f'Visibility windows for {date}')
+        print('Name                  WG Rise (HST)       Set (HST)        Meridian (HST)')
+        print('--------------------- -- ---------------- ---------------- -----------------')
+        for t in targetList.get_all_targets():
+            window = visibility.window(t.name, date)
+            if window is None:
+                print(f'{t.name:21s} {t.wg:2s} {bcolors.FAIL}{"not observable":33s}{bcolors.ENDC}')
+                continue
+            t_rise, t_set = window
+            print(f'{t.name:21s} {t.wg:2s} {(t_rise+observer.utcoffset).iso[:-7]} {(t_set+observer.utcoffset).iso[:-7]}', end=' ')
+            gap = visibility.meridian_gap(t.name, date)
+            if gap is not None:
+                print(f'{bcolors.WARNING}{(gap[0]+observer.utcoffset).iso[11:-7]}-{(gap[1]+observer.utcoffset).iso[11:-7]}{bcolors.ENDC}', end='')
+            print()
         print()
 
+@profiled()
 def createTableContents(obsSlotList, observer, oc, params):
-    # Define the color sequence
-    custom_colors = ['green', 'yellow', 'orange', 'red']
-
-    # Create a custom colormap
-    custom_cmap = LinearSegmentedColormap.from_list('danger_scale', custom_colors)
+    frames = scheduleFrame(obsSlotList, observer, oc, params)
+    background = {WARN: colors.lemonchiffon, LIMIT: colors.lightcoral}
+    columns = [('airmass', '7.2f'), ('teff', '7.2f'), ('rotang_start', '+7.2f'), ('rotang_end', '+7.2f'),
+               ('ha', '6.2f'), ('moon_sep', '7.2f'), ('moon_ill', '7.2f'), ('moon_alt', '7.2f')]
 
     texts = list()
     tables = list()
     tablestyles = list()
-    for k in range(len(obsSlotList.dates)):
-        texts.append(f'Observing plan for {obsSlotList.dates[k]}')
+    for date, frame in frames.items():
+        texts.append(f'Observing plan for {date}')
         data = list()
         l_tablestyle = list()
-        #data.append(['Name', 'Time (HST)', 'Airmass', 't_eff', 'RotAng(Start)', 'RotAng(End)', 'MoonSep', 'MoonIll', 'MoonAlt', 'MarsSep', 'JupiterSep', 'SaturnSep'])
         data.append(['', '', '', '', 'Rotator Angle', '', '', '', ''])
         data.append(['Name', 'Time (HST)', 'Airmass', 't_eff', 'Start', 'End', 'HA', 'MoonSep', 'MoonIll', 'MoonAlt'])
-        jj = 1
-        for slot in obsSlotList.slots:
-            if slot.start.iso.split(' ')[0] == obsSlotList.dates_utc[k]:
-                i = slot.index
-                if slot.target is None:
-                    continue
-                tname = slot.target.name
-                data.append([tname, (slot.start+5*u.minute+observer.utcoffset).iso[:-7],
-                             f'{oc.airmass(i, tname):7.2f}',
-                             f'{oc.teff(i, tname):7.2f}',
-                             f'{oc.rotang_start(i, tname).degree:+7.2f}',
-                             f'{oc.rotang_end(i, tname).degree:+7.2f}',
-                             f'{oc.ha(i, tname).value:6.2f}',
-                             f'{oc.moon_sep(i, tname).degree:7.2f}', 
-                             f'{oc.moon_ill(i):7.2f}', 
-                             f'{oc.moon_altaz(i).alt.deg:7.2f}', 
-                            # f'{oc.planet_sep('mars', i, tname).degree:7.2f}', 
-                            # f'{oc.planet_sep('jupiter', i, tname).degree:7.2f}', 
-                            # f'{oc.planet_sep('saturn', i, tname).degree:7.2f}'
-                            ])
-
-                if oc.airmass(i, tname) > params.airmass['limit'][slot.target.wg]:
-                    l_tablestyle.append(('BACKGROUND', (2, jj+1), (2, jj+1), colors.lightcoral))
-                elif oc.airmass(i, tname) > params.airmass['warn']:
-                    l_tablestyle.append(('BACKGROUND', (2, jj+1), (2, jj+1), colors.lemonchiffon))               
-
-                if oc.teff(i, tname) < 0.6:
-                    l_tablestyle.append(('BACKGROUND', (3, jj+1), (3, jj+1), colors.lightcoral))
-                elif oc.teff(i, tname) < 0.8:
-                    l_tablestyle.append(('BACKGROUND', (3, jj+1), (3, jj+1), colors.lemonchiffon))
-
-                rotang_warn = 150 * u.deg
-                rotang_limit = 170 * u.deg
-                if oc.rotang_start(i, tname) > rotang_limit or oc.rotang_start(i, tname) < -rotang_limit:
-                    l_tablestyle.append(('BACKGROUND', (4, jj+1), (4, jj+1), colors.lightcoral))
-                elif oc.rotang_start(i, tname) > rotang_warn or oc.rotang_start(i, tname) < -rotang_warn:
-                    l_tablestyle.append(('BACKGROUND', (4, jj+1), (4, jj+1), colors.lemonchiffon))
-
-                if oc.rotang_end(i, tname) > rotang_limit or oc.rotang_end(i, tname) < -rotang_limit:
-                    l_tablestyle.append(('BACKGROUND', (5, jj+1), (5, jj+1), colors.lightcoral))
-                elif oc.rotang_end(i, tname) > rotang_warn or oc.rotang_end(i, tname) < -rotang_warn:
-                    l_tablestyle.append(('BACKGROUND', (5, jj+1), (5, jj+1), colors.lemonchiffon))
-
-                ha_warn = (0.3 * u.hourangle).value
-                ha_limit = (0.1 * u.hourangle).value
-                is_north = slot.target.coord.dec > observer.location.lat
-                if abs(oc.ha(i, tname).value) < ha_limit and is_north:
-                    l_tablestyle.append(('BACKGROUND', (6, jj+1), (6, jj+1), colors.lightcoral))
-                elif abs(oc.ha(i, tname).value) < ha_warn and is_north:
-                    l_tablestyle.append(('BACKGROUND', (6, jj+1), (6, jj+1), colors.lemonchiffon))
-
-                if oc.moon_sep(i, tname) < params.moonsep['limit']:
-                    l_tablestyle.append(('BACKGROUND', (7, jj+1), (7, jj+1), colors.lightcoral))
-                elif oc.moon_sep(i, tname) < params.moonsep['warn']:
-                    l_tablestyle.append(('BACKGROUND', (7, jj+1), (7, jj+1), colors.lemonchiffon))
-
-                if oc.moon_altaz(i).alt > params.moonalt['limit']:
-                    if oc.moon_ill(i) > params.moonill['limit']:
-                        l_tablestyle.append(('BACKGROUND', (8, jj+1), (8, jj+1), colors.lightcoral))
-                    elif oc.moon_ill(i) > params.moonill['warn']:
-                        l_tablestyle.append(('BACKGROUND', (8, jj+1), (8, jj+1), colors.lemonchiffon))
-
-                if oc.moon_altaz(i).alt > params.moonalt['limit']:
-                    l_tablestyle.append(('BACKGROUND', (9, jj+1), (9, jj+1), colors.lightcoral))
-                elif oc.moon_altaz(i).alt > params.moonalt['warn']:
-                    l_tablestyle.append(('BACKGROUND', (8, jj+1), (8, jj+1), colors.lemonchiffon))
-                """
-                if mars_sep[(i, tname)] < planetssep_limit:
-                    l_tablestyle.append(('BACKGROUND', (9, jj+1), (9, jj+1), colors.lightcoral))
-                elif mars_sep[(i, tname)] < planetssep_warn:
-                    l_tablestyle.append(('BACKGROUND', (9, jj+1), (9, jj+1), colors.lemonchiffon))
-                if jupiter_sep[(i, tname)] < planetssep_limit:
-                    l_tablestyle.append(('BACKGROUND', (10, jj+1), (10, jj+1), colors.lightcoral))
-                elif jupiter_sep[(i, tname)] < planetssep_warn:
-                    l_tablestyle.append(('BACKGROUND', (10, jj+1), (10, jj+1), colors.lemonchiffon))
-                if saturn_sep[(i, tname)] < planetssep_limit:
-                    l_tablestyle.append(('BACKGROUND', (11, jj+1), (11, jj+1), colors.lightcoral))
-                elif saturn_sep[(i, tname)] < planetssep_warn:
-                    l_tablestyle.append(('BACKGROUND', (11, jj+1), (11, jj+1), colors.lemonchiffon))
-                """
-
-                jj += 1
-            
+        values = [(frame[name].data, frame[f'{name}_code'].data, fmt) for name, fmt in columns]
+        for k in range(len(frame)):
+            data.append([frame['name'][k], frame['time'][k]] + [format(v[k], fmt) for v, _, fmt in values])
+            # Background of the cells in the warning and limit ranges (the first two rows are the header)
+            for col, (_, codes, _) in enumerate(values, 2):
+                if codes[k] != OK:
+                    l_tablestyle.append(('BACKGROUND', (col, k+2), (col, k+2), background[codes[k]]))
+
         tables.append(data)
         tablestyles.append(l_tablestyle)
 
     return texts, tables, tablestyles
 
-# Function to write text and table data to a multi-page PDF
-def write_text_and_table_to_pdf(texts, tables, tablestyles, params):
-
-    # Get the current date
-    current_date = datetime.datetime.now()
-
-    # Format the version string with current date as YYYYMMDD
-    version_date = current_date.strftime("%Y%m%d")
+# Images of the first page of the PDF report, in order
+REPORT_IMAGES = ['elevation', 'observed_counts', 'rot_angle', 'hour_angle']
 
-    # Extract the base filename (without .pdf)
+def report_filename(params, suffix=''):
+    """
+    日付の版を付けた PDF のファイル名 (<fname_report>.v<YYYYMMDD>[.<suffix>].pdf) を返します。
+    """
+    version_date = datetime.datetime.now().strftime("%Y%m%d")
     base_filename = params.fname_report.replace('.pdf', '')
+    return f"{base_filename}.v{version_date}.{suffix}.pdf" if suffix else f"{base_filename}.v{version_date}.pdf"
 
-    # Create the new filename with version date
-    fname_report_versioned = f"{base_filename}.v{version_date}.pdf"
-
-    pdf = SimpleDocTemplate(fname_report_versioned, pagesize=A4)
-    elements = []
-
-    # Define a custom style for the text
+def title_style():
+    # Custom style for the titles
     styles = getSampleStyleSheet()
-    custom_style = ParagraphStyle(
+    return ParagraphStyle(
         name='CustomStyle',
         parent=styles['Normal'],
         fontSize=16,  # Set font size
@@ -250,76 +220,78 @@ def write_text_and_table_to_pdf(texts, tables, tablestyles, params):
         spaceAfter=12  # Space after paragraph
     )
 
-    # Add text with the custom style
-    text = f'Observing plan for {params.fname_obsdate}'
-    paragraph = Paragraph(text, custom_style)
-    elements.append(paragraph)
-
-    img1 = Image('elevation.png', width=7*inch, height=4.5*inch)
-    elements.append(img1)
-    # Add some space between images
-    elements.append(Spacer(1, 12))
-    img2 = Image('observed_counts.png', width=7*inch, height=4.5*inch)
-    elements.append(img2)
-    # Add some space between images
-    elements.append(Spacer(1, 12))
-
-    img3 = Image('rot_angle.png', width=7*inch, height=4.5*inch)
-    elements.append(img3)
-    # Add some space between images
-    elements.append(Spacer(1, 12))
-    img4 = Image('hour_angle.png', width=7*inch, height=4.5*inch)
-    elements.append(img4)
-    # Add some space between images
-    elements.append(Spacer(1, 12))
-
-    # Add a page break after each page except the last one
-    elements.append(PageBreak())
-
-    for text, data, ts in zip(texts, tables, tablestyles):
-        # Create a list to hold the elements that should be kept together
-        keep_together_elements = []
+def nightSection(text, data, ts, style):
+    """
+    1 夜分のタイトルと表を、同じページに収める flowable にします。
+    """
+    table = Table(data)
+    table.setStyle(TableStyle([
+        ('SPAN', (4, 0), (5, 0)),
+        ('BACKGROUND', (0, 0), (-1, 1), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 1), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 1), 9),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ] + ts))
+    return KeepTogether([Paragraph(text, style), Spacer(1, 12), table, Spacer(1, 12)])
 
-        # Add text with the custom style
-        paragraph = Paragraph(text, custom_style)
-        keep_together_elements.append(paragraph)
-
-        # Add some space between text and table
-        keep_together_elements.append(Spacer(1, 12))
-
-        # Create the table
-        table = Table(data)
-
-        # Add style to the table
-        style = TableStyle([
-            ('SPAN', (4, 0), (5, 0)),
-            ('BACKGROUND', (0, 0), (-1, 1), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 1), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 1), 9),
-            #('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            #('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ] + ts)
-        table.setStyle(style)
-
-        # Add the table to the elements list
-        keep_together_elements.append(table)
-
-        # Add some space between text and table
-        keep_together_elements.append(Spacer(1, 12))
-
-        # Add a page break after each page except the last one
-        #elements.append(PageBreak())
+# Function to write text and table data to a multi-page PDF
+@profiled()
+def write_text_and_table_to_pdf(texts, tables, tablestyles, params, images=None):
+    """
+    図と夜ごとの表を 1 つの PDF に書きます。
+
+    Args:
+        texts (list): 夜ごとのタイトル。
+        tables (list): 夜ごとの表の行。
+        tablestyles (list): 夜ごとの表のスタイル。
+        params: Params オブジェクト
+        images (dict): REPORT_IMAGES の名前をキー、PNG のバイト列を値とする辞書。
+            None の場合は作業ディレクトリの <名前>.png を読みます。ない図は省略します。
+
+    Returns:
+        str: PDF のファイル名。
+    """
+    fname_report_versioned = report_filename(params)
+    pdf = SimpleDocTemplate(fname_report_versioned, pagesize=A4)
+    custom_style = title_style()
+
+    elements = [Paragraph(f'Observing plan for {params.fname_obsdate}', custom_style)]
+    for name in REPORT_IMAGES:
+        if images is None:
+            source = f'{name}.png'
+        elif name in images:
+            source = io.BytesIO(images[name])
+        else:
+            continue
+        elements.append(Image(source, width=7*inch, height=4.5*inch))
+        # Add some space between images
+        elements.append(Spacer(1, 12))
+
+    # Add a page break after the images
+    elements.append(PageBreak())
 
-        # Add the keep_together_elements to the main elements list using KeepTogether
-        elements.append(KeepTogether(keep_together_elements))
+    elements += [nightSection(text, data, ts, custom_style) for text, data, ts in zip(texts, tables, tablestyles)]
 
     # Build the PDF
     pdf.build(elements)
-
-def printSchedule_PDF(obsSlotList, observer, oc, params):
+    return fname_report_versioned
+
+@profiled()
+def write_night_pdf(text, data, ts, params, date):
+    """
+    1 夜分の表を <fname_report>.v<YYYYMMDD>.<date>.pdf に書きます。
+    夜ごとに別のプロセスで作れるので、長い期間の報告を並列に、できた夜から順に出力できます。
+
+    Returns:
+        str: PDF のファイル名。
+    """
+    fname = report_filename(params, date)
+    SimpleDocTemplate(fname, pagesize=A4).build([nightSection(text, data, ts, title_style())])
+    return fname
+
+def printSchedule_PDF(obsSlotList, observer, oc, params, images=None):
     texts, tables, tablestyles = createTableContents(obsSlotList, observer, oc, params)
 
-    write_text_and_table_to_pdf(texts, tables, tablestyles, params)
\ No newline at end of file
+    write_text_and_table_to_pdf(texts, tables, tablestyles, params, images)
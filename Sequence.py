@@ -0,0 +1,262 @@
+from Optimize import ROTANG_MIN, ROTANG_MAX
+from ObservingConditions import slew_times_deg
+from Profiling import profiled
+import astropy.units as u
+import numpy as np
+import time
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+def block_key(target):
+    """
+    ブロックのキーを返します。GA のサブポインティングはフィールド単位でまとめます
+    (フィールド内の順序は reorderGAtargets で決まっているため)。
+    """
+    if target.wg == 'GA':
+        return target.name[:target.name.rindex('_')]
+    return target.name
+
+def night_runs(obsSlotList):
+    """
+    同じ夜の連続した使用済みスロットの並びを返します。
+
+    Args:
+        obsSlotList: ObsSlotList オブジェクト
+
+    Returns:
+        list: スロットのリストのリスト (2 スロット以上の並びのみ)。
+    """
+    runs = []
+    run = []
+    prev = None
+    for slot in obsSlotList.get_all_slots():
+        if slot.target is None or prev is None or prev.target is None or slot.date != prev.date:
+            if len(run) > 1:
+                runs.append(run)
+            run = []
+        if slot.target is not None:
+            run.append(slot)
+        prev = slot
+    if len(run) > 1:
+        runs.append(run)
+    return runs
+
+def split_blocks(targets, key):
+    """
+    連続して同じキーを持つ要素をまとめたリストのリストに分割します。
+    """
+    blocks = []
+    for target in targets:
+        if blocks and key(blocks[-1][-1]) == key(target):
+            blocks[-1].append(target)
+        else:
+            blocks.append([target])
+    return blocks
+
+def two_opt(items, evaluate, max_passes):
+    """
+    区間の反転 (2-opt) で評価値が下がらなくなるまで並びを改善します。
+
+    Args:
+        items (list): 並べ替える要素のリスト。
+        evaluate: 並びを受け取り、比較可能な評価値を返す関数。
+        max_passes (int): 最大の反復回数。
+
+    Returns:
+        tuple: 改善した並びとその評価値。
+    """
+    best = evaluate(items)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(items)-1):
+            for j in range(i+1, len(items)):
+                candidate = items[:i] + items[i:j+1][::-1] + items[j+1:]
+                score = evaluate(candidate)
+                if score < best:
+                    items, best, improved = candidate, score, True
+        if not improved:
+            break
+    return items, best
+
+class SequenceEvaluator:
+    """
+    Scores the order of the targets in a run of consecutive slots.
+
+    The score is (number of violated constraints, total slew time in minutes). The airmass,
+    hour-angle and rotator limits are checked at the slot times shifted by the cumulative
+    slew time, as updateTimeBySlew will do, by interpolating the ObservingConditions grids.
+    The visibility and the separations from the Moon and planets are checked at the nominal slot times.
+    All the (slot, target) quantities of the run are tabulated once, so that scoring an order
+    only takes a few array operations.
+
+    The positions of the run can be offset from the slot times (offsets), and the slew from the
+    current telescope position to the first target can be included (start), for the dispatcher.
+    """
+
+    def __init__(self, islots, targets, oc, params, observer, offsets=None, start=None):
+        """
+        Args:
+            islots (list): 各位置のスロットのインデックス (slot.index)。
+            targets (list): 並べるターゲット (重複可)。
+            oc: ObservingConditions オブジェクト
+            params: Params オブジェクト
+            observer: MyObserver オブジェクト
+            offsets (Quantity): 各位置のスロットの時刻からのずれ。None の場合は 0。
+            start (tuple): 望遠鏡の現在の (az, alt, rotang) (deg)。None の場合は最初のスリューを数えません。
+        """
+        targets = list({t.name: t for t in targets}.values())
+        self._columns = {t.name: i for i, t in enumerate(targets)}
+        islots = np.asarray(islots)[:, np.newaxis]
+        names = np.array([t.name for t in targets], dtype=object)[np.newaxis, :]
+        self._positions = np.arange(len(islots))
+        if offsets is None:
+            offsets = np.zeros(len(islots)) * u.minute
+        offsets = offsets[:, np.newaxis]
+
+        # Slew time (minutes) from each target in a slot to each target in the next slot
+        self._slews = np.nan_to_num(oc.slew_times(islots[:-1, :, np.newaxis], names[:, :, np.newaxis],
+                                                  names[:, np.newaxis, :]).to(u.minute).value)
+
+        # Slew time (minutes) from the current telescope position to each target in the first slot
+        self._start_slews = np.zeros(len(targets))
+        if start is not None and len(islots):
+            first = {name: oc.interpolate(name, islots[:1], names, offsets[:1])[0]
+                     for name in ['az', 'alt', 'rotang_start']}
+            self._start_slews = slew_times_deg(start[0], start[1], start[2],
+                                               first['az'], first['alt'], first['rotang_start'], params)
+
+        # Visibility and separations from the Moon and planets at the nominal slot times
+        self._feasible = oc.visible_mask(islots, names)
+        self._feasible &= oc.interpolate('moon_sep', islots, names, offsets) >= params.moonsep['limit'].to(u.deg).value
+        for planet in ["mars", "jupiter", "saturn"]:
+            self._feasible &= oc.interpolate(f'{planet}_sep', islots, names, offsets) \
+                >= params.planetssep['limit'].to(u.deg).value
+
+        # Value and rate of change (per minute) of the limited quantities
+        self._values = {}
+        self._rates = {}
+        for name in ['airmass', 'ha', 'rotang_start', 'rotang_end']:
+            v0 = oc.interpolate(name, islots, names, offsets)
+            v1 = oc.interpolate(name, islots, names, offsets + 1 * u.minute)
+            self._values[name] = v0
+            self._rates[name] = np.mod(v1 - v0 + 180.0, 360.0) - 180.0 if name.startswith('rotang') else v1 - v0
+
+        self._airmass_limit = np.array([params.airmass['limit'][t.wg] for t in targets])
+        self._meridian = np.array([t.coord.dec > observer.location.lat for t in targets]) \
+            * params.meridian['warn'].to(u.hourangle).value
+        self._rotang_min = np.array([ROTANG_MIN[t.wg] for t in targets])
+        self._rotang_max = np.array([ROTANG_MAX[t.wg] for t in targets])
+
+    def _at(self, name, positions, cols, shifts):
+        return self._values[name][positions, cols] + shifts * self._rates[name][positions, cols]
+
+    def _violations(self, positions, cols, shifts):
+        # Violated constraints of the target cols[k] at the position positions[k] shifted by shifts[k] minutes
+        violations = ~self._feasible[positions, cols]
+        violations = violations.astype(int)
+        violations += self._at('airmass', positions, cols, shifts) > self._airmass_limit[cols]
+        violations += np.abs(self._at('ha', positions, cols, shifts)) < self._meridian[cols]
+        for name in ['rotang_start', 'rotang_end']:
+            rotang = np.mod(self._at(name, positions, cols, shifts) + 180.0, 360.0) - 180.0
+            violations += (rotang < self._rotang_min[cols]) | (rotang > self._rotang_max[cols])
+        return violations
+
+    def feasible(self, targets):
+        """
+        各位置で各ターゲットが制約を満たすか (時刻のずれなし) を返します。
+
+        Returns:
+            ndarray: 形状 (位置, ターゲット) の bool 配列。
+        """
+        positions = np.repeat(self._positions, len(targets))
+        cols = np.tile([self._columns[t.name] for t in targets], len(self._positions)).astype(int)
+        violations = self._violations(positions, cols, np.zeros(len(cols)))
+        return (violations == 0).reshape(len(self._positions), len(targets))
+
+    def __call__(self, targets):
+        cols = np.array([self._columns[t.name] for t in targets])
+        positions = self._positions[:len(cols)]
+        if len(cols) == 0:
+            return (0, 0.0)
+        slews = np.concatenate([[self._start_slews[cols[0]]], self._slews[positions[:-1], cols[:-1], cols[1:]]])
+        shifts = np.cumsum(slews)
+        return (int(self._violations(positions, cols, shifts).sum()), float(slews.sum()))
+
+def resequence(targets, evaluate, params, max_passes):
+    """
+    ターゲット (GA はフィールド) のブロックを WG のまとまりの中で並べ替え、次に WG のまとまりを並べ替えます。
+    各 WG・各ターゲットの連続観測はそのまま保たれ、GA_last の場合は GA を最後に残します。
+
+    Args:
+        targets (list): 並べ替えるターゲットのリスト。
+        evaluate: SequenceEvaluator オブジェクト
+        params: Params オブジェクト
+        max_passes (int): 2-opt の最大反復回数。
+
+    Returns:
+        tuple: 並べ替えたターゲットのリストとその評価値。
+    """
+    groups = [split_blocks(group, block_key) for group in split_blocks(targets, lambda t: t.wg)]
+
+    def flatten(groups):
+        return [t for group in groups for block in group for t in block]
+
+    # Order of the target blocks within each WG group
+    for g in range(len(groups)):
+        groups[g], _ = two_opt(groups[g], lambda blocks: evaluate(flatten(groups[:g] + [blocks] + groups[g+1:])),
+                               max_passes)
+
+    # Order of the WG groups (GA groups stay at the end)
+    n_free = len(groups)
+    if params.GA_last:
+        while n_free > 0 and groups[n_free-1][0][0].wg == 'GA':
+            n_free -= 1
+    head, score = two_opt(groups[:n_free], lambda head: evaluate(flatten(head + groups[n_free:])), max_passes)
+    return flatten(head + groups[n_free:]), score
+
+@profiled()
+def optimizeSequence(obsSlotList, oc, params, observer, max_passes=10, dates=None):
+    """
+    各夜の連続したスロットの中でターゲットの順序を入れ替え、スリュー時間の合計を最小化します。
+    reorderGAtargets の後、updateTimeBySlew の前に実行します。
+
+    並べ替えは resequence で行います (各 WG・各ターゲットの連続観測はそのまま保たれます)。
+
+    Args:
+        obsSlotList: ObsSlotList オブジェクト
+        oc: ObservingConditions オブジェクト
+        params: Params オブジェクト
+        observer: MyObserver オブジェクト
+        max_passes (int): 2-opt の最大反復回数。
+        dates (list): 並べ替える夜。None の場合は全ての夜。
+
+    Returns:
+        tuple: 最適化前と後のスリュー時間の合計 (分)。
+    """
+    total_before = 0.0
+    total_after = 0.0
+    for slots in night_runs(obsSlotList):
+        if dates is not None and slots[0].date not in dates:
+            continue
+        t0 = time.perf_counter()
+        targets = [slot.target for slot in slots]
+        evaluate = SequenceEvaluator([slot.index for slot in slots], targets, oc, params, observer)
+        score_before = evaluate(targets)
+        targets, score_after = resequence(targets, evaluate, params, max_passes)
+
+        if score_after < score_before:
+            for slot, target in zip(slots, targets):
+                slot.target = target
+        else:
+            score_after = score_before
+
+        total_before += score_before[1]
+        total_after += score_after[1]
+        logger.info(f"Sequence {slots[0].date} slots {slots[0].index}-{slots[-1].index}: "
+                    f"slew {score_before[1]:.1f} -> {score_after[1]:.1f} min, "
+                    f"violations {score_before[0]} -> {score_after[0]} ({(time.perf_counter()-t0)*1e3:.1f} ms)")
+
+    logger.info(f"Total slew time: {total_before:.1f} -> {total_after:.1f} min")
+    return total_before, total_after
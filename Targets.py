@@ -24,6 +24,83 @@ class Target:
     def __repr__(self):
         return f"Target({self.wg}, {self.name}, {self.coord}, {self.pa}, {self.nexp}, {self.priority}, {self.observed})"
     
+def field_name(target):
+    """
+    GA のサブポインティングが属するフィールド名を返します (GA 以外はターゲット名)。
+    """
+    if target.wg == 'GA' and '_' in target.name:
+        return target.name[:target.name.rindex('_')]
+    return target.name
+
+class TargetField(Target):
+    """
+    GA field modelled as a single target in the optimization.
+
+    The sub-pointings of a field share the pointing, so the optimizer only has to decide
+    how many slots the field gets. The number of exposures, the observed count and the
+    priority are derived from the members; next_member() disaggregates the slots of the
+    field onto the members in (priority, name) order, as reorderGAtargets does.
+    """
+    def __init__(self, name, members):
+        self.members = sorted(members, key=lambda x: (x.priority, x.name))
+        self.wg = self.members[0].wg
+        self.name = name
+        self.coord = self.members[0].coord
+        self.pa = self.members[0].pa
+
+    @property
+    def nexp(self):
+        return sum(t.nexp for t in self.members)
+
+    @property
+    def observed(self):
+        return sum(t.observed for t in self.members)
+
+    @property
+    def priority(self):
+        # Priority of the member observed first
+        return self.next_member().priority
+
+    def next_member(self):
+        """
+        次に観測するメンバーを返します (全て完了している場合は最後のメンバー)。
+        """
+        for t in self.members:
+            if t.observed < t.nexp:
+                return t
+        return self.members[-1]
+
+    def __repr__(self):
+        return f"TargetField({self.wg}, {self.name}, {[t.name for t in self.members]})"
+
+def aggregate_fields(targets):
+    """
+    同じポインティングを持つ GA のサブポインティングを TargetField にまとめます。
+
+    Args:
+        targets (list): Target のリスト。
+
+    Returns:
+        list: GA のフィールドを TargetField に置き換えたリスト。
+    """
+    fields = {}
+    for t in targets:
+        if t.wg == 'GA':
+            fields.setdefault(field_name(t), []).append(t)
+
+    aggregated = []
+    done = set()
+    for t in targets:
+        name = field_name(t)
+        members = fields.get(name) if t.wg == 'GA' else None
+        if members is None or len(members) == 1 \
+                or len(set((m.coord.ra.deg, m.coord.dec.deg, m.pa.to(u.deg).value) for m in members)) > 1:
+            aggregated.append(t)
+        elif name not in done:
+            aggregated.append(TargetField(name, members))
+            done.add(name)
+    return aggregated
+
 class TargetList:
     def __init__(self):
         self.targets = []
@@ -0,0 +1,230 @@
+from astropy.time import Time
+import astropy.units as u
+from astropy.coordinates import get_body
+import numpy as np
+from Profiling import profiled
+
+# Configure logging
+import logging
+logger = logging.getLogger(__name__)
+
+# Ratio of the sidereal to the solar time
+SIDEREAL_RATE = 1.00273790935
+
+def unit_vectors(ra, dec):
+    """
+    赤経・赤緯 (rad) から単位ベクトルを計算します。
+
+    Args:
+        ra (ndarray): 赤経 (rad)。
+        dec (ndarray): 赤緯 (rad)。
+
+    Returns:
+        ndarray: 形状 (..., 3) の単位ベクトル。
+    """
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+def separation_matrix(vectors1, vectors2):
+    """
+    単位ベクトルの組の全ての組み合わせについて角距離 (deg) を一度の行列積で計算します。
+
+    Args:
+        vectors1 (ndarray): 形状 (n1, 3) の単位ベクトル。
+        vectors2 (ndarray): 形状 (n2, 3) の単位ベクトル。
+
+    Returns:
+        ndarray: 形状 (n1, n2) の角距離 (deg)。
+    """
+    return np.degrees(np.arccos(np.clip(vectors1 @ vectors2.T, -1.0, 1.0)))
+
+class VisibilityWindows:
+    """
+    Per-target nightly observable windows derived analytically from the hour angle.
+
+    For each (target, night) the windows are the intervals where the target is above
+    the altitude of its WG airmass limit, minus the meridian-avoidance gap for the
+    targets north of the zenith. Nights where the Moon stays closer than the limit
+    are excluded as a whole. The windows are widened by small margins so that they
+    never exclude a (slot, target) pair allowed by the exact conditions.
+    """
+
+    @profiled('VisibilityWindows')
+    def __init__(self, obsSlotList, targetList, observer, params,
+                 alt_margin=0.5 * u.deg, time_margin=5 * u.minute, sep_margin=1 * u.deg):
+
+        self.observer = observer
+        self.params = params
+
+        targets = targetList.get_all_targets()
+        self._target_indices = {target.name: i for i, target in enumerate(targets)}
+
+        # Night boundaries from the observation slots
+        self.dates = list(obsSlotList.dates)
+        self._date_indices = {date: i for i, date in enumerate(self.dates)}
+        night_start = np.full(len(self.dates), np.inf)
+        night_end = np.full(len(self.dates), -np.inf)
+        for slot in obsSlotList:
+            n = self._date_indices[slot.date]
+            night_start[n] = min(night_start[n], slot.start.jd)
+            night_end[n] = max(night_end[n], slot.end.jd)
+        self._night_start = night_start
+        self._night_end = night_end
+
+        ra = np.array([target.coord.ra.rad for target in targets])
+        dec = np.array([target.coord.dec.rad for target in targets])
+        lat = observer.location.lat.rad
+
+        logger.info("Calculating visibility windows")
+        # Hour angle (hours) of each target at the start of each night
+        lst0 = Time(night_start, format='jd').sidereal_time('mean', longitude=observer.longitude).hour
+        ha0 = (lst0[np.newaxis, :] - np.degrees(ra)[:, np.newaxis] / 15.0 + 12.0) % 24.0 - 12.0
+
+        # Half width of the hour-angle range above the airmass limit (airmass = sec z)
+        alt_min = np.array([np.arcsin(1.0 / params.airmass['limit'][target.wg]) for target in targets]) \
+            - alt_margin.to(u.rad).value
+        cos_h0 = (np.sin(alt_min) - np.sin(lat) * np.sin(dec)) / (np.cos(lat) * np.cos(dec))
+        h0 = np.where(cos_h0 > 1.0, np.nan, np.degrees(np.arccos(np.clip(cos_h0, -1.0, 1.0))) / 15.0)
+
+        margin = time_margin.to(u.day).value
+        self._rise, self._set = self._intervals(ha0, h0)
+        self._rise -= margin
+        self._set += margin
+
+        # Meridian-avoidance gap for the targets north of the zenith
+        is_north = dec > lat
+        gap = np.where(is_north, params.meridian['warn'].to(u.hourangle).value, np.nan)
+        self._gap_start, self._gap_end = self._intervals(ha0, gap)
+        self._gap_start += margin
+        self._gap_end -= margin
+
+        # Nights where the Moon is always closer than the limit (sampled at start, middle and end)
+        times = Time(np.concatenate([night_start, 0.5 * (night_start + night_end), night_end]), format='jd')
+        moon = get_body('moon', times, observer.location)
+        moon_sep = separation_matrix(unit_vectors(ra, dec), unit_vectors(moon.ra.rad, moon.dec.rad)).reshape(len(targets), 3, len(self.dates))
+        self.moon_sep_min = moon_sep.min(axis=1)
+        self._moon_excluded = np.all(moon_sep < (params.moonsep['limit'] - sep_margin).to(u.deg).value, axis=1)
+
+        # (target, night) blocks with a window inside the night, computed once for observable() and window()
+        overlap = np.any((self._rise < night_end[np.newaxis, :, np.newaxis])
+                         & (self._set > night_start[np.newaxis, :, np.newaxis]), axis=2)
+        self._observable = overlap & ~self._moon_excluded
+
+        n_visible = np.count_nonzero(self._observable)
+        logger.info(f"{n_visible} of {self._observable.size} (target, night) blocks are observable")
+
+    def _intervals(self, ha0, half_width):
+        """
+        時角が [-half_width, half_width] に入る時刻 (JD) の区間を計算します。
+        夜の長さは 1 恒星日より短いので、各夜について 2 周期分の区間を返します。
+
+        Args:
+            ha0 (ndarray): 夜の開始時の時角 (hour)、形状 (target, night)。
+            half_width (ndarray): 時角の半幅 (hour)、形状 (target,)。NaN の場合は区間なし。
+
+        Returns:
+            tuple: 区間の開始と終了 (JD)、形状 (target, night, 2)。
+        """
+        cycle = np.array([0.0, 24.0])
+        hw = half_width[:, np.newaxis, np.newaxis]
+        start = (-hw - ha0[:, :, np.newaxis] + cycle) / SIDEREAL_RATE / 24.0
+        end = (hw - ha0[:, :, np.newaxis] + cycle) / SIDEREAL_RATE / 24.0
+        night_start = self._night_start[np.newaxis, :, np.newaxis]
+        return night_start + start, night_start + end
+
+    def _visible_at(self, it, n, jd):
+        """
+        時刻 jd (JD) にターゲットが観測可能かを判定します。it, n, jd はブロードキャストされます。
+        """
+        jd = np.asarray(jd)[..., np.newaxis]
+        up = np.any((self._rise[it, n] <= jd) & (jd <= self._set[it, n]), axis=-1)
+        in_gap = np.any((self._gap_start[it, n] < jd) & (jd < self._gap_end[it, n]), axis=-1)
+        return up & ~in_gap & ~self._moon_excluded[it, n]
+
+    def observable(self, tname, date):
+        """
+        ターゲットがその夜に観測可能な時間帯を持つかを返します。
+        """
+        if tname not in self._target_indices or date not in self._date_indices:
+            return True
+        return bool(self._observable[self._target_indices[tname], self._date_indices[date]])
+
+    def window(self, tname, date):
+        """
+        ターゲットがその夜に airmass limit より上にある時間帯を返します。
+
+        Returns:
+            tuple: 開始と終了の Time (夜の範囲に制限)。観測できない場合は None。
+        """
+        if not self.observable(tname, date):
+            return None
+        it = self._target_indices[tname]
+        n = self._date_indices[date]
+        night_start = self._night_start[n]
+        night_end = self._night_end[n]
+        valid = (self._rise[it, n] < night_end) & (self._set[it, n] > night_start)
+        start = max(self._rise[it, n][valid].min(), night_start)
+        end = min(self._set[it, n][valid].max(), night_end)
+        return Time(start, format='jd'), Time(end, format='jd')
+
+    def meridian_gap(self, tname, date):
+        """
+        その夜の子午線回避の時間帯を返します。該当しない場合は None。
+        """
+        it = self._target_indices[tname]
+        n = self._date_indices[date]
+        valid = (self._gap_start[it, n] < self._gap_end[it, n]) \
+            & (self._gap_start[it, n] < self._night_end[n]) & (self._gap_end[it, n] > self._night_start[n])
+        if not np.any(valid):
+            return None
+        k = np.argmax(valid)
+        return Time(self._gap_start[it, n, k], format='jd'), Time(self._gap_end[it, n, k], format='jd')
+
+    def observable_mask(self, targetList, dates):
+        """
+        (target, night) ごとに観測可能な時間帯を持つかを返します。
+        この VisibilityWindows が知らないターゲットや夜は観測可能として扱います。
+
+        Args:
+            targetList: TargetList オブジェクト
+            dates (list): 夜 (ローカルの日付) のリスト。
+
+        Returns:
+            ndarray: 形状 (target, night) の bool 配列。
+        """
+        targets = targetList.get_all_targets()
+        mask = np.ones((len(targets), len(dates)), dtype=bool)
+
+        it = np.array([self._target_indices.get(target.name, -1) for target in targets], dtype=int)
+        n = np.array([self._date_indices.get(date, -1) for date in dates], dtype=int)
+        rows = np.flatnonzero(it >= 0)
+        cols = np.flatnonzero(n >= 0)
+        if len(rows) and len(cols):
+            mask[np.ix_(rows, cols)] = self._observable[np.ix_(it[rows], n[cols])]
+        return mask
+
+    def mask(self, obsSlotList, targetList):
+        """
+        (target, slot) ごとにスロットの中央時刻が観測可能な時間帯に入るかを返します。
+        この VisibilityWindows が知らないターゲットや夜は観測可能として扱います。
+
+        Args:
+            obsSlotList: ObsSlotList オブジェクト
+            targetList: TargetList オブジェクト
+
+        Returns:
+            ndarray: 形状 (target, slot) の bool 配列。
+        """
+        slots = obsSlotList.get_all_slots()
+        targets = targetList.get_all_targets()
+        mask = np.ones((len(targets), len(slots)), dtype=bool)
+
+        it = np.array([self._target_indices.get(target.name, -1) for target in targets])
+        n = np.array([self._date_indices.get(slot.date, -1) for slot in slots])
+        jd = np.array([slot.mid.jd for slot in slots])
+        rows = np.flatnonzero(it >= 0)
+        cols = np.flatnonzero(n >= 0)
+        if len(rows) and len(cols):
+            mask[np.ix_(rows, cols)] = self._visible_at(it[rows][:, np.newaxis], n[cols][np.newaxis, :],
+                                                        jd[cols][np.newaxis, :])
+        return mask
@@ -3,8 +3,27 @@ from astropy.io import ascii
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.table import Table, vstack
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import argparse
+import logging
 import re
 
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Default list of working groups (WG).
+WG_LIST = ['GA', 'GE', 'CO']
+
+# Columns kept from each ppcList.ecsv file.
+PPC_COLUMNS = ['ppc_code', 'ppc_ra', 'ppc_dec', 'ppc_pa', 'ppc_resolution', 'ppc_priority', 'ppc_exptime', 'ppc_nframes']
+
+# Keys identifying a unique pointing in the target table.
+GROUP_KEYS = ['ra', 'dec', 'ppc_pa', 'ppc_priority']
+
+# Exposure time of a single exposure (seconds)
+T_EXPOSURE = 900
+
 # Function to find the longest common prefix among a list of strings.
 def longest_common_prefix(strings):
     """
@@ -34,125 +53,172 @@ def natural_sort_key(s):
     Generate a key for natural sorting where numbers within strings are sorted numerically
     rather than lexicographically.
     """
-    return [int(text) if text.isdigit() else text.lower() 
+    return [int(text) if text.isdigit() else text.lower()
             for text in re.split(r'(\d+)', s)]
 
-# Define the directory where the target data files are located.
-ref_dir = '/home/yasuda/spt_ssp_observation/runs/2025-05/targets'
+def target_name(ppc_codes):
+    """
+    Derive the target name from the ppc_code of the rows of a pointing.
 
-# Define the list of working groups (WG).
-wg_list = ['GA', 'GE', 'CO']
-wg_list_exist = []
+    Args:
+        ppc_codes: A list of ppc_code strings sharing the same pointing.
 
-# Initialize an empty dictionary to store data for each working group.
-d = dict()
+    Returns:
+        The target name.
+    """
+    # Find the longest common prefix of the 'ppc_code' for the selected rows.
+    ppc_code = longest_common_prefix(ppc_codes)
+
+    # Special handling for 'SSP_GA' and 'EN1' prefixes.
+    if ppc_code.startswith('SSP_GA'):
+        ppc_code = ppc_code[:ppc_code.rfind('V')]
+    elif ppc_code.startswith('EN1'):
+        ppc_code = ppc_code[:ppc_code.rfind('_')]
+    return ppc_code
 
-# Loop through each working group.
-for wg in wg_list:
+def read_ppc_list(ref_dir, wg):
+    """
+    Read the ppcList.ecsv file of a working group.
 
-    if os.path.exists(f"{ref_dir}/{wg}/ppcList.ecsv") == False:
-        print(f"File not found: {ref_dir}/{wg}/ppcList.ecsv")
-        continue
+    Args:
+        ref_dir: Directory containing one sub-directory per working group.
+        wg: Working group name.
 
-    # Append the existing working group to wg_list_exist.
-    wg_list_exist.append(wg)
+    Returns:
+        Table with the ppc columns and the formatted 'ra', 'dec' and 'wg' columns,
+        or None if the file does not exist.
+    """
+    fname = f"{ref_dir}/{wg}/ppcList.ecsv"
+    if not os.path.exists(fname):
+        logger.warning(f"File not found: {fname}")
+        return None
 
     # Read the target data file for the current working group.
-    data = ascii.read(f"{ref_dir}/{wg}/ppcList.ecsv")
-
-    # Extract RA and Dec from the data.
-    ra = data['ppc_ra']
-    dec = data['ppc_dec']
+    data = ascii.read(fname)
 
     # Create SkyCoord objects for each target.
-    c = SkyCoord(ra=ra, dec=dec, unit=(u.deg, u.deg))
+    c = SkyCoord(ra=data['ppc_ra'], dec=data['ppc_dec'], unit=(u.deg, u.deg))
 
     # Convert RA and Dec to string format (HH:MM:SS and +/-DD:MM:SS).
-    ra_str = c.ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True)
-    dec_str = c.dec.to_string(sep=':', precision=1, alwayssign=True, pad=True)
-
-    # Add the formatted RA and Dec strings to the data table.
-    data['ra'] = ra_str
-    data['dec'] = dec_str
+    data['ra'] = c.ra.to_string(unit=u.hourangle, sep=':', precision=2, pad=True)
+    data['dec'] = c.dec.to_string(sep=':', precision=1, alwayssign=True, pad=True)
 
     # Add the working group name to the data table.
     data['wg'] = wg
 
     # Select the relevant columns for each working group.
-    d[wg] = data['ppc_code', 'ppc_ra', 'ppc_dec', 'ppc_pa', 'ppc_resolution', 'ppc_priority', 'ppc_exptime', 'ppc_nframes', 'ra', 'dec', 'wg']
-    #if wg != 'GE':
-    #    d[wg] = data['ppc_code', 'ppc_ra', 'ppc_dec', 'ppc_pa', 'ppc_resolution', 'ppc_priority', 'ppc_exptime', 'ppc_nframes', 'ra', 'dec', 'wg']
-    #else:
-    #    # Special handling for 'GE' working group: rename 'ppc_nframe' to 'ppc_nframes'.
-    #    d[wg] = data['ppc_code', 'ppc_ra', 'ppc_dec', 'ppc_pa', 'ppc_resolution', 'ppc_priority', 'ppc_exptime', 'ppc_nframe', 'ra', 'dec', 'wg']
-    #    d[wg].rename_column('ppc_nframe', 'ppc_nframes')
-
-wg_list = wg_list_exist
-
-# Vertically stack the data tables for all working groups.
-raw_targets = vstack([d[wg] for wg in wg_list])
-
-# Create a list of unique combinations of (ra, dec, pa, priority).
-uniq_rdpp = list(set([(raw_targets[i]['ra'], raw_targets[i]['dec'], raw_targets[i]['ppc_pa'], raw_targets[i]['ppc_priority']) for i in range(len(raw_targets))]))
-
-# Create an empty table to store the final target information.
-target_table = Table(names=('wg', 'name', 'ra', 'dec', 'pa', 'nexp', 'priority'),
-                     dtype=(str, str, str, str, float, int, int))
-
-# Loop through each unique combination of (ra, dec, pa, priority).
-for ra, dec, pa, priority in uniq_rdpp:
-    # Select the rows in raw_targets that match the current combination.
-    sub = raw_targets[(raw_targets['ra'] == ra) & (raw_targets['dec'] == dec) & (raw_targets['ppc_pa'] == pa) & (raw_targets['ppc_priority'] == priority)]
-    
-    # Find the longest common prefix of the 'ppc_code' for the selected rows.
-    ppc_code = longest_common_prefix([sub[i]['ppc_code'] for i in range(len(sub))])
+    return data[PPC_COLUMNS + ['ra', 'dec', 'wg']]
 
-    # Special handling for 'SSP_GA' and 'EN1' prefixes.
-    if ppc_code.startswith('SSP_GA'):
-        ppc_code = ppc_code[:ppc_code.rfind('V')]
-    elif ppc_code.startswith('EN1'):
-        ppc_code = ppc_code[:ppc_code.rfind('_')]
+def read_ppc_lists(ref_dir, wg_list=WG_LIST, max_workers=None):
+    """
+    Read the ppcList.ecsv files of the working groups in parallel.
 
-    # Calculate the total exposure time and total number of frames.
-    tot_exptime = sub['ppc_exptime'].sum()
-    tot_nframes = sub['ppc_nframes'].sum()
+    Args:
+        ref_dir: Directory containing one sub-directory per working group.
+        wg_list: List of working group names.
+        max_workers: Number of reader threads. Defaults to one per working group.
 
-    # Get the working group name (should be the same for all rows in 'sub').
-    wg = list(set(sub['wg']))[0]
+    Returns:
+        Table stacking the rows of all existing working groups.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or len(wg_list)) as executor:
+        tables = list(executor.map(lambda wg: read_ppc_list(ref_dir, wg), wg_list))
 
-    # Calculate the number of exposures (assuming 900 seconds per exposure).
-    nexp = int(tot_exptime/900)
+    tables = [t for t in tables if t is not None]
+    if not tables:
+        raise FileNotFoundError(f"No ppcList.ecsv found under {ref_dir} for {wg_list}")
 
-    # Add a row to the target_table with the processed information.
-    target_table.add_row([wg, ppc_code, ra, dec, pa, nexp, priority])
+    # Vertically stack the data tables for all working groups.
+    return vstack(tables)
 
-# Sort the target table by working group and target name.
-target_table.sort(['wg', 'name'])
+def aggregate_targets(raw_targets):
+    """
+    Aggregate the rows of each unique (ra, dec, pa, priority) into one target.
 
-# First sort by working group
-target_table.sort('wg')
+    Args:
+        raw_targets: Table returned by read_ppc_lists.
 
-# Then sort by name within each working group
-wgs = set(target_table['wg'])
-sorted_table = Table(names=target_table.colnames, dtype=target_table.dtype)
+    Returns:
+        Table with the columns wg, name, ra, dec, pa, nexp, priority.
+    """
+    grouped = raw_targets.group_by(GROUP_KEYS)
+    keys = grouped.groups.keys
+    starts = grouped.groups.indices[:-1]
+    ends = grouped.groups.indices[1:]
 
-for group in sorted(wgs):
-    group_rows = target_table[target_table['wg'] == group]
+    # Calculate the total exposure time of each group in a single pass.
+    tot_exptime = np.add.reduceat(np.asarray(grouped['ppc_exptime'], dtype=float), starts)
 
-    if group == "CO":
-        # Use natural sort for CO working group
-        sorted_indices = sorted(range(len(group_rows)), key=lambda i: natural_sort_key(group_rows['name'][i]))
-    else:
-        # Use default sort for other working groups
-        sorted_indices = sorted(range(len(group_rows)), key=lambda i: group_rows['name'][i])
+    ppc_codes = list(grouped['ppc_code'])
+    names = [target_name(ppc_codes[i0:i1]) for i0, i1 in zip(starts, ends)]
 
-    for i in sorted_indices:
-        sorted_table.add_row(group_rows[i])
+    # Calculate the number of exposures (assuming 900 seconds per exposure).
+    nexp = (tot_exptime / T_EXPOSURE).astype(int)
 
-target_table = sorted_table
+    # The working group is the same for all rows in a group.
+    return Table([grouped['wg'][starts].astype(str), names,
+                  keys['ra'].astype(str), keys['dec'].astype(str),
+                  np.asarray(keys['ppc_pa'], dtype=float), nexp,
+                  np.asarray(keys['ppc_priority'], dtype=int)],
+                 names=('wg', 'name', 'ra', 'dec', 'pa', 'nexp', 'priority'))
 
-# Print the final target table.
-print(target_table)
+def sort_targets(target_table):
+    """
+    Sort the target table by working group, then by name within each working group.
+    Natural sort is used for the CO working group.
 
-# Write the final target table to an ECSV file.
-target_table.write('target_table_output_202505.ecsv', format='ascii.ecsv', overwrite=True)
+    Args:
+        target_table: Table returned by aggregate_targets.
+
+    Returns:
+        Sorted table.
+    """
+    def sort_key(i):
+        wg = target_table['wg'][i]
+        name = target_table['name'][i]
+        return (wg, natural_sort_key(name) if wg == 'CO' else name)
+
+    return target_table[sorted(range(len(target_table)), key=sort_key)]
+
+def convert(ref_dir, fname_output, wg_list=WG_LIST, max_workers=None):
+    """
+    Create the target table read by TargetManager from the per-WG ppcList.ecsv files.
+
+    Args:
+        ref_dir: Directory containing one sub-directory per working group.
+        fname_output: Output ECSV file name.
+        wg_list: List of working group names.
+        max_workers: Number of reader threads.
+
+    Returns:
+        The target table written to fname_output.
+    """
+    raw_targets = read_ppc_lists(ref_dir, wg_list, max_workers)
+    target_table = sort_targets(aggregate_targets(raw_targets))
+
+    # Write the final target table to an ECSV file.
+    target_table.write(fname_output, format='ascii.ecsv', overwrite=True)
+    logger.info(f"{len(target_table)} targets written to {fname_output}")
+
+    return target_table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the target table from the ppcList.ecsv files")
+    parser.add_argument('ref_dir', help='Directory containing the <WG>/ppcList.ecsv files')
+    parser.add_argument('-o', '--output', default='target_table_output.ecsv',
+                        help='Output target table (default: target_table_output.ecsv)')
+    parser.add_argument('--wg', nargs='+', default=WG_LIST,
+                        help=f'Working groups to read (default: {" ".join(WG_LIST)})')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the logging level for the application (default: INFO)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    target_table = convert(args.ref_dir, args.output, args.wg)
+
+    # Print the final target table.
+    print(target_table)
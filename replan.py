@@ -0,0 +1,131 @@
+from Params import Params
+from Targets import TargetManager
+from Optimize import OptimizeSchedule
+from Presolve import presolveCheck
+from Sequence import optimizeSequence
+from Report import printSchedule as report_printSchedule
+from Export import save_cache, load_cache
+import logging
+import argparse
+import copy
+import time
+
+logger = logging.getLogger(__name__)
+
+def replan(cache, params, done=(), lost=()):
+    """
+    キャッシュした観測条件を使い、残りの夜だけを再計画します。
+
+    done の夜は計画どおりに観測されたものとして割り当てを固定し、その露出を観測済みに加えます。
+    lost の夜 (天候などで観測できなかった夜) は使いません。以前の再計画でキャッシュに保存した
+    done と lost の夜も同じように扱います。fname_obsdate_finish の夜は
+    fname_targets_finish で観測数が与えられているので、そのまま観測済みとして扱います。
+
+    残りの夜は各 priority について OptimizeSchedule を解き、optimizeSequence で並べ替えます。
+    GA のフィールドはパラメータファイルの aggregate_GA によらず常にまとめて最適化し、更新時にサブポインティングへ割り当てます
+    (過去の夜の割り当てを変える reorderGAtargets の代わり)。
+
+    Args:
+        cache (dict): load_cache で読み込んだキャッシュ。
+        params: Params オブジェクト
+        done (list): 計画どおりに観測された夜 (ローカルの日付)。
+        lost (list): 観測できなかった夜 (ローカルの日付)。
+
+    Returns:
+        tuple: 再計画した ObsDate (done と lost の夜は観測済み)、ObsSlotList と TargetList、残りの夜のリスト。
+    """
+    obsdate = cache['obsdate']
+    observer = cache['observer']
+    oc = cache['observingConditions']
+    plan = cache['obsSlotList']
+
+    # Nights of the previous replannings stay fixed (done) or unused (lost)
+    done = list(dict.fromkeys(list(cache.get('done', [])) + list(done)))
+    lost = list(dict.fromkeys(list(cache.get('lost', [])) + list(lost)))
+
+    unknown = [date for date in list(done) + list(lost) if date not in obsdate.dates]
+    if unknown:
+        raise ValueError(f"Dates not in the observation dates: {unknown}")
+
+    # Targets with the observations recorded in fname_targets_finish
+    targetList = TargetManager(params.fname_targets, params.fname_targets_finish).targetList
+
+    # Slots of the finished, done and lost nights are used
+    obsdate = obsdate.clone(dates_finish=list(dict.fromkeys(list(obsdate.dates_finish) + list(done) + list(lost))))
+    obsSlotList = obsdate.obsSlotList
+    remaining = [date for date in obsdate.dates if date not in obsdate.dates_finish]
+    logger.info(f"Replanning {len(remaining)} nights: {remaining}")
+
+    # Fix the decisions of the nights observed as planned
+    for slot in obsSlotList:
+        if slot.date not in done:
+            continue
+        planned = plan.get_slot_by_index(slot.index)
+        if planned is None or planned.target is None:
+            continue
+        index = targetList.get_index(planned.target.name)
+        if index is None:
+            logger.warning(f"Target {planned.target.name} of slot {slot.index} is not in {params.fname_targets}")
+            continue
+        slot.target = targetList.targets[index]
+        targetList.update_observed(slot.target.name, 1)
+
+    # Optimize the remaining nights, with the GA fields aggregated on a copy of the caller's parameters:
+    # reorderGAtargets would reassign the sub-pointings of the past nights
+    if not params.aggregate_GA:
+        logger.warning("aggregate_GA is False in the parameter file, but the replanning always aggregates the GA fields")
+    params = copy.copy(params)
+    params.params = dict(params.params, aggregate_GA=True)
+    for priority in targetList.priorities:
+        check = presolveCheck(obsSlotList, targetList, oc, params, observer, obsdate.nexp_max, priority=priority)
+        if check.upper_bound == 0:
+            logger.warning(f"Skipping the optimization for priority {priority}: no exposure is achievable")
+            continue
+        o, obs_slots, targets, dummy = OptimizeSchedule(obsSlotList, targetList, oc, params, observer, obsdate.nexp_max, priority)
+        obsSlotList.updateSchedule(o, obs_slots, targets, targetList)
+
+    optimizeSequence(obsSlotList, oc, params, observer, dates=remaining)
+    obsSlotList.updateTimeBySlew(oc, params)
+
+    return obsdate, obsSlotList, targetList, remaining
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replan the remaining nights using the cached observing conditions. "
+                                                 "The GA fields are always aggregated (aggregate_GA), whatever the parameter file sets")
+    parser.add_argument('--params', default='parameters_2025May.yaml',
+                        help='Parameter file (default: parameters_2025May.yaml)')
+    parser.add_argument('--cache', default=None,
+                        help='Cache written by sspplan.py (default: fname_cache of the parameter file)')
+    parser.add_argument('--done', nargs='+', default=[],
+                        help='Nights (local dates) observed as planned')
+    parser.add_argument('--lost', nargs='+', default=[],
+                        help='Nights (local dates) lost, e.g. to the weather')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the logging level for the application (default: INFO)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    params = Params(args.params)
+    fname_cache = args.cache or params.fname_cache
+
+    t0 = time.perf_counter()
+    cache = load_cache(fname_cache)
+    obsdate, obsSlotList, targetList, remaining = replan(cache, params, args.done, args.lost)
+    logger.info(f"Replanning done in {time.perf_counter() - t0:.1f} s")
+
+    # Report from the cached conditions, interpolated at the slot times updated by the slew
+    t0 = time.perf_counter()
+    observer = cache['observer']
+    done = list(dict.fromkeys(list(cache.get('done', [])) + list(args.done)))
+    lost = list(dict.fromkeys(list(cache.get('lost', [])) + list(args.lost)))
+    dates_local = [date for date in obsdate.dates_local if date not in lost]
+    report_printSchedule(obsSlotList, dates_local, observer, cache['observingConditions'], params)
+    logger.info(f"Report done in {time.perf_counter() - t0:.1f} s")
+
+    # The replanned schedule, with the done and lost nights, becomes the plan of the next replanning
+    save_cache(fname_cache, obsdate, observer, cache['visibility'], cache['observingConditions'], obsSlotList,
+               done=done, lost=lost)
@@ -4,8 +4,17 @@ from ObsSlot import ObsDate
 from Targets import TargetManager, TargetList, Target
 from ObservingConditions import ObservingConditions
 from Optimize import OptimizeSchedule
-from Plotting import plotSchedule, plotSchedule_rotang, plotSchedule_ha, plotObservedCounts
-from Report import printSchedule as report_printSchedule, printSchedule_PDF # Renamed to avoid conflict
+from Plotting import SchedulePlotter, renderPanels, plotObservedCounts
+from Report import scheduleFrame, formatSchedule, createTableContents, write_text_and_table_to_pdf, write_night_pdf, printVisibilityWindows
+from Artifacts import ArtifactQueue
+from Visibility import VisibilityWindows
+from Sequence import optimizeSequence
+from Presolve import presolveCheck
+from Export import exportSchedule, exportConditions, save_cache
+from Checkpoint import STAGES, CheckpointStore, time_array, assignment_arrays, restore_assignments, target_arrays, restore_targets
+from Profiling import Profiler, span
+import Profiling
+from astropy.time import Time
 import logging
 import pprint
 import argparse # Added for command-line arguments
@@ -13,12 +22,18 @@ import argparse # Added for command-line arguments
 logger = logging.getLogger(__name__) # Logger can be defined globally
 
 
-def optimization_1st(targetList, obsSlotList, ObservingConditions, params, subaru, obsdate):
+def optimization_1st(targetList, obsSlotList, ObservingConditions, params, subaru, obsdate, artifacts):
     """
     1st stage of the optimization process.
     """
+    # The twilight times are shared by the successive priority stages
+    plotter = SchedulePlotter(subaru)
     for priority in targetList.priorities:
         logger.info(f"Optimization 1st stage - Priority: {priority}")
+        check = presolveCheck(obsSlotList, targetList, ObservingConditions, params, subaru, obsdate.nexp_max, priority=priority)
+        if check.upper_bound == 0:
+            logger.warning(f"Skipping the optimization for priority {priority}: no exposure is achievable")
+            continue
         o, obs_slots, targets, dummy = OptimizeSchedule(obsSlotList, targetList, ObservingConditions, params, subaru, obsdate.nexp_max, priority)
 
         #for slot in obs_slots:
@@ -32,11 +47,12 @@ def optimization_1st(targetList, obsSlotList, ObservingConditions, params, subar
         #    print(f'{t.name} {t.wg} {t.priority} {t.observed}')
         #    # logger.debug(f'Target observed (1st opt): {t.name} {t.wg} {t.priority} {t.observed}')
 
-        plotSchedule(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru, priority)
-        plotSchedule_rotang(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru, priority)
-        plotSchedule_ha(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru, priority)
+        # The plots of each priority are rendered in the background while the next one is optimized
+        if artifacts.intermediate:
+            artifacts.submit(renderPanels, plotter.snapshot(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, priority),
+                             intermediate=True)
 
-def optimization_2nd(obsSlotList, ObservingConditions, params, subaru, obsdate):
+def optimization_2nd(obsSlotList, ObservingConditions, params, subaru, obsdate, artifacts):
     """
     2nd stage of the optimization process.
     """
@@ -51,13 +67,15 @@ def optimization_2nd(obsSlotList, ObservingConditions, params, subaru, obsdate):
     logger.info(f'Total {targetList2.num_targets} targets available for 2nd stage')
     logger.info(f"WG objects for 2nd stage: {pprint.pformat(targetList2.wg_objects)}")
 
-    # Load observation slots for the second stage
-    obsdate2 = ObsDate(params.fname_obsdate,
-                      params.fname_obsdate_finish,
-                      observer=subaru,
-                      params=params)
+    # Fresh observation slots for the second stage (night boundaries are not recomputed)
+    obsdate2 = obsdate.clone()
     obsSlotList2 = obsdate2.obsSlotList
 
+    check = presolveCheck(obsSlotList2, targetList2, ObservingConditions, params, subaru, obsdate.nexp_max, obsdate.nexp_min)
+    if check.upper_bound == 0:
+        logger.warning("Skipping the 2nd stage optimization: no exposure is achievable")
+        return obsSlotList2, targetList2
+
     o, obs_slots, targets, dummy = OptimizeSchedule(obsSlotList2, targetList2, ObservingConditions, params, subaru, obsdate.nexp_max)
     obsSlotList2.updateSchedule(o, obs_slots, targets, targetList2)
 
@@ -65,13 +83,12 @@ def optimization_2nd(obsSlotList, ObservingConditions, params, subaru, obsdate):
     for t in targets:
         logger.info(f"  Name: {t.name}, WG: {t.wg}, Priority: {t.priority}, Observed: {t.observed}")
 
-    plotSchedule(obsSlotList2, obsdate.dates_local, ObservingConditions, targetList2, subaru)
-    plotSchedule_rotang(obsSlotList2, obsdate.dates_local, ObservingConditions, targetList2, subaru)
-    plotSchedule_ha(obsSlotList2, obsdate.dates_local, ObservingConditions, targetList2, subaru)
+    artifacts.submit(renderPanels, SchedulePlotter(subaru).snapshot(obsSlotList2, obsdate.dates_local, ObservingConditions, targetList2),
+                     key='panels')
 
     return obsSlotList2, targetList2
 
-def optimization_3rd(obsSlotList, ObservingConditions, params, subaru, obsdate):
+def optimization_3rd(obsSlotList, ObservingConditions, params, subaru, obsdate, artifacts):
     """
     2nd stage of the optimization process.
     """
@@ -88,6 +105,11 @@ def optimization_3rd(obsSlotList, ObservingConditions, params, subaru, obsdate):
 
     obsSlotList.reset()
 
+    check = presolveCheck(obsSlotList, targetList, ObservingConditions, params, subaru, obsdate.nexp_max, obsdate.nexp_min)
+    if check.upper_bound == 0:
+        logger.warning("Skipping the 3rd stage optimization: no exposure is achievable")
+        return obsSlotList, targetList
+
     o, obs_slots, targets, dummy = OptimizeSchedule(obsSlotList, targetList, ObservingConditions, params, subaru, obsdate.nexp_max)
     obsSlotList.updateSchedule(o, obs_slots, targets, targetList)
 
@@ -95,9 +117,8 @@ def optimization_3rd(obsSlotList, ObservingConditions, params, subaru, obsdate):
     for t in targets:
         logger.info(f"  Name: {t.name}, WG: {t.wg}, Priority: {t.priority}, Observed: {t.observed}")
 
-    plotSchedule(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru)
-    plotSchedule_rotang(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru)
-    plotSchedule_ha(obsSlotList, obsdate.dates_local, ObservingConditions, targetList, subaru)
+    artifacts.submit(renderPanels, SchedulePlotter(subaru).snapshot(obsSlotList, obsdate.dates_local, ObservingConditions, targetList),
+                     key='panels')
 
     return obsSlotList, targetList
 
@@ -121,6 +142,157 @@ def reorderGAtargets(obsSlotList):
             t.observed = nobs
             i0 += nobs
 
+def run_pipeline(args, params, subaru, checkpoints, artifacts):
+    """
+    観測夜 (slots)、観測条件 (conditions)、1st stage (stage1)、2nd stage (stage2)、報告と出力 (output) を順に実行します。
+
+    入力 (Checkpoint.DEPENDENCIES) が変わっていない段階は計算せずにチェックポイントから復元します。
+    args.from_stage 以降の段階は必ず計算し直し、args.to_stage の段階で終了します。
+    """
+    first = checkpoints.first_stage(args.from_stage)
+    last = STAGES.index(args.to_stage)
+    if first > last:
+        logger.info(f"Stages up to {args.to_stage} are up to date in {checkpoints.directory}: nothing to do "
+                    f"(use --from-stage to recompute them)")
+        return
+    logger.info(f"Stages restored from the checkpoints: {STAGES[:first]}, computed: {STAGES[first:last+1]}")
+
+    with span('slots', stage=True):
+        # Night boundaries of the slots checkpoint
+        boundaries = None
+        if first > STAGES.index('slots'):
+            slots = checkpoints.load('slots')
+            boundaries = tuple(Time(slots[name][0], slots[name][1], format='jd', scale='utc')
+                               for name in ['night_start', 'night_end'])
+
+        # Load observation slots
+        obsdate = ObsDate(params.fname_obsdate,
+                          params.fname_obsdate_finish,
+                          observer=subaru,
+                          params=params,
+                          boundaries=boundaries)
+        obsSlotList = obsdate.obsSlotList
+        num_slots = obsSlotList.num_slots
+        logger.info(f"Total {num_slots} observation slots available")
+
+        for date in obsdate.dates_local:
+            logger.info(f"Slots for date {date}: {[slot.index for slot in obsdate.obsSlotList.get_slots_by_date(date)]}")
+
+        logger.info(f"Nexp max per WG: {obsdate.nexp_max}")
+        logger.info(f"Nexp min per WG: {obsdate.nexp_min}")
+
+        # Load target list
+        target_manager = TargetManager(params.fname_targets, params.fname_targets_finish)
+        targetList = target_manager.targetList
+        num_targets = targetList.num_targets
+        logger.info(f'Total {num_targets} targets available')
+        logger.info(f"Priorities: {targetList.priorities}")
+        logger.info(f"Working groups: {targetList.wg_list}")
+        logger.info(f"WG objects: {pprint.pformat(targetList.wg_objects)}")
+        #logger.debug(pprint.pformat(targetList.wg_objects)) # if pprint.pprint was used for debugging
+
+
+        # Visibility windows of each target for each night, used to prune (target, slot) pairs
+        visibility = VisibilityWindows(obsSlotList, targetList, subaru, params)
+        if args.print_windows:
+            printVisibilityWindows(visibility, targetList, obsdate.dates_local, subaru)
+
+        if boundaries is None:
+            checkpoints.save('slots', night_start=time_array(obsdate.night_start), night_end=time_array(obsdate.night_end))
+    if last == STAGES.index('slots'):
+        return
+
+    with span('conditions', stage=True):
+        if first > STAGES.index('conditions'):
+            observingConditions = ObservingConditions.from_arrays(checkpoints.load('conditions'), obsSlotList, targetList,
+                                                                  subaru, params, visibility)
+        else:
+            observingConditions = ObservingConditions(obsSlotList, targetList, subaru, params, visibility)
+            checkpoints.save('conditions', **observingConditions.arrays())
+    if last == STAGES.index('conditions'):
+        return
+
+    with span('stage1', stage=True):
+        # 1st stage of the optimization (only restored when the 2nd stage is computed from it)
+        if first <= STAGES.index('stage1'):
+            optimization_1st(targetList, obsSlotList, observingConditions, params, subaru, obsdate, artifacts)
+            checkpoints.save('stage1', **assignment_arrays(obsSlotList))
+        elif first == STAGES.index('stage2'):
+            restore_assignments(obsSlotList, checkpoints.load('stage1'), {t.name: t for t in targetList.get_all_targets()},
+                                targetList)
+    if last == STAGES.index('stage1'):
+        return
+
+    with span('stage2', stage=True):
+        if first <= STAGES.index('stage2'):
+            reorderGAtargets(obsSlotList)
+
+            # 2nd stage of the optimization
+            obsSlotList2, targetList2 = optimization_2nd(obsSlotList, observingConditions, params, subaru, obsdate, artifacts)
+
+            for t in targetList.get_all_targets():
+                if not t.name in targetList2.names:
+                    targetList2.add_target(t)
+
+            reorderGAtargets(obsSlotList2)
+
+            # Reorder the targets within each night to reduce the slew time
+            if not args.no_sequence:
+                optimizeSequence(obsSlotList2, observingConditions, params, subaru)
+
+            checkpoints.save('stage2', **assignment_arrays(obsSlotList2), **target_arrays(targetList2))
+        else:
+            stage2 = checkpoints.load('stage2')
+            targetList2 = restore_targets(stage2, targetList)
+            obsSlotList2 = obsdate.clone().obsSlotList
+            restore_assignments(obsSlotList2, stage2, {t.name: t for t in targetList2.get_all_targets()})
+            # The PDF embeds the panels of the 2nd stage
+            artifacts.submit(renderPanels, SchedulePlotter(subaru).snapshot(obsSlotList2, obsdate.dates_local, observingConditions, targetList2),
+                             key='panels')
+    if last == STAGES.index('stage2'):
+        return
+
+    with span('output', stage=True):
+        artifacts.submit(plotObservedCounts, targetList2, key='observed_counts')
+
+        artifacts.submit(formatSchedule, scheduleFrame(obsSlotList2, subaru, observingConditions, params, obsdate.dates_local),
+                         obsdate.dates_local, intermediate=True)
+
+        obsSlotList2.updateTimeBySlew(observingConditions, params)
+
+        observingConditions2 = ObservingConditions(obsSlotList2, targetList2, subaru, params, visibility) # Recalculate OC with updated times
+
+        # 3rd stage of the optimization
+        #obsSlotList3, targetList3 = optimization_3rd(obsSlotList2, observingConditions2, params, subaru, obsdate, artifacts)
+
+        #for t in targetList.get_all_targets():
+        #    if not t.name in targetList3.names:
+        #        targetList3.add_target(t)
+
+        artifacts.submit(formatSchedule, scheduleFrame(obsSlotList2, subaru, observingConditions2, params, obsdate.dates_local),
+                         obsdate.dates_local)
+
+        # Final schedule and condition grids for the downstream tools
+        exportSchedule(params.fname_schedule, obsSlotList2, subaru, observingConditions2, params)
+        exportConditions(params.fname_conditions, observingConditions2)
+
+        # Cache of the conditions and the plan for replan.py
+        save_cache(params.fname_cache, obsdate, subaru, visibility, observingConditions, obsSlotList2)
+
+        # The nights of the PDF can be written in parallel as soon as their tables are ready
+        texts, tables, tablestyles = createTableContents(obsSlotList2, subaru, observingConditions2, params)
+        if args.pdf_per_night:
+            for date, text, data, ts in zip(obsdate.dates_local, texts, tables, tablestyles):
+                artifacts.submit(write_night_pdf, text, data, ts, params, date)
+
+        # The PDF embeds the PNG bytes of the plots returned by the rendering processes
+        images = dict(artifacts.result('panels', {}))
+        images['observed_counts'] = artifacts.result('observed_counts')
+        artifacts.submit(write_text_and_table_to_pdf, texts, tables, tablestyles, params,
+                         {name: image for name, image in images.items() if image is not None})
+
+        checkpoints.save('output')
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="SSP Plan Optimizer")
     parser.add_argument(
@@ -129,6 +301,81 @@ if __name__ == '__main__':
         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
         help='Set the logging level for the application (default: INFO)'
     )
+    parser.add_argument(
+        '--print-windows',
+        action='store_true',
+        help='Print the visibility windows of the targets for each night'
+    )
+    parser.add_argument(
+        '--no-sequence',
+        action='store_true',
+        help='Skip the reordering of the targets within each night to reduce the slew time'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=2,
+        help='Number of processes rendering the plots and reports in the background (0: render them synchronously)'
+    )
+    parser.add_argument(
+        '--no-intermediate',
+        action='store_true',
+        help='Skip the plots and reports of the intermediate stages'
+    )
+    parser.add_argument(
+        '--pdf-per-night',
+        action='store_true',
+        help='Also write the table of each night to its own PDF, in parallel'
+    )
+    parser.add_argument(
+        '--params',
+        default='parameters_2025May.yaml',
+        help='Parameter file (default: parameters_2025May.yaml)'
+    )
+    parser.add_argument(
+        '--from-stage',
+        default=None,
+        choices=STAGES,
+        help='Recompute from this stage even if its checkpoint is valid (default: the first stage without a valid checkpoint)'
+    )
+    parser.add_argument(
+        '--to-stage',
+        default=STAGES[-1],
+        choices=STAGES,
+        help=f'Stop after this stage (default: {STAGES[-1]})'
+    )
+    parser.add_argument(
+        '--checkpoint-dir',
+        default=None,
+        help='Directory of the stage checkpoints (default: dir_checkpoint of the parameter file)'
+    )
+    parser.add_argument(
+        '--no-checkpoint',
+        action='store_true',
+        help='Neither restore nor save the stage checkpoints'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='profile',
+        default=None,
+        metavar='PREFIX',
+        help='Record the time and memory of the stages and write them to PREFIX.json and a Chrome trace '
+             'PREFIX.trace.json (default PREFIX: profile). The plots and reports rendered in the background '
+             'are not included: use --workers 0 to profile them'
+    )
+    parser.add_argument(
+        '--profile-stages',
+        nargs='+',
+        default=[],
+        choices=STAGES,
+        help='Stages to profile with cProfile, written to PREFIX.<stage>.prof (with --profile)'
+    )
+    parser.add_argument(
+        '--no-tracemalloc',
+        action='store_true',
+        help='Do not trace the memory allocations of the stages (with --profile), which slows them down'
+    )
     args = parser.parse_args()
 
     # Configure logging using the command-line argument
@@ -142,7 +389,7 @@ if __name__ == '__main__':
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     # Load parameters
-    params = Params('parameters_2025May.yaml')
+    params = Params(args.params)
 
     logger.info(f"Airmass limits: {params.airmass['limit']}")
 
@@ -150,69 +397,22 @@ if __name__ == '__main__':
     subaru = MyObserver.at_site('Subaru', timezone='US/Hawaii')
     logger.info(f"UTC offset: {subaru.utcoffset}")
 
-    # Load observation slots
-    obsdate = ObsDate(params.fname_obsdate,
-                      params.fname_obsdate_finish,
-                      observer=subaru,
-                      params=params)
-    obsSlotList = obsdate.obsSlotList
-    num_slots = obsSlotList.num_slots
-    logger.info(f"Total {num_slots} observation slots available")
-    
-    for date in obsdate.dates_local:
-        logger.info(f"Slots for date {date}: {[slot.index for slot in obsdate.obsSlotList.get_slots_by_date(date)]}")
-
-    logger.info(f"Nexp max per WG: {obsdate.nexp_max}")
-    logger.info(f"Nexp min per WG: {obsdate.nexp_min}")
-    
-    # Load target list
-    target_manager = TargetManager(params.fname_targets, params.fname_targets_finish)
-    targetList = target_manager.targetList
-    num_targets = targetList.num_targets
-    logger.info(f'Total {num_targets} targets available')
-    logger.info(f"Priorities: {targetList.priorities}")
-    logger.info(f"Working groups: {targetList.wg_list}")
-    logger.info(f"WG objects: {pprint.pformat(targetList.wg_objects)}")
-    #logger.debug(pprint.pformat(targetList.wg_objects)) # if pprint.pprint was used for debugging
-
-
-    observingConditions = ObservingConditions(obsSlotList, targetList, subaru, params)
-
-    # 1st stage of the optimization
-    optimization_1st(targetList, obsSlotList, observingConditions, params, subaru, obsdate)
-
-    reorderGAtargets(obsSlotList)
-
-    # 2nd stage of the optimization
-    obsSlotList2, targetList2 = optimization_2nd(obsSlotList, observingConditions, params, subaru, obsdate)
-    
-    for t in targetList.get_all_targets():
-        if not t.name in targetList2.names:
-            targetList2.add_target(t)
-
-    reorderGAtargets(obsSlotList2)
-
-    plotObservedCounts(targetList2)
-
-    report_printSchedule(obsSlotList2, obsdate.dates_local, subaru, observingConditions, params)
-
-    obsSlotList2.updateTimeBySlew(observingConditions, params)
-
-    observingConditions2 = ObservingConditions(obsSlotList2, targetList2, subaru, params) # Recalculate OC with updated times
+    # Checkpoints of the stages, valid while the parameters, files and options each stage depends on are unchanged
+    checkpoint_dir = None if args.no_checkpoint else (args.checkpoint_dir or params.dir_checkpoint)
+    checkpoints = CheckpointStore(checkpoint_dir, params, {'stage2': {'no_sequence': args.no_sequence}})
 
-    # 3rd stage of the optimization
-    #obsSlotList3, targetList3 = optimization_3rd(obsSlotList2, observingConditions2, params, subaru, obsdate)
+    # Plots and reports are rendered in background processes
+    artifacts = ArtifactQueue(args.workers, intermediate=not args.no_intermediate)
 
-    #for t in targetList.get_all_targets():
-    #    if not t.name in targetList3.names:
-    #        targetList3.add_target(t)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(trace_memory=not args.no_tracemalloc, cprofile=args.profile_stages, prefix=args.profile)
+        Profiling.enable(profiler)
 
-    report_printSchedule(obsSlotList2, obsdate.dates_local, subaru, observingConditions2, params)
+    run_pipeline(args, params, subaru, checkpoints, artifacts)
 
-    import pickle
-    with open('obsSlotList2.pickle', 'wb') as f:
-        pickle.dump(obsSlotList2, f)
-    with open('observingConditions2.pickle', 'wb') as f:
-        pickle.dump(observingConditions2, f)
+    artifacts.join()
 
-    printSchedule_PDF(obsSlotList2, subaru, observingConditions2, params)
\ No newline at end of file
+    if profiler is not None:
+        profiler.log()
+        profiler.write(f'{args.profile}.json', f'{args.profile}.trace.json')
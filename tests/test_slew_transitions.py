@@ -0,0 +1,43 @@
+from Params import Params
+from ObsSlot import ObsSlot
+from Targets import Target
+from Optimize import adjacent_pairs, slew_transitions, ROTANG_MIN, ROTANG_MAX
+from astropy.coordinates import SkyCoord, EarthLocation
+import astropy.units as u
+import numpy as np
+import os
+import types
+
+PARAMS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'parameters_2025May.yaml')
+
+class ConstantConditions:
+    """
+    Conditions in which every target is observable in every slot, with a slew of 1 minute.
+    """
+    VALUES = {'moon_sep': 90.0, 'mars_sep': 90.0, 'jupiter_sep': 90.0, 'saturn_sep': 90.0,
+              'airmass': 1.1, 'ha': 2.0, 'rotang_start': 0.0, 'rotang_end': 0.0}
+
+    def visible_mask(self, islots, names):
+        return np.ones(np.broadcast(islots, names).shape, dtype=bool)
+
+    def values(self, name, islots, names):
+        return np.full(np.broadcast(islots, names).shape, self.VALUES[name])
+
+    def slew_times(self, slots, from_targets, to_targets):
+        return np.ones(len(slots)) * u.minute
+
+def make_slot(index, date='2025-05-26'):
+    return ObsSlot(index, None, None, None, None, None, date, date)
+
+def test_no_transition_across_a_gap():
+    # Slots 3 and 4 of the night were filled by an earlier priority stage
+    obs_slots = [make_slot(i) for i in [1, 2, 5, 6]] + [make_slot(7, '2025-05-27')]
+    targets = [Target('CO', name, SkyCoord(150.0 * u.deg, 2.0 * u.deg), 90.0 * u.deg, 2, 1) for name in ['a', 'b']]
+    observer = types.SimpleNamespace(location=EarthLocation.from_geodetic(-155.4761 * u.deg, 19.8256 * u.deg, 4139 * u.m))
+
+    assert [(s1.index, s2.index) for s1, s2 in adjacent_pairs(obs_slots)] == [(1, 2), (5, 6)]
+
+    transitions = slew_transitions(obs_slots, targets, ConstantConditions(), Params(PARAMS), observer,
+                                   ROTANG_MIN, ROTANG_MAX)
+    assert sorted(set(islot for islot, _, _ in transitions)) == [1, 5]
+    assert len(transitions) == 2 * len(targets)**2